@@ -0,0 +1,285 @@
+"""
+Admission control for contact/list, so a few clients asking for whole multi-million row books can't take every
+worker.
+
+Before the view runs the request gets a cost: the rows it reads, estimated the way query.plan does it from the
+label counters (LabelStat) and the highest contact id, a fraction of that for emails_only, at most limit= when
+there is one, streamed or not. Requests below EXPENSIVE_ROWS pass without further ado, the pages of a client paging
+through the book cost no query at all.
+
+An expensive request needs a slot, at most MAX_CONCURRENT of them run at once and MAX_CONCURRENT_PER_CLIENT
+per client, and its cost in tokens from two buckets: the client's (CLIENT_RATE rows per second, CLIENT_BURST
+at most) and the one of all clients together (RATE, BURST). When either is short the request waits up to
+QUEUE_SECONDS and is then shed with a 429 and a Retry-After. A client is its address, or the value of
+CLIENT_HEADER behind a gateway that sets one.
+
+It's a view decorator, below the result cache and the conditional requests: a cache hit or a 304 is cheap
+whatever the filter. The slots and buckets are per process, like the locmem cache; admission/stats and
+/metrics show the counters.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.models import Max
+from django.http import HttpResponse
+
+from . import query, segments
+from .models import Contact
+
+DEFAULTS = {
+    "ENABLED": False,
+    "EXPENSIVE_ROWS": 10000,  # estimated rows from which a request is admitted
+    "MAX_CONCURRENT": 8,  # expensive requests running at once, in this process
+    "MAX_CONCURRENT_PER_CLIENT": 2,
+    "RATE": 2000000,  # rows per second for all clients together
+    "BURST": 10000000,
+    "CLIENT_RATE": 500000,  # rows per second for one client
+    "CLIENT_BURST": 2000000,
+    "QUEUE_SECONDS": 2,  # how long an excess request waits for its turn before the 429
+    "EMAILS_ONLY_WEIGHT": 0.2,  # share of the cost of a row left for an email: no labels, one narrow column
+    "CLIENT_HEADER": None,  # e.g. "X-Api-Key", the address of the client without
+    "MAX_CLIENTS": 10000,  # buckets kept, the ones of the clients not seen for longest go first
+}
+POLL_SECONDS = 0.05  # how often a waiting request looks again
+COUNTERS = ("cheap", "admitted", "queued", "rejected_rate", "rejected_concurrency")
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "CONTACTBOOK_ADMISSION", {})}
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, amount, now):
+        """Seconds until amount tokens are there, 0 when they are"""
+        self.refill(now)
+        return max(min(amount, self.capacity) - self.tokens, 0) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+
+class AdmissionController:
+    """The slots, buckets and counters of the process"""
+
+    def __init__(self, config):
+        self.config = config
+        self.bucket = TokenBucket(config["RATE"], config["BURST"])
+        self.client_buckets = OrderedDict()
+        self.running = Counter()  # client -> expensive requests running
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def client_bucket(self, client):
+        bucket = self.client_buckets.get(client)
+        if bucket is None:
+            bucket = self.client_buckets[client] = TokenBucket(self.config["CLIENT_RATE"],
+                                                               self.config["CLIENT_BURST"])
+            while len(self.client_buckets) > self.config["MAX_CLIENTS"]:
+                self.client_buckets.popitem(last=False)
+        self.client_buckets.move_to_end(client)
+        return bucket
+
+    def try_enter(self, client, cost):
+        """(None, 0) when admitted, else (reason, seconds to wait): nothing is taken unless all of it is there"""
+        with self._lock:
+            if (sum(self.running.values()) >= self.config["MAX_CONCURRENT"]
+                    or self.running[client] >= self.config["MAX_CONCURRENT_PER_CLIENT"]):
+                return "rejected_concurrency", POLL_SECONDS
+            client_bucket = self.client_bucket(client)
+            now = time.monotonic()
+            wait = max(self.bucket.wait(cost, now), client_bucket.wait(cost, now))
+            if wait:
+                return "rejected_rate", wait
+            self.bucket.take(cost)
+            client_bucket.take(cost)
+            self.running[client] += 1
+            return None, 0
+
+    def leave(self, client):
+        with self._lock:
+            self.running[client] -= 1
+            if not self.running[client]:
+                del self.running[client]
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "running": sum(self.running.values()), "clients": len(self.client_buckets)}
+
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_controller():
+    """The controller of the current settings, None when admission control is off"""
+    global _controller
+    config = get_config()
+    if not config["ENABLED"]:
+        return None
+    with _controller_lock:
+        if _controller is None or _controller.config != config:
+            _controller = AdmissionController(config)
+        return _controller
+
+
+def client_of(request, config):
+    if config["CLIENT_HEADER"] and request.headers.get(config["CLIENT_HEADER"]):
+        return request.headers[config["CLIENT_HEADER"]]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def estimate_cost(params, config):
+    """The rows a contact/list request with these params (filters.parse_list_params) reads"""
+    if params["explain"]:
+        return 0
+    # a limit stops a stream too, after= alone only pages without one
+    page = params["limit"] or (params["page_size"] if params["paged"] and not params["stream"] else None)
+    if page is not None and page < config["EXPENSIVE_ROWS"]:
+        return page
+    node = params["query"] or segments.filter_node(params["label_names"], params["match_mode"],
+                                                   params["exclude_names"])
+    if node is None:
+        rows = Contact.all_objects.aggregate(top=Max("id"))["top"] or 0
+    else:
+        rows = query.plan("", node).root.estimate
+    if params["emails_only"]:
+        rows *= config["EMAILS_ONLY_WEIGHT"]
+    return math.ceil(min(rows, page) if page else rows)
+
+
+def too_busy(wait):
+    response = HttpResponse("too many expensive requests, try again later", status=429)
+    response["Retry-After"] = str(max(math.ceil(wait), 1))
+    return response
+
+
+def enter(controller, client, cost, waited):
+    """None when admitted, the 429 once the request waited long enough, else the seconds to wait before trying again"""
+    reason, wait = controller.try_enter(client, cost)
+    if reason is None:
+        controller.count("queued" if waited else "admitted")
+        return None
+    if waited + wait > controller.config["QUEUE_SECONDS"]:
+        controller.count(reason)
+        return too_busy(wait)
+    return min(wait, POLL_SECONDS)
+
+
+def release_on_close(response, release):
+    # a streamed body is read after the view returned, the slot is given back once the server closed it
+    close = response.close
+
+    def closing():
+        try:
+            close()
+        finally:
+            release()
+    response.close = closing
+    return response
+
+
+def finished(response, controller, client):
+    if response.streaming:
+        return release_on_close(response, lambda: controller.leave(client))
+    controller.leave(client)
+    return response
+
+
+def admitted(params_of):
+    """
+    Admission control for the expensive requests of a view (sync or async), see the top of the module.
+    params_of(request) returns the (params, error) of the view, a request with an error is let through.
+    """
+    def cost_of(request, config):
+        params, error = params_of(request)
+        return 0 if error else estimate_cost(params, config)
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                controller = get_controller()
+                if controller is None:
+                    return await view(request, *args, **kwargs)
+                cost = await sync_to_async(cost_of)(request, controller.config)
+                if cost < controller.config["EXPENSIVE_ROWS"]:
+                    controller.count("cheap")
+                    return await view(request, *args, **kwargs)
+                client, waited = client_of(request, controller.config), 0
+                while True:
+                    result = enter(controller, client, cost, waited)
+                    if result is None:
+                        break
+                    if isinstance(result, HttpResponse):
+                        return result
+                    await asyncio.sleep(result)
+                    waited += result
+                try:
+                    response = await view(request, *args, **kwargs)
+                except BaseException:
+                    controller.leave(client)
+                    raise
+                return finished(response, controller, client)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            controller = get_controller()
+            if controller is None:
+                return view(request, *args, **kwargs)
+            cost = cost_of(request, controller.config)
+            if cost < controller.config["EXPENSIVE_ROWS"]:
+                controller.count("cheap")
+                return view(request, *args, **kwargs)
+            client, waited = client_of(request, controller.config), 0
+            while True:
+                result = enter(controller, client, cost, waited)
+                if result is None:
+                    break
+                if isinstance(result, HttpResponse):
+                    return result
+                time.sleep(result)
+                waited += result
+            try:
+                response = view(request, *args, **kwargs)
+            except BaseException:
+                controller.leave(client)
+                raise
+            return finished(response, controller, client)
+        return wrapper
+    return decorator
+
+
+def prometheus():
+    """The counters in the Prometheus text format, nothing when admission control is off"""
+    controller = get_controller()
+    if controller is None:
+        return ""
+    stats = controller.stats()
+    lines = ["# HELP contactbook_admission_requests_total contact/list requests by what admission control did",
+             "# TYPE contactbook_admission_requests_total counter"]
+    lines += [f'contactbook_admission_requests_total{{outcome="{name}"}} {stats[name]}' for name in COUNTERS]
+    lines += ["# HELP contactbook_admission_running Expensive requests running",
+              "# TYPE contactbook_admission_running gauge",
+              f"contactbook_admission_running {stats['running']}"]
+    return "\n".join(lines) + "\n"
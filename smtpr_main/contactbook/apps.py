@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class ContactbookConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'contactbook'
+
+    def ready(self):
+        # connect the signal receivers
+        from . import signals, label_index, label_stats, cache, changes, database, instrumentation, books, segments  # noqa: F401
@@ -0,0 +1,269 @@
+"""
+Async versions of the hot endpoints, for when the app is served over ASGI (uvicorn smtpr_main.asgi:application
+with CONTACTBOOK_ASYNC_VIEWS = True). They run on the event loop and only hop to a thread for the queries
+(Django's async ORM), a slow contact_list no longer pins a worker thread for its whole duration.
+
+Parameters, answers and errors are the ones of views.py, which also keeps doing what has no async ORM
+counterpart: the in-memory label index and the multi statement transactions of deletion.py.
+"""
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.views.decorators.http import require_http_methods
+
+from . import admission, cache, changes, label_index, label_queue, labels, query, segments, serialization, views
+from .cache import cached_view
+from .conditional import compressed_view, conditional_view
+from .database import read_only_view
+from .filters import encode_cursor, filter_contacts, parse_list_params
+from .instrumentation import JSONEncoder, JsonResponse
+from .models import Contact, Label, LabelMutation
+from .views import STREAM_CHUNK_SIZE, name_list, page_envelope, parse_body, parse_changes_params, contact_page, \
+    project, serialize_fields
+
+
+async def astream_json_array(items, prefix="", suffix=""):
+    yield prefix + "["
+    first = True
+    async for item in items:
+        yield ("" if first else ",") + json.dumps(item, cls=JSONEncoder)
+        first = False
+    yield "]" + suffix
+
+
+async def astream_ndjson(items):
+    async for item in items:
+        yield json.dumps(item, cls=JSONEncoder) + "\n"
+
+
+def astreaming_response(items, output_format, prefix="", suffix=""):
+    if output_format == "ndjson":
+        return StreamingHttpResponse(astream_ndjson(items), content_type="application/x-ndjson")
+    return StreamingHttpResponse(astream_json_array(items, prefix, suffix), content_type="application/json")
+
+
+async def aserialized(contacts, fields=None):
+    async for c in contacts:
+        yield serialize_fields(c, fields)
+
+
+# labels.py answers from its name cache or with one query, a single hop to a thread either way
+aresolve_labels = sync_to_async(labels.resolve)
+aget_or_create_label = sync_to_async(labels.get_or_create)
+
+
+async def arow_chunks(rows, limit=None, chunk_size=STREAM_CHUNK_SIZE):
+    # Keyset chunks, each its own bounded query in one sync_to_async hop. aiterator() wouldn't run in the
+    # event loop either, Django fetches every chunk of it through sync_to_async too, but it keeps its cursor
+    # open between the hops while the client reads
+    last_id = 0
+    left = limit
+    while left is None or left > 0:
+        size = chunk_size if left is None else min(chunk_size, left)
+        chunk = [row async for row in rows.filter(id__gt=last_id)[:size]]
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1][0]
+        if left is not None:
+            left -= len(chunk)
+
+
+async def afast_contact_list(rows, params):
+    """views.fast_contact_list"""
+    page_size = params["page_size"]
+    encode_row = serialization.row_encoder(params["fields"])
+    if params["stream"]:
+        chunks = arow_chunks(rows, params["limit"])
+        if params["output_format"] == "ndjson":
+            return StreamingHttpResponse(serialization.astream_lines(chunks, encode_row),
+                                         content_type="application/x-ndjson")
+        return StreamingHttpResponse(serialization.astream_array(chunks, encode_row), content_type="application/json")
+    if params["paged"]:
+        body = serialization.encode_page([row async for row in rows[:page_size + 1]], page_size,
+                                         lambda row: encode_cursor({"id": row[0]}), encode_row)
+        return HttpResponse(body, content_type="application/json")
+    return HttpResponse(serialization.encode_array([row async for row in rows], encode_row),
+                        content_type="application/json")
+
+
+@require_http_methods(["GET"])
+@label_queue.flushed
+@compressed_view
+@conditional_view
+@cached_view(cache.contact_list_scopes)
+@segments.reports_segment
+@read_only_view
+@admission.admitted(parse_list_params)
+async def contact_list(request):
+    params, error = parse_list_params(request)
+    if error:
+        return HttpResponseBadRequest(error)
+    label_names, exclude_names = params["label_names"], params["exclude_names"]
+    segment = await sync_to_async(segments.for_request)(params)
+    if segment is not None:
+        qs = segments.contacts(segment[0])
+        request.contactbook_segment = segment[1]
+    elif params["query"] is not None:
+        # planning reads the label counters, a few small queries in one hop
+        plan = await sync_to_async(query.plan)(params["query_text"], params["query"])
+        if params["explain"]:
+            return JsonResponse(await sync_to_async(plan.explain)())
+        qs = plan.queryset
+    elif label_names and label_index.is_enabled():
+        # the index is in memory and answers from python, that part stays sync
+        return await sync_to_async(views.label_index_response)(params)
+    else:
+        ids_by_name = await aresolve_labels(label_names + exclude_names) if label_names or exclude_names else {}
+        qs, error = filter_contacts(Contact.objects.all(), label_names, params["match_mode"], exclude_names,
+                                    ids_by_name=ids_by_name)
+        if error:
+            return HttpResponseBadRequest(error)
+    sort_key, cursor, limit = params["sort_key"], params["cursor"], params["limit"]
+    stream, paged, page_size = params["stream"], params["paged"], params["page_size"]
+    if cursor:
+        qs = qs.filter(**{sort_key + "__gt": cursor[sort_key]})
+
+    if params["emails_only"]:
+        emails = qs.values_list("email", flat=True).distinct()
+        if paged or stream:
+            emails = emails.order_by("email")
+        if stream:
+            emails = emails[:limit] if limit else emails
+            return astreaming_response(emails.aiterator(chunk_size=STREAM_CHUNK_SIZE), params["output_format"],
+                                       prefix='{"emails":', suffix="}")
+        if paged:
+            page = [email async for email in emails[:page_size + 1]]
+            return JsonResponse(page_envelope("emails", page, page_size, lambda e: {"email": e}))
+        return JsonResponse({"emails": [email async for email in emails]})
+
+    fields = params["fields"]
+    if serialization.is_supported():
+        return await afast_contact_list(serialization.contact_rows(qs.order_by("id"), fields), params)
+
+    qs = project(qs, fields).order_by("id")
+    if stream:
+        qs = qs[:limit] if limit else qs
+        contacts = aserialized(qs.aiterator(chunk_size=STREAM_CHUNK_SIZE), fields)
+        return astreaming_response(contacts, params["output_format"])
+    if paged:
+        return JsonResponse(contact_page([c async for c in qs[:page_size + 1]], page_size, fields))
+    return JsonResponse([serialize_fields(c, fields) async for c in qs], safe=False)
+
+
+@require_http_methods(["GET"])
+@label_queue.flushed
+@compressed_view
+@conditional_view
+@cached_view(cache.label_list_scopes)
+@read_only_view
+async def label_list(request):
+    labels = [a_label async for a_label in views.label_list_values(request)]
+    return JsonResponse(views.label_list_entries(request, labels), safe=False)
+
+
+@require_http_methods(["POST"])
+async def contact_create(request):
+    data = parse_body(request)
+    name = data.get("name", None)
+    email = data.get("email", None)
+    phone = data.get("phone", None)
+
+    if not name or not email or not phone:
+        return HttpResponseBadRequest("name, phone and email are required")
+
+    contact = await Contact.objects.acreate(name=name, email=email, phone=phone)
+    return JsonResponse({"id": contact.id, "name": contact.name, "email": contact.email, "phone": contact.phone})
+
+
+@require_http_methods(["POST"])
+async def label_create(request):
+    data = parse_body(request)
+    name = data.get("name", None)
+    if not isinstance(name, str) or not name.strip():
+        return HttpResponseBadRequest("name is required")
+
+    a_label, created = await aget_or_create_label(name)
+    return JsonResponse({"id": a_label.id, "name": a_label.name, "created": created})
+
+
+async def contact_labels_response(contact):
+    return JsonResponse({
+        "contact_id": contact.id,
+        "labels": [a_label.name async for a_label in contact.labels.all()],
+    })
+
+
+@require_http_methods(["POST"])
+async def add_label(request):
+    data = parse_body(request)
+    contact_id = data.get("contact_id")
+    label_names = name_list(data.get("labels", []))
+
+    if not contact_id or not label_names:
+        return HttpResponseBadRequest("contact_id and labels are required")
+    if label_queue.is_enabled():
+        return await sync_to_async(views.enqueue_labels)(LabelMutation.ADD, contact_id, label_names)
+
+    try:
+        contact = await Contact.objects.aget(id=contact_id)
+    except Contact.DoesNotExist:
+        return HttpResponseBadRequest("contact with id" + str(contact_id) + "not found")
+
+    label_ids = await aresolve_labels(label_names, create=True)
+    await contact.labels.aadd(*label_ids.values())
+    return await contact_labels_response(contact)
+
+
+@require_http_methods(["POST"])
+async def remove_label(request):
+    data = parse_body(request)
+    contact_id = data.get("contact_id")
+    label_names = name_list(data.get("labels", []))
+
+    if not contact_id or not label_names:
+        return HttpResponseBadRequest("contact_id and labels are required")
+    if label_queue.is_enabled():
+        return await sync_to_async(views.enqueue_labels)(LabelMutation.REMOVE, contact_id, label_names)
+
+    try:
+        contact = await Contact.objects.aget(id=contact_id)
+    except Contact.DoesNotExist:
+        return HttpResponseBadRequest("contact not found")
+
+    await contact.labels.aremove(*(await aresolve_labels(label_names)).values())
+    return await contact_labels_response(contact)
+
+
+@require_http_methods(["GET"])
+async def contact_del(request):
+    return await sync_to_async(views.delete_object)(request, Contact, "contact")
+
+
+@require_http_methods(["GET"])
+async def label_del(request):
+    return await sync_to_async(views.delete_object)(request, Label, "label")
+
+
+@require_http_methods(["GET"])
+@label_queue.flushed
+@compressed_view
+async def changes_since(request):
+    # a long poll only holds a coroutine here, not a worker thread
+    params, error = parse_changes_params(request)
+    if error:
+        return HttpResponseBadRequest(error)
+    response = await sync_to_async(views.start_of_changes)(params)
+    if response is not None:
+        return response
+
+    deadline = time.monotonic() + params["wait"]
+    while True:
+        generation = changes.notifier.generation
+        page = await sync_to_async(views.change_page)(params["since"], params["limit"])
+        remaining = deadline - time.monotonic()
+        if page["changes"] or remaining <= 0:
+            return JsonResponse(page)
+        await changes.notifier.async_wait(generation, min(remaining, changes.get_config()["POLL_INTERVAL"]))
@@ -0,0 +1,188 @@
+"""
+Helpers shared by the benchmark management commands: a throwaway database, synthetic data and timing
+requests against the URLs.
+"""
+import json
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.db import connections
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from . import label_stats
+from .models import Contact, Label
+
+BATCH_SIZE = 5000
+FIRST_NAMES = ["Anna", "Bram", "Chloe", "Daan", "Emma", "Finn", "Hiro", "Iris", "Jan", "Lotte", "Milan", "Noor",
+               "Olivia", "Rutger", "Sanne", "Sem", "Tess", "Vera", "Yara", "Zoe"]
+LAST_NAMES = ["Bakker", "de Boer", "Dekker", "van Dijk", "Hendriks", "Jansen", "de Jong", "Meijer", "Mulder",
+              "Peters", "de Vries", "Visser", "Smit", "van den Berg", "Bos", "Vos", "Tanaka", "Hauer"]
+DOMAINS = ["smart.pr", "nu.nl", "bol.com", "example.com", "gmail.com", "outlook.com"]
+
+
+def fake_contact(rng, i):
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    handle = f"{first}.{last}".lower().replace(" ", "")
+    return Contact(
+        name=f"{first} {last}",
+        email=f"{handle}{i}@{rng.choice(DOMAINS)}",
+        phone=f"+31 6 {rng.randrange(10 ** 8):08d}",
+    )
+
+
+@contextmanager
+def temporary_database(alias="default"):
+    """Runs the block against a freshly migrated test database, so benchmarks never touch real data."""
+    connection = connections[alias]
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def generate_contacts(n_contacts, n_labels, labels_per_contact=3, skew=1.0, seed=42):
+    """
+    Creates n_contacts contacts and n_labels labels ("label_0", "label_1", ...). Every contact gets up to
+    labels_per_contact labels, drawn with zipf-like weights 1 / (rank + 1) ** skew, so label_0 is the most
+    common one. skew=0 spreads them evenly.
+    """
+    rng = random.Random(seed)
+    Label.objects.bulk_create([Label(name=f"label_{i}") for i in range(n_labels)], batch_size=BATCH_SIZE)
+    label_ids = list(Label.objects.order_by("id").values_list("id", flat=True))
+    weights = [1 / (rank + 1) ** skew for rank in range(n_labels)]
+    through = Contact.labels.through
+
+    for start in range(0, n_contacts, BATCH_SIZE):
+        size = min(BATCH_SIZE, n_contacts - start)
+        contacts = Contact.objects.bulk_create([fake_contact(rng, i) for i in range(start, start + size)])
+        links = []
+        for contact in contacts:
+            picked = set(rng.choices(label_ids, weights=weights, k=labels_per_contact))
+            links.extend(through(contact_id=contact.id, label_id=label_id) for label_id in picked)
+        through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+    # the links went around memberships_changed, count them once at the end
+    label_stats.rebuild()
+
+
+def time_call(func, repeat=5):
+    """Returns (best time in seconds, result of the last call)."""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+class Scenario:
+    """
+    One kind of request against one URL (by name). query and body are either fixed or a function of the
+    request number, for requests which can't be repeated as they are (deleting the same contact twice).
+    setup(count) runs right before the first request, for data only this scenario should see, count is how
+    many requests follow.
+    """
+
+    def __init__(self, name, url_name, method="GET", query="", body=None, content_type="application/json",
+                 setup=None):
+        self.name = name
+        self.url_name = url_name
+        self.method = method
+        self.query = query
+        self.body = body
+        self.content_type = content_type
+        self.setup = setup
+
+    def send(self, client, n):
+        query = self.query(n) if callable(self.query) else self.query
+        path = reverse(self.url_name) + ("?" + query if query else "")
+        if self.method == "GET":
+            response = client.get(path)
+        else:
+            body = self.body(n) if callable(self.body) else self.body
+            if not isinstance(body, (str, bytes)):
+                body = json.dumps(body)
+            response = client.post(path, data=body, content_type=self.content_type)
+        # a streaming body is only produced while it is read
+        content = b"".join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, len(content)
+
+
+def percentile(sorted_values, pct):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_scenario(client, scenario, requests, warmup=1):
+    """
+    Latencies come from plain requests, queries and peak memory from one extra request with
+    tracemalloc on (it slows everything down, so it's never part of the timing).
+    """
+    if scenario.setup is not None:
+        scenario.setup(warmup + requests + 1)
+    n = 0
+    for _ in range(warmup):
+        scenario.send(client, n)
+        n += 1
+
+    latencies = []
+    statuses = set()
+    response_bytes = 0
+    for _ in range(requests):
+        started = time.perf_counter()
+        status, response_bytes = scenario.send(client, n)
+        latencies.append((time.perf_counter() - started) * 1000)
+        statuses.add(status)
+        n += 1
+
+    connection = connections["default"]
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as ctx:
+            scenario.send(client, n)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "url": scenario.url_name,
+        "requests": requests,
+        "status": sorted(statuses),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "mean_ms": round(sum(latencies) / len(latencies), 3),
+        "queries": len(ctx.captured_queries),
+        "peak_memory_kb": round(peak / 1024, 1),
+        "response_bytes": response_bytes,
+    }
+
+
+def compare_to_baseline(results, baseline, max_regression_pct):
+    """Returns a line per scenario and the list of scenarios which got slower than allowed (or more queries)."""
+    lines = []
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            lines.append(f"{name}: new")
+            continue
+        change = (result["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 if before["p95_ms"] else 0
+        lines.append(
+            f"{name}: p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f}ms ({change:+.0f}%), "
+            f"queries {before['queries']} -> {result['queries']}"
+        )
+        if change > max_regression_pct or result["queries"] > before["queries"]:
+            regressions.append(name)
+    return lines, regressions
+
@@ -0,0 +1,187 @@
+"""
+Tenancy: every contact, label, change event and export belongs to a Book, one customer's address book.
+
+BookMiddleware picks the book of a request from the X-Contactbook-Book header (its slug, the default book
+without one) and keeps it in a context variable for the whole request, streamed bodies included. The
+managers of the models (models.BookManager) filter on it, so every queryset a view builds only sees that
+book. Commands and workers choose one with use_book(), or see all books without.
+
+BookRouter sends the rows of the books listed in CONTACTBOOK_BOOK_DATABASES to a database of their own, a
+big customer then doesn't slow down everybody else's queries and writes. The books themselves and the
+export jobs stay on default. Code that opens a transaction or a cursor itself uses db(), the database of
+the current book.
+"""
+import threading
+from contextlib import contextmanager, nullcontext
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponseNotFound
+
+from .models import DEFAULT_BOOK_ID, Book, _current_book
+
+HEADER = "X-Contactbook-Book"
+# the models whose rows are placed with their book, the through table of Contact.labels included
+PLACED_MODELS = {"contactbook.contact", "contactbook.label", "contactbook.contact_labels", "contactbook.labelstat",
+                 "contactbook.labelpairstat", "contactbook.changeevent", "contactbook.segment",
+                 "contactbook.segmentmember"}
+
+_books = {}  # slug -> Book, there are few and they hardly change
+_books_lock = threading.Lock()
+
+
+def current_book():
+    return _current_book.get()
+
+
+def database_of(book):
+    """The alias holding the rows of book, CONTACTBOOK_BOOK_DATABASES maps slugs to aliases"""
+    if book is None:
+        return DEFAULT_DB_ALIAS
+    return getattr(settings, "CONTACTBOOK_BOOK_DATABASES", {}).get(book.slug, DEFAULT_DB_ALIAS)
+
+
+def db():
+    """The alias of the current book, for transaction.atomic(using=...), on_commit and raw cursors"""
+    return database_of(current_book())
+
+
+def cached_book(slug):
+    with _books_lock:
+        return _books.get(slug or "")
+
+
+def get_book(slug=None):
+    """The book with slug (the default one for None), None if there is no such book"""
+    book = cached_book(slug)
+    if book is not None:
+        return book
+    books = Book.objects.using(DEFAULT_DB_ALIAS)
+    book = books.filter(slug=slug).first() if slug else books.filter(id=DEFAULT_BOOK_ID).first()
+    if book is not None:
+        with _books_lock:
+            _books[slug or ""] = book
+    return book
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def forget_books(sender, **kwargs):
+    with _books_lock:
+        _books.clear()
+
+
+@contextmanager
+def use_book(book):
+    """Runs the block in book (a Book, an id or a slug), as if it was a request to it"""
+    if not isinstance(book, Book):
+        lookup = {"id": book} if isinstance(book, int) else {"slug": book}
+        book = Book.objects.using(DEFAULT_DB_ALIAS).get(**lookup)
+    token = _current_book.set(book)
+    try:
+        yield book
+    finally:
+        _current_book.reset(token)
+
+
+def book_option(slug):
+    """use_book(slug), or all the books of default for None: the --book of the management commands"""
+    return use_book(slug) if slug else nullcontext()
+
+
+def within(book, content):
+    # a streamed body runs its queries after the middleware returned, each step gets the book again
+    content = iter(content)
+    while True:
+        token = _current_book.set(book)
+        try:
+            chunk = next(content)
+        except StopIteration:
+            return
+        finally:
+            _current_book.reset(token)
+        yield chunk
+
+
+async def awithin(book, content):
+    content = aiter(content)
+    while True:
+        token = _current_book.set(book)
+        try:
+            chunk = await anext(content)
+        except StopAsyncIteration:
+            return
+        finally:
+            _current_book.reset(token)
+        yield chunk
+
+
+class BookMiddleware:
+    """Sets the book of the request, a 404 for a slug that doesn't exist. Sync and async."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        book = get_book(request.headers.get(HEADER))
+        if book is None:
+            return HttpResponseNotFound("unknown book")
+        token = _current_book.set(book)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_book.reset(token)
+        return self.keep_book(response, book)
+
+    async def __acall__(self, request):
+        slug = request.headers.get(HEADER)
+        book = cached_book(slug) or await sync_to_async(get_book)(slug)
+        if book is None:
+            return HttpResponseNotFound("unknown book")
+        token = _current_book.set(book)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_book.reset(token)
+        return self.keep_book(response, book)
+
+    def keep_book(self, response, book):
+        if response.streaming:
+            content = response.streaming_content
+            response.streaming_content = awithin(book, content) if response.is_async else within(book, content)
+        return response
+
+
+class BookRouter:
+    """
+    The rows of a book go to database_of(book), everything else is left to the next router. Put it in
+    front of the ReadReplicaRouter: a book with a database of its own has no replicas.
+    """
+
+    def db_for(self, model):
+        if model._meta.label_lower not in PLACED_MODELS:
+            return None
+        alias = db()
+        return None if alias == DEFAULT_DB_ALIAS else alias
+
+    def db_for_read(self, model, **hints):
+        return self.db_for(model)
+
+    def db_for_write(self, model, **hints):
+        return self.db_for(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        return None  # every database gets the whole schema, migrate --database <alias> for a new one
@@ -0,0 +1,378 @@
+"""
+Result cache for the list endpoints.
+
+A cache key is the normalized query plus the current version of every "scope" the answer depends on:
+
+- "contacts": any contact or membership changed, for unfiltered listings
+- "label:<name>": the members of that label (or one of their other labels) changed
+- "labels": a label was created or deleted, for label_list
+- "all": bumped when a label is deleted or restored, since that touches the label list of many contacts
+
+Scopes are per book (books.py), a write to one book leaves the entries of the others alone.
+
+Writes only bump the versions, old entries are never looked up again and age out of the LRU / timeout.
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+
+from . import books, query
+from .models import Contact, Label, current_book_id
+from .signals import memberships_changed, contacts_created, labels_created, visibility_changed
+
+DEFAULTS = {
+    "BACKEND": "locmem",  # "locmem", "django" or None to turn the cache off
+    "MAX_ENTRIES": 1000,  # locmem only
+    "MAX_ENTRY_BYTES": 1024 * 1024,  # bigger responses are not worth keeping around
+    "ALIAS": "default",  # django only, which of settings.CACHES
+    "TIMEOUT": 300,  # django only
+}
+# query parameters whose comma separated label names can come in any order
+LIST_PARAMS = ("labels", "exclude")
+UNORDERED_PARAMS = LIST_PARAMS + ("fields",)  # fields= can too
+# set by the views below the cache, kept with the entry so a hit answers the same
+CACHED_HEADERS = ("X-Contactbook-Segment",)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "CONTACTBOOK_CACHE", {})}
+
+
+class LocMemBackend:
+    """LRU in the memory of this process, the versions live here too."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def versions(self, scopes):
+        with self._lock:
+            return [self._versions.get(scope, 0) for scope in scopes]
+
+    def bump(self, scopes):
+        with self._lock:
+            for scope in scopes:
+                self._versions[scope] = self._versions.get(scope, 0) + 1
+
+    def size(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+class DjangoCacheBackend:
+    """Any of settings.CACHES, so the entries and versions can be shared between processes."""
+
+    evictions = None  # django's cache doesn't tell
+
+    def __init__(self, alias, timeout):
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get("contactbook:entry:" + key)
+
+    def set(self, key, value):
+        self.cache.set("contactbook:entry:" + key, value, self.timeout)
+
+    def versions(self, scopes):
+        keys = ["contactbook:version:" + scope for scope in scopes]
+        found = self.cache.get_many(keys)
+        return [found.get(key, 0) for key in keys]
+
+    def bump(self, scopes):
+        for scope in scopes:
+            key = "contactbook:version:" + scope
+            self.cache.add(key, 0, None)
+            try:
+                self.cache.incr(key)
+            except ValueError:  # evicted between add and incr
+                self.cache.set(key, 1, None)
+
+    def size(self):
+        return None
+
+    def clear(self):
+        self.cache.clear()
+
+
+def in_book(book_id, scopes):
+    return [f"{book_id}:{scope}" for scope in scopes]
+
+
+class ResultCache:
+    def __init__(self, backend, max_entry_bytes):
+        self.backend = backend
+        self.max_entry_bytes = max_entry_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, path, params, scopes):
+        book_id = current_book_id()
+        versions = self.backend.versions(in_book(book_id, ["all"] + scopes))
+        raw = json.dumps([book_id, path, params, scopes, versions], separators=(",", ":"))
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def bump(self, scopes):
+        scopes = list(scopes)
+        if scopes:
+            self.backend.bump(in_book(current_book_id(), scopes))
+
+    def clear(self):
+        self.backend.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "entries": self.backend.size(),
+        }
+
+
+_result_cache = None
+_result_cache_config = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """The cache for the current settings, None if it's turned off."""
+    global _result_cache, _result_cache_config
+    config = get_config()
+    if not config["BACKEND"]:
+        return None
+    with _result_cache_lock:
+        if config != _result_cache_config:
+            if config["BACKEND"] == "django":
+                backend = DjangoCacheBackend(config["ALIAS"], config["TIMEOUT"])
+            else:
+                backend = LocMemBackend(config["MAX_ENTRIES"])
+            _result_cache = ResultCache(backend, config["MAX_ENTRY_BYTES"])
+            _result_cache_config = config
+        return _result_cache
+
+
+def normalized_params(query_dict):
+    params = {}
+    for key in sorted(query_dict):
+        value = query_dict.get(key, "").strip()
+        if key in UNORDERED_PARAMS:
+            value = ",".join(sorted({n.strip() for n in value.split(",") if n.strip()}))
+        elif key == "match":
+            value = value.lower()
+        params[key] = value
+    params.setdefault("match", "or")  # contact_list's default
+    return params
+
+
+def lookup(result_cache, request, scopes):
+    """Returns (key, cached response or None)."""
+    # the key is made before the view runs: a write during the view bumps past it
+    key = result_cache.make_key(request.path, normalized_params(request.GET), scopes)
+    cached = result_cache.get(key)
+    if cached is None:
+        return key, None
+    content, content_type, headers = cached
+    response = HttpResponse(content, content_type=content_type, headers=headers)
+    response["X-Contactbook-Cache"] = "hit"
+    return key, response
+
+
+def store(result_cache, key, response):
+    if (response.status_code == 200 and not response.streaming
+            and len(response.content) <= result_cache.max_entry_bytes):
+        headers = {name: response[name] for name in CACHED_HEADERS if response.has_header(name)}
+        result_cache.set(key, (response.content, response["Content-Type"], headers))
+    response["X-Contactbook-Cache"] = "miss"
+    return response
+
+
+def cached_view(scopes_of):
+    """
+    Caches the successful responses of a GET view. scopes_of(request) returns the scopes the answer
+    depends on, or None when the request shouldn't be cached at all. Works for async views too.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                result_cache = get_result_cache()
+                scopes = scopes_of(request) if result_cache and request.method == "GET" else None
+                if scopes is None:
+                    return await view(request, *args, **kwargs)
+                # the in-process LRU never blocks, any other backend is I/O and goes to a thread
+                in_loop = isinstance(result_cache.backend, LocMemBackend)
+                if in_loop:
+                    key, cached = lookup(result_cache, request, scopes)
+                else:
+                    key, cached = await sync_to_async(lookup)(result_cache, request, scopes)
+                if cached is not None:
+                    return cached
+                response = await view(request, *args, **kwargs)
+                if in_loop:
+                    return store(result_cache, key, response)
+                return await sync_to_async(store)(result_cache, key, response)
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            result_cache = get_result_cache()
+            scopes = scopes_of(request) if result_cache and request.method == "GET" else None
+            if scopes is None:
+                return view(request, *args, **kwargs)
+            key, cached = lookup(result_cache, request, scopes)
+            if cached is not None:
+                return cached
+            return store(result_cache, key, view(request, *args, **kwargs))
+        return wrapper
+    return decorator
+
+
+def contact_list_scopes(request):
+    if request.GET.get("stream", "").lower() in ("1", "true", "yes"):
+        return None
+    names = set()
+    scopes = []
+    for key in LIST_PARAMS:
+        given = {n.strip() for n in request.GET.get(key, "").split(",") if n.strip()}
+        if key == "exclude" and given:
+            scopes.append("contacts")  # exclude=x is a NOT x, see below
+        names |= given
+    if request.GET.get("q", "").strip():
+        try:
+            label_query = query.parse(request.GET["q"].strip())
+        except query.QueryError:
+            return None  # answered with a 400, which isn't cached anyway
+        names |= query.label_names(label_query)
+        if query.has_not(label_query) and "contacts" not in scopes:
+            scopes.append("contacts")  # NOT x also matches contacts without any label
+    if not names:
+        return ["contacts"]
+    return scopes + ["label:" + name for name in sorted(names)]
+
+
+def label_list_scopes(request):
+    if request.GET.get("with_counts", "").lower() in ("1", "true", "yes"):
+        return ["labels", "contacts"]  # the counts move with every membership
+    return ["labels"]
+
+
+def bump(scopes):
+    """Bumps now and once more on commit, so nobody caches what was read in between under the new version."""
+    result_cache = get_result_cache()
+    if result_cache is None:
+        return
+    scopes = list(scopes)
+    result_cache.bump(scopes)
+    transaction.on_commit(lambda: result_cache.bump(scopes), using=books.db(), robust=True)
+
+
+def label_scopes_of_contacts(contact_ids, chunk_size=500):
+    # a filtered listing also shows the other labels of its contacts, those lists are affected as well
+    contact_ids = list(contact_ids)
+    names = set()
+    for start in range(0, len(contact_ids), chunk_size):
+        chunk = contact_ids[start:start + chunk_size]
+        names.update(Label.objects.filter(contacts__id__in=chunk).values_list("name", flat=True))
+    return {"label:" + name for name in names}
+
+
+@receiver(memberships_changed)
+def bump_on_memberships_changed(sender, action, pairs, **kwargs):
+    if get_result_cache() is None:
+        return
+    label_ids = {label_id for _, label_id in pairs}
+    scopes = {"label:" + name for name in Label.objects.filter(id__in=label_ids).values_list("name", flat=True)}
+    scopes |= label_scopes_of_contacts({contact_id for contact_id, _ in pairs})
+    bump(scopes | {"contacts"})
+
+
+@receiver(contacts_created)
+def bump_on_contacts_created(sender, contact_ids, **kwargs):
+    bump(["contacts"])
+
+
+@receiver(labels_created)
+def bump_on_labels_created(sender, label_ids, **kwargs):
+    bump(["labels"])  # nobody carries them yet, the listings by label stay valid
+
+
+@receiver(post_save, sender=Contact)
+def bump_on_contact_saved(sender, instance, created, **kwargs):
+    if get_result_cache() is None:
+        return
+    scopes = {"contacts"}
+    if not created:
+        scopes |= label_scopes_of_contacts([instance.pk])
+    bump(scopes)
+
+
+@receiver(post_delete, sender=Contact)
+def bump_on_contact_deleted(sender, instance, **kwargs):
+    # its memberships are bumped through memberships_changed, a purged contact was invisible already
+    if not instance.is_deleted:
+        bump(["contacts"])
+
+
+@receiver(visibility_changed)
+def bump_on_visibility_changed(sender, ids, **kwargs):
+    if sender is Label:
+        names = Label.all_objects.filter(id__in=ids).values_list("name", flat=True)
+        bump(["labels", "all"] + ["label:" + name for name in names])
+    else:
+        bump(["contacts"])
+
+
+@receiver(post_save, sender=Label)
+@receiver(post_delete, sender=Label)
+def bump_on_label_changed(sender, instance, **kwargs):
+    if instance.is_deleted:
+        return  # hidden already, see bump_on_visibility_changed
+    scopes = ["labels", "label:" + instance.name]
+    if not kwargs.get("created"):
+        scopes.append("all")  # changed or deleted, it shows up in the label list of its contacts
+    bump(scopes)
@@ -0,0 +1,197 @@
+"""
+Change log for incremental sync: every write appends what it changed to ChangeEvent, inside the writing
+transaction, and changes?since=<seq> hands a client the events after the last one it has seen instead of
+the whole book.
+
+The events follow the signals every write path sends already (contacts_created, memberships_changed,
+visibility_changed...), so contact/create, add_label, remove_label, batch_label, the importer and the
+deletes are all covered. A deleted contact is one contact_deleted, the label_removed events of its
+memberships are left out.
+
+Sequence numbers are handed out in commit order because SQLite has one writer at a time (IMMEDIATE
+transactions). With concurrent writers a later seq could commit first and a client could skip the
+earlier one. They are shared by the books of a database, the log of one book has gaps.
+
+The long poll of changes?wait= sleeps on the notifier, which wakes it when a transaction of this process
+commits events. Writes by other processes are seen every POLL_INTERVAL seconds.
+"""
+import asyncio
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import books
+from .memberships import chunked
+from .models import Book, ChangeEvent, Contact, Label, current_book_id
+from .signals import contacts_created, labels_created, memberships_changed, visibility_changed
+
+DEFAULTS = {
+    "PAGE_SIZE": 1000,  # events per answer, also the highest limit=
+    "MAX_WAIT": 30,  # seconds a long poll may wait
+    "POLL_INTERVAL": 1,  # seconds, how often a long poll looks for the writes of other processes
+    "RETENTION_DAYS": 30,  # trim_changes removes older events
+}
+BULK_SIZE = 500  # events per INSERT
+TRIM_BATCH_SIZE = 5000
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "CONTACTBOOK_CHANGES", {})}
+
+
+class Notifier:
+    """Wakes the long polls (threads and coroutines) of this process up when events were committed"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._waiters = []  # (loop, asyncio.Event) of the async long polls
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+            waiters, self._waiters = self._waiters, []
+        for loop, event in waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # its loop is closed
+                pass
+
+    def wait(self, generation, timeout):
+        """Blocks until notify() was called since generation was read, or timeout. Returns whether it was."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._generation != generation, timeout)
+
+    async def async_wait(self, generation, timeout):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            if self._generation != generation:
+                return True
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._condition:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+
+notifier = Notifier()
+
+
+def append(events):
+    """Writes (action, contact_id, label_id) events to the log, in the current transaction"""
+    events = list(events)
+    if not events:
+        return
+    for chunk in chunked(events, BULK_SIZE):
+        ChangeEvent.objects.bulk_create([ChangeEvent(action=action, contact_id=contact_id, label_id=label_id)
+                                         for action, contact_id, label_id in chunk])
+    transaction.on_commit(notifier.notify, using=books.db(), robust=True)
+
+
+def head():
+    """The seq of the newest event, 0 for an empty log"""
+    return ChangeEvent.objects.aggregate(seq=Max("id"))["seq"] or 0
+
+
+def is_trimmed(since):
+    # the seqs of a book have gaps, trim() remembers the newest one it deleted
+    trimmed_seq = Book.objects.using(DEFAULT_DB_ALIAS).filter(id=current_book_id()).values_list("trimmed_seq")
+    return since < (trimmed_seq.first() or (0,))[0]
+
+
+def read(since, limit):
+    """(events, more): up to limit (seq, action, contact_id, label_id) tuples after since"""
+    events = list(ChangeEvent.objects.filter(id__gt=since).order_by("id")
+                  .values_list("id", "action", "contact_id", "label_id")[:limit + 1])
+    return events[:limit], len(events) > limit
+
+
+def trim(older_than=None, batch_size=TRIM_BATCH_SIZE):
+    """Deletes the events older than older_than (RETENTION_DAYS), batch by batch. Returns how many."""
+    if older_than is None:
+        older_than = timedelta(days=get_config()["RETENTION_DAYS"])
+    cutoff = timezone.now() - older_than
+    trimmed = 0
+    while True:
+        rows = list(ChangeEvent.objects.filter(created_date__lt=cutoff).order_by("id")
+                    .values_list("id", "book_id")[:batch_size])
+        if not rows:
+            return trimmed
+        newest = dict((book_id, seq) for seq, book_id in rows)  # ordered by id, the last one wins
+        trimmed += ChangeEvent.objects.filter(id__in=[seq for seq, _ in rows]).delete()[0]
+        for book_id, seq in newest.items():
+            Book.objects.using(DEFAULT_DB_ALIAS).filter(id=book_id, trimmed_seq__lt=seq).update(trimmed_seq=seq)
+
+
+@receiver(post_save, sender=Contact)
+def log_contact_saved(sender, instance, created, **kwargs):
+    if created:
+        append([(ChangeEvent.CONTACT_CREATED, instance.pk, None)])
+
+
+@receiver(contacts_created)
+def log_contacts_created(sender, contact_ids, **kwargs):
+    append((ChangeEvent.CONTACT_CREATED, contact_id, None) for contact_id in contact_ids)
+
+
+@receiver(post_save, sender=Label)
+def log_label_saved(sender, instance, created, **kwargs):
+    if created:
+        append([(ChangeEvent.LABEL_CREATED, None, instance.pk)])
+
+
+@receiver(labels_created)
+def log_labels_created(sender, label_ids, **kwargs):
+    append((ChangeEvent.LABEL_CREATED, None, label_id) for label_id in label_ids)
+
+
+@receiver(memberships_changed)
+def log_memberships_changed(sender, action, pairs, **kwargs):
+    if action == "add":
+        append((ChangeEvent.LABEL_ADDED, contact_id, label_id) for contact_id, label_id in pairs)
+        return
+    # a soft deleted contact is marked before its memberships are reported, contact_deleted says it all
+    deleted = set()
+    for chunk in chunked(sorted({contact_id for contact_id, _ in pairs})):
+        deleted.update(Contact.all_objects.filter(id__in=chunk, is_deleted=True).values_list("id", flat=True))
+    append((ChangeEvent.LABEL_REMOVED, contact_id, label_id) for contact_id, label_id in pairs
+           if contact_id not in deleted)
+
+
+@receiver(visibility_changed)
+def log_visibility_changed(sender, ids, visible, **kwargs):
+    if sender is Contact:
+        action = ChangeEvent.CONTACT_RESTORED if visible else ChangeEvent.CONTACT_DELETED
+        append((action, contact_id, None) for contact_id in ids)
+    elif sender is Label:
+        action = ChangeEvent.LABEL_RESTORED if visible else ChangeEvent.LABEL_DELETED
+        append((action, None, label_id) for label_id in ids)
+
+
+@receiver(post_delete, sender=Contact)
+def log_contact_deleted(sender, instance, **kwargs):
+    # purging a soft deleted contact changes nothing a client can see
+    if not instance.is_deleted:
+        append([(ChangeEvent.CONTACT_DELETED, instance.pk, None)])
+
+
+@receiver(post_delete, sender=Label)
+def log_label_deleted(sender, instance, **kwargs):
+    if not instance.is_deleted:
+        append([(ChangeEvent.LABEL_DELETED, None, instance.pk)])
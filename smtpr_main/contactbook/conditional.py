@@ -0,0 +1,216 @@
+"""
+Conditional GET and compression for the list endpoints.
+
+The validator of an answer is its path and normalized query plus the head of the change log (changes.py):
+every write that can change what a list shows appends an event, so an unchanged head means an unchanged
+answer. Every book (books.py) has a head of its own, one lookup at the end of the (book_id, id) index, so
+the ETag / Last-Modified are known before the view runs and If-None-Match / If-Modified-Since are answered
+with a 304 without fetching a single row. The head is read from the primary, a replica lagging behind must
+not confirm a stale copy.
+
+Bodies are compressed with brotli (when the brotli package is installed) or gzip, whichever the client
+prefers in Accept-Encoding, streams chunk by chunk. The ETag of a compressed answer gets a -br / -gzip
+suffix, all variants of one version validate each other.
+"""
+import gzip
+import hashlib
+import json
+import math
+import zlib
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.http import HttpResponseNotModified
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+from .cache import normalized_params
+from .models import ChangeEvent, current_book_id
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+MIN_COMPRESS_SIZE = 1024  # bytes, smaller bodies are sent as they are
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # 11 is the slowest, 4-6 is what servers use for dynamic content
+ENCODING_SUFFIXES = ("-br", "-gzip")
+
+
+def version():
+    """(seq, created_date) of the newest change log event of the current book, (0, None) for an empty log"""
+    head = ChangeEvent.objects.order_by("-id").values_list("id", "created_date").first()
+    return head or (0, None)
+
+
+def validators(request):
+    """(etag, last modified) of the answer to request, without the quotes and encoding suffix"""
+    seq, modified = version()
+    raw = json.dumps([current_book_id(), request.path, normalized_params(request.GET), seq], separators=(",", ":"))
+    return hashlib.sha1(raw.encode()).hexdigest()[:32], modified
+
+
+def strip_etag(etag):
+    # W/ from a proxy that compressed it, the suffix from us
+    etag = etag.removeprefix("W/").strip('"')
+    for suffix in ENCODING_SUFFIXES:
+        etag = etag.removesuffix(suffix)
+    return etag
+
+
+def not_modified(request, etag, modified):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        # it wins over If-Modified-Since
+        return any(tag == "*" or strip_etag(tag) == etag for tag in parse_etags(if_none_match))
+    since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+    return modified is not None and since is not None and modified.timestamp() <= since
+
+
+def last_modified_header(modified):
+    """
+    HTTP dates have whole seconds: the modification time rounded up, and only once that second is over,
+    otherwise a second write within the same second would look unmodified.
+    """
+    if modified is None:
+        return None
+    rounded = math.ceil(modified.timestamp())
+    return http_date(rounded) if rounded <= timezone.now().timestamp() else None
+
+
+def set_validators(response, etag, modified):
+    response["ETag"] = f'"{etag}"'
+    last_modified = last_modified_header(modified)
+    if last_modified:
+        response["Last-Modified"] = last_modified
+    response["Cache-Control"] = "no-cache"  # keep it, but ask us whether it's still current
+    return response
+
+
+def conditional_response(request, etag, modified):
+    """The 304 for request, or None when it has to be answered"""
+    if request.method != "GET" or not not_modified(request, etag, modified):
+        return None
+    return set_validators(HttpResponseNotModified(), etag, modified)
+
+
+def conditional_view(view):
+    """ETag / Last-Modified on the 200s of a GET list view, 304 when the client's copy is current"""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            etag, modified = await sync_to_async(validators)(request)
+            response = conditional_response(request, etag, modified)
+            if response is not None:
+                return response
+            response = await view(request, *args, **kwargs)
+            return set_validators(response, etag, modified) if response.status_code == 200 else response
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        etag, modified = validators(request)
+        response = conditional_response(request, etag, modified)
+        if response is not None:
+            return response
+        response = view(request, *args, **kwargs)
+        return set_validators(response, etag, modified) if response.status_code == 200 else response
+    return wrapper
+
+
+def negotiate(accept_encoding):
+    """"br", "gzip" or None, the one with the highest q the client accepts (br on a tie)"""
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    available = ["br", "gzip"] if brotli is not None else ["gzip"]
+    scored = [(weights.get(name, weights.get("*", 0.0)), -i, name) for i, name in enumerate(available)]
+    weight, _, best = max(scored)
+    return best if weight > 0 else None
+
+
+def compressor(encoding):
+    """(compress(chunk) -> bytes, finish() -> bytes), flushing after every chunk so a stream keeps flowing"""
+    if encoding == "br":
+        out = brotli.Compressor(quality=BROTLI_QUALITY)
+        return (lambda chunk: out.process(chunk) + out.flush()), out.finish
+    out = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # the gzip container
+    return (lambda chunk: out.compress(chunk) + out.flush(zlib.Z_SYNC_FLUSH)), out.flush
+
+
+def compress_bytes(content, encoding):
+    if encoding == "br":
+        return brotli.compress(content, quality=BROTLI_QUALITY)
+    return gzip.compress(content, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def as_bytes(chunk):
+    return chunk if isinstance(chunk, bytes) else str(chunk).encode()
+
+
+def compress_stream(content, encoding):
+    compress, finish = compressor(encoding)
+    for chunk in content:
+        data = compress(as_bytes(chunk))
+        if data:
+            yield data
+    yield finish()
+
+
+async def acompress_stream(content, encoding):
+    compress, finish = compressor(encoding)
+    async for chunk in content:
+        data = compress(as_bytes(chunk))
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(request, response):
+    patch_vary_headers(response, ("Accept-Encoding",))
+    if response.status_code != 200 or response.has_header("Content-Encoding"):
+        return response
+    encoding = negotiate(request.headers.get("Accept-Encoding", ""))
+    if encoding is None:
+        return response
+    if response.streaming:
+        content = response.streaming_content
+        response.streaming_content = (acompress_stream(content, encoding) if response.is_async
+                                      else compress_stream(content, encoding))
+        response.headers.pop("Content-Length", None)
+    else:
+        if len(response.content) < MIN_COMPRESS_SIZE:
+            return response
+        compressed = compress_bytes(response.content, encoding)
+        if len(compressed) >= len(response.content):
+            return response
+        response.content = compressed
+        response["Content-Length"] = str(len(compressed))
+    response["Content-Encoding"] = encoding
+    if response.has_header("ETag"):
+        response["ETag"] = response["ETag"].removesuffix('"') + f'-{encoding}"'
+    return response
+
+
+def compressed_view(view):
+    """Compresses the 200s of the view as negotiated with Accept-Encoding"""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            return compress_response(request, await view(request, *args, **kwargs))
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return compress_response(request, view(request, *args, **kwargs))
+    return wrapper
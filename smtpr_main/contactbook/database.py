@@ -0,0 +1,138 @@
+"""
+Database tuning: the SQLite PRAGMAs every new connection gets, and a router sending the queries of the
+read-only views to read replicas.
+
+WAL lets readers carry on while one writer commits, synchronous=NORMAL only syncs at checkpoints (still
+safe in WAL mode, a power cut may lose the last commits but never corrupts), mmap and a bigger page cache
+save read syscalls, and busy_timeout makes a writer wait for the lock instead of failing with "database is
+locked". Together with "transaction_mode": "IMMEDIATE" in DATABASES (a transaction takes the write lock up
+front, so two of them never deadlock upgrading a read lock, which no timeout helps against) and
+CONN_MAX_AGE that is the production setup, see settings.py.
+"""
+import random
+from contextvars import ContextVar
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+DEFAULTS = {
+    "ENABLED": True,
+    "JOURNAL_MODE": "wal",
+    "SYNCHRONOUS": "normal",
+    "BUSY_TIMEOUT_MS": 5000,
+    "CACHE_SIZE_KB": 64 * 1024,  # per connection
+    "MMAP_SIZE": 256 * 1024 * 1024,
+}
+
+_read_only = ContextVar("contactbook_read_only", default=False)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "CONTACTBOOK_SQLITE", {})}
+
+
+def pragmas(config):
+    return [
+        f"PRAGMA journal_mode = {config['JOURNAL_MODE']}",
+        f"PRAGMA synchronous = {config['SYNCHRONOUS']}",
+        f"PRAGMA busy_timeout = {int(config['BUSY_TIMEOUT_MS'])}",
+        f"PRAGMA cache_size = {-int(config['CACHE_SIZE_KB'])}",  # negative: in KiB instead of pages
+        f"PRAGMA mmap_size = {int(config['MMAP_SIZE'])}",
+    ]
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    config = get_config()
+    if connection.vendor != "sqlite" or not config["ENABLED"]:
+        return
+    with connection.cursor() as cursor:
+        for pragma in pragmas(config):
+            cursor.execute(pragma)
+
+
+def replicas():
+    return getattr(settings, "CONTACTBOOK_READ_REPLICAS", [])
+
+
+class ReadReplicaRouter:
+    """
+    Reads of the views marked with read_only_view go to one of CONTACTBOOK_READ_REPLICAS, everything else
+    stays on default. A replica lags behind a bit, which is why the writes and whatever they read (inside
+    a transaction, or the answers of the write views) never use one.
+    """
+
+    def db_for_read(self, model, **hints):
+        aliases = replicas()
+        if not aliases or not _read_only.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # the replicas hold the same rows
+
+    def allow_migrate(self, db, app_label, **hints):
+        return False if db in replicas() else None  # they get the schema from the primary
+
+
+def reading(content):
+    # a streamed body runs its queries after the view returned, each step is run as read only too
+    content = iter(content)
+    while True:
+        token = _read_only.set(True)
+        try:
+            chunk = next(content)
+        except StopIteration:
+            return
+        finally:
+            _read_only.reset(token)
+        yield chunk
+
+
+async def areading(content):
+    content = aiter(content)
+    while True:
+        token = _read_only.set(True)
+        try:
+            chunk = await anext(content)
+        except StopAsyncIteration:
+            return
+        finally:
+            _read_only.reset(token)
+        yield chunk
+
+
+def read_from_replicas(response):
+    if response.streaming:
+        content = response.streaming_content
+        response.streaming_content = areading(content) if response.is_async else reading(content)
+    return response
+
+
+def read_only_view(view):
+    """Lets the router send the queries of the view (sync or async) to a read replica."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            token = _read_only.set(True)
+            try:
+                return read_from_replicas(await view(request, *args, **kwargs))
+            finally:
+                _read_only.reset(token)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        token = _read_only.set(True)
+        try:
+            return read_from_replicas(view(request, *args, **kwargs))
+        finally:
+            _read_only.reset(token)
+    return wrapper
@@ -0,0 +1,195 @@
+"""
+Finding and merging duplicate contacts.
+
+Comparing every contact with every other one is quadratic, instead every contact gets a few normalized
+blocking keys and the contacts sharing a key are duplicates:
+
+- the email, stripped and lower-cased
+- the phone in E.164 form (+31612345678, COUNTRY_CODE for numbers without one) together with the name
+  tokens (lower-cased, accents dropped, sorted: "Smit, Jan" is "jan smit"). A phone alone isn't enough,
+  a household or an office shares one.
+
+One pass over the contacts of the book remembers the first contact of every key and joins the later ones
+to it (union-find), so a chain a~b~c ends up in one group however it's linked. The oldest contact of a
+group is kept: it gets the labels of the others (through memberships_changed, so the counters, caches and
+change log follow) and the others are soft deleted, CHUNK_SIZE contacts per transaction.
+"""
+import re
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from . import books, deletion
+from .models import Contact
+from .signals import send_memberships_changed
+
+DEFAULTS = {
+    "COUNTRY_CODE": None,  # e.g. "31", the country of phone numbers written without one
+    "CHUNK_SIZE": 500,  # contacts merged per transaction
+}
+SCAN_SIZE = 5000  # contacts read per query
+MIN_PHONE_DIGITS = 7  # shorter ones are extensions or junk, not a key
+SAMPLE_SIZE = 20  # groups shown in a report
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "CONTACTBOOK_DEDUPE", {})}
+
+
+def email_key(email):
+    email = (email or "").strip().lower()
+    return email if "@" in email else ""
+
+
+def phone_key(phone, country_code=None):
+    """+<digits> when the country is known, the bare digits otherwise, "" for no usable number"""
+    phone = (phone or "").strip()
+    digits = re.sub(r"\D", "", phone)
+    if len(digits) < MIN_PHONE_DIGITS:
+        return ""
+    if phone.startswith("+"):
+        return "+" + digits
+    if digits.startswith("00"):
+        return "+" + digits[2:]
+    if country_code and digits.startswith("0"):
+        return "+" + country_code + digits[1:]
+    return digits
+
+
+def name_key(name):
+    name = unicodedata.normalize("NFKD", name or "")
+    name = "".join(c for c in name if not unicodedata.combining(c)).lower()
+    return " ".join(sorted(re.findall(r"\w+", name)))
+
+
+def blocking_keys(name, email, phone, country_code=None):
+    keys = []
+    email = email_key(email)
+    if email:
+        keys.append(("email", email))
+    phone, name = phone_key(phone, country_code), name_key(name)
+    if phone and name:
+        keys.append(("phone_name", phone + "|" + name))
+    return keys
+
+
+class Groups:
+    """Union-find over contact ids, the root of a group is its lowest id"""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = x
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while x != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return False
+        low, high = min(a, b), max(a, b)
+        self.parent[high] = low
+        self.parent.setdefault(low, low)
+        return True
+
+    def groups(self):
+        """[[kept id, *duplicate ids]], by kept id"""
+        members = defaultdict(list)
+        for x in self.parent:
+            members[self.find(x)].append(x)
+        return [sorted(ids) for _, ids in sorted(members.items())]
+
+
+def find_duplicates(country_code=None):
+    """(groups, links by key kind) for the live contacts of the current book, in one pass"""
+    country_code = country_code or get_config()["COUNTRY_CODE"]
+    first = {}  # key -> the first contact id having it
+    groups = Groups()
+    links = defaultdict(int)
+    last_id = 0
+    qs = Contact.objects.order_by("id").values_list("id", "name", "email", "phone")
+    while True:
+        rows = list(qs.filter(id__gt=last_id)[:SCAN_SIZE])
+        if not rows:
+            break
+        for contact_id, name, email, phone in rows:
+            for key in blocking_keys(name, email, phone, country_code):
+                other = first.setdefault(key, contact_id)
+                if other != contact_id and groups.union(other, contact_id):
+                    links[key[0]] += 1
+        last_id = rows[-1][0]
+    return groups.groups(), dict(links)
+
+
+def merge_groups(groups):
+    """
+    Gives the first contact of every group the labels of the others and soft deletes those, in the
+    current transaction. Contacts deleted meanwhile are left out. Returns (merged, labels added).
+    """
+    ids = [contact_id for group in groups for contact_id in group]
+    live = set(Contact.objects.filter(id__in=ids).values_list("id", flat=True))
+    labels_of = defaultdict(set)
+    for contact_id, label_id in Contact.labels.through.objects.filter(contact_id__in=live).values_list(
+            "contact_id", "label_id"):
+        labels_of[contact_id].add(label_id)
+
+    new_pairs, duplicates = [], []
+    for group in groups:
+        alive = [contact_id for contact_id in group if contact_id in live]
+        if len(alive) < 2:
+            continue
+        keep, rest = alive[0], alive[1:]
+        missing = set().union(*(labels_of[contact_id] for contact_id in rest)) - labels_of[keep]
+        new_pairs.extend((keep, label_id) for label_id in sorted(missing))
+        duplicates.extend(rest)
+
+    through = Contact.labels.through
+    through.objects.bulk_create([through(contact_id=contact_id, label_id=label_id)
+                                 for contact_id, label_id in new_pairs], ignore_conflicts=True)
+    send_memberships_changed("add", new_pairs)
+    return deletion.soft_delete(Contact, duplicates), len(new_pairs)
+
+
+def group_chunks(groups, size):
+    # whole groups, about size contacts per chunk
+    chunk, contacts = [], 0
+    for group in groups:
+        if chunk and contacts + len(group) > size:
+            yield chunk
+            chunk, contacts = [], 0
+        chunk.append(group)
+        contacts += len(group)
+    if chunk:
+        yield chunk
+
+
+def dedupe(dry_run=True, chunk_size=None, country_code=None):
+    """
+    Finds the duplicates of the current book and, unless dry_run, merges them. Returns the report:
+    the number of groups and duplicates, the links per key kind and a sample of the groups.
+    """
+    chunk_size = chunk_size or get_config()["CHUNK_SIZE"]
+    groups, links = find_duplicates(country_code)
+    report = {
+        "groups": len(groups),
+        "duplicates": sum(len(group) - 1 for group in groups),
+        "links": links,
+        "sample": [{"keep": group[0], "merge": group[1:]} for group in groups[:SAMPLE_SIZE]],
+        "dry_run": dry_run,
+    }
+    if dry_run:
+        return report
+
+    report["merged"] = report["labels_added"] = 0
+    for chunk in group_chunks(groups, chunk_size):
+        with transaction.atomic(using=books.db()):
+            merged, labels_added = merge_groups(chunk)
+        report["merged"] += merged
+        report["labels_added"] += labels_added
+    return report
@@ -0,0 +1,100 @@
+"""
+Soft delete and the purge that removes soft deleted rows for real, in bounded batches.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import books
+from .models import Contact, Label
+from .signals import send_memberships_changed, visibility_changed
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def soft_delete(model, ids):
+    """Marks the rows as deleted, O(1) per row whatever hangs on them. Returns how many were deleted."""
+    with transaction.atomic(using=books.db()):
+        ids = list(model.objects.filter(id__in=ids).values_list("id", flat=True))
+        if not ids:
+            return 0
+        pairs = []
+        if model is Contact:
+            pairs = list(Contact.labels.through.objects.filter(contact_id__in=ids)
+                         .values_list("contact_id", "label_id"))
+        model.objects.filter(id__in=ids).update(is_deleted=True, deleted_date=timezone.now())
+        send_memberships_changed("remove", pairs)
+        visibility_changed.send(sender=model, ids=ids, visible=False)
+    return len(ids)
+
+
+def restore(model, ids):
+    """Brings soft deleted rows back, as long as they haven't been purged."""
+    with transaction.atomic(using=books.db()):
+        ids = list(model.all_objects.filter(id__in=ids, is_deleted=True).values_list("id", flat=True))
+        if not ids:
+            return 0
+        model.all_objects.filter(id__in=ids).update(is_deleted=False, deleted_date=None)
+        if model is Contact:
+            send_memberships_changed("add", Contact.labels.through.objects.filter(contact_id__in=ids)
+                                     .values_list("contact_id", "label_id"))
+        visibility_changed.send(sender=model, ids=ids, visible=True)
+    return len(ids)
+
+
+def purge_after():
+    return timedelta(hours=getattr(settings, "CONTACTBOOK_PURGE_AFTER_HOURS", 24))
+
+
+def purgeable(model, cutoff):
+    # rows deleted before deleted_date existed have none, they are old enough
+    return model.all_objects.filter(Q(deleted_date__lte=cutoff) | Q(deleted_date__isnull=True), is_deleted=True)
+
+
+def purge_deleted(batch_size=DEFAULT_BATCH_SIZE, older_than=None, max_batches=None, pause=0):
+    """
+    Hard deletes what was soft deleted more than older_than ago. Every batch touches at most batch_size
+    rows in its own transaction, so the database is never locked for long, pause (seconds) lets other
+    writers in between. Stops after max_batches batches when given. Returns the counts.
+    """
+    cutoff = timezone.now() - (purge_after() if older_than is None else older_than)
+    through = Contact.labels.through
+    counts = {"contacts": 0, "labels": 0, "links": 0, "batches": 0}
+
+    def next_batch():
+        if max_batches is not None and counts["batches"] >= max_batches:
+            return False
+        if counts["batches"] and pause:
+            time.sleep(pause)
+        counts["batches"] += 1
+        return True
+
+    while True:
+        ids = list(purgeable(Contact, cutoff).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not ids or not next_batch():
+            break
+        with transaction.atomic(using=books.db()):
+            counts["links"] += through.objects.filter(contact_id__in=ids).delete()[0]
+            counts["contacts"] += purgeable(Contact, cutoff).filter(id__in=ids).delete()[1].get(
+                Contact._meta.label, 0)
+
+    for label_id in list(purgeable(Label, cutoff).order_by("id").values_list("id", flat=True)):
+        # a huge label goes in many small steps, its links first
+        while True:
+            if not Label.all_objects.filter(id=label_id, is_deleted=True).exists():
+                break  # restored meanwhile
+            link_ids = list(through.objects.filter(label_id=label_id).values_list("id", flat=True)[:batch_size])
+            if not next_batch():
+                return counts
+            with transaction.atomic(using=books.db()):
+                if link_ids:
+                    counts["links"] += through.objects.filter(id__in=link_ids).delete()[0]
+                else:
+                    counts["labels"] += purgeable(Label, cutoff).filter(id=label_id).delete()[1].get(
+                        Label._meta.label, 0)
+                    break
+    return counts
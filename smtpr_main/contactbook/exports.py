@@ -0,0 +1,235 @@
+"""
+Export jobs: the contacts (or only the emails) of a label filter written to a compressed CSV or NDJSON file
+by a background worker, so a segment of millions of contacts never sits in the memory of a request.
+
+The worker walks the filter in keyset chunks of CHUNK_SIZE and streams them through the compressor into
+DIR/contacts-<job id>.<format>[.gz|.zst].part, which is renamed once complete. By default a small thread pool in
+the web process runs the jobs; with "WORKERS": 0 they are left pending for manage.py export_contacts --pending.
+
+A job still running after STALE_SECONDS lost its worker with the process, it goes back to pending when the
+workers of the next process start (or export_contacts --pending runs) and is written again from scratch.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import books, filters, serialization
+from .models import Contact, ExportJob
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for compression="zstd"
+    zstandard = None
+
+DEFAULTS = {
+    "DIR": None,  # defaults to <BASE_DIR>/exports
+    "WORKERS": 2,  # threads running jobs in the web process, 0 leaves them to export_contacts --pending
+    "CHUNK_SIZE": 5000,  # rows per query
+    "STALE_SECONDS": 3600,  # a job running for longer than this lost its worker
+}
+FORMATS = ("csv", "ndjson")
+COMPRESSIONS = ("gzip", "zstd", "none")
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+CONTENT_TYPES = {"gzip": "application/gzip", "zstd": "application/zstd"}
+CSV_FIELDS = ("id", "name", "email", "phone", "labels")  # the columns contact/bulk_create reads back
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_config():
+    config = {**DEFAULTS, **getattr(settings, "CONTACTBOOK_EXPORTS", {})}
+    if config["DIR"] is None:
+        config["DIR"] = os.path.join(settings.BASE_DIR, "exports")
+    return config
+
+
+def check_options(file_format, compression):
+    """Returns an error message, or None"""
+    if file_format not in FORMATS:
+        return "format must be 'csv' or 'ndjson'"
+    if compression not in COMPRESSIONS:
+        return "compression must be 'gzip', 'zstd' or 'none'"
+    if compression == "zstd" and zstandard is None:
+        return "compression 'zstd' needs the zstandard package"
+    return None
+
+
+def file_name(job):
+    return f"contacts-{job.id}.{job.file_format}{EXTENSIONS[job.compression]}"
+
+
+def file_path(job):
+    return os.path.join(get_config()["DIR"], file_name(job))
+
+
+def content_type(job):
+    if job.compression in CONTENT_TYPES:
+        return CONTENT_TYPES[job.compression]
+    return "text/csv" if job.file_format == "csv" else "application/x-ndjson"
+
+
+def create_job(label_names=(), exclude_names=(), match_mode="or", emails_only=False, file_format="csv",
+               compression="gzip", background=True):
+    """Saves the job and, with background, hands it to the workers once the transaction commits."""
+    job = ExportJob.objects.create(
+        params={"labels": list(label_names), "exclude": list(exclude_names), "match": match_mode,
+                "emails_only": emails_only},
+        file_format=file_format,
+        compression=compression,
+    )
+    workers = get_config()["WORKERS"]
+    if background and workers:
+        transaction.on_commit(lambda: get_executor(workers).submit(run_in_thread, job.id))
+    return job
+
+
+def get_executor(workers):
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="contactbook-export")
+            for job_id in recover_stale():
+                _executor.submit(run_in_thread, job_id)
+        return _executor
+
+
+def recover_stale():
+    """Puts the jobs whose worker died with its process back to pending, returns their ids"""
+    started_before = timezone.now() - timedelta(seconds=get_config()["STALE_SECONDS"])
+    # jobs started before started_date was kept only have their created_date
+    stale = ExportJob.objects.filter(Q(started_date__lt=started_before)
+                                     | Q(started_date__isnull=True, created_date__lt=started_before),
+                                     status=ExportJob.RUNNING)
+    ids = list(stale.values_list("id", flat=True))
+    ExportJob.objects.filter(id__in=ids, status=ExportJob.RUNNING).update(status=ExportJob.PENDING,
+                                                                          started_date=None)
+    return ids
+
+
+def run_in_thread(job_id):
+    try:
+        run(job_id)
+    finally:
+        # the pool threads outlive the job, their connections must not
+        connections.close_all()
+
+
+def run_pending():
+    """Runs the pending jobs one after the other, returns how many ran."""
+    recover_stale()
+    ran = 0
+    for job_id in ExportJob.objects.filter(status=ExportJob.PENDING).order_by("id").values_list("id", flat=True):
+        ran += run(job_id)
+    return ran
+
+
+def run(job_id):
+    """Runs the job unless another worker claimed it already. Returns whether it ran."""
+    claimed = ExportJob.objects.filter(id=job_id, status=ExportJob.PENDING).update(status=ExportJob.RUNNING,
+                                                                                  started_date=timezone.now())
+    if not claimed:
+        return False
+    job = ExportJob.objects.get(id=job_id)
+    path = file_path(job)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".part", "wb") as raw:
+            with compressed(raw, job.compression) as out, books.use_book(job.book_id):
+                rows = write_rows(out, job)
+        os.replace(path + ".part", path)
+    except Exception as e:
+        if os.path.exists(path + ".part"):
+            os.remove(path + ".part")
+        job.status, job.error = ExportJob.FAILED, str(e)
+    else:
+        job.status, job.rows, job.size = ExportJob.DONE, rows, os.path.getsize(path)
+    job.finished_date = timezone.now()
+    job.save(update_fields=["status", "error", "rows", "size", "finished_date"])
+    return True
+
+
+class compressed:
+    """A binary file object that compresses into raw"""
+
+    def __init__(self, raw, compression):
+        if compression == "gzip":
+            self.out = gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+        elif compression == "zstd":
+            self.out = zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        else:
+            self.out = None
+        self.raw = raw
+
+    def __enter__(self):
+        return self.out or self.raw
+
+    def __exit__(self, *exc_info):
+        if self.out is not None:
+            self.out.close()
+
+
+def write_rows(out, job):
+    """Writes the job's rows chunk by chunk, returns how many"""
+    qs, error = filters.filter_contacts(Contact.objects.all(), job.params["labels"], job.params["match"],
+                                        job.params["exclude"])
+    if error:
+        raise ValueError(error)
+    chunk_size = get_config()["CHUNK_SIZE"]
+    if job.params["emails_only"]:
+        chunks, header = email_chunks(qs, chunk_size), ("email",)
+    else:
+        chunks, header = contact_chunks(qs, chunk_size), CSV_FIELDS
+    if job.file_format == "csv":
+        out.write(encode_csv([header]))
+    rows = 0
+    for chunk in chunks:
+        out.write(encode_csv(chunk) if job.file_format == "csv" else encode_lines(header, chunk))
+        rows += len(chunk)
+    return rows
+
+
+def email_chunks(qs, chunk_size):
+    emails = qs.values_list("email", flat=True).distinct().order_by("email")
+    chunk = list(emails[:chunk_size])
+    while chunk:
+        yield [(email,) for email in chunk]
+        chunk = list(emails.filter(email__gt=chunk[-1])[:chunk_size])
+
+
+def contact_chunks(qs, chunk_size):
+    """(id, name, email, phone, label names) tuples in id order"""
+    qs = qs.order_by("id")
+    last_id = 0
+    while True:
+        page = qs.filter(id__gt=last_id)
+        if serialization.is_supported():
+            chunk = [(*row[:4], json.loads(row[4])) for row in serialization.contact_rows(page)[:chunk_size]]
+        else:
+            chunk = [(c.id, c.name, c.email, c.phone, [a_label.name for a_label in c.labels.all()])
+                     for c in page.prefetch_related("labels")[:chunk_size]]
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1][0]
+
+
+def encode_csv(rows):
+    # label lists as "a,b", the way the importer reads them
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([",".join(v) if isinstance(v, list) else v for v in row] for row in rows)
+    return buffer.getvalue().encode()
+
+
+def encode_lines(fields, rows):
+    return "".join(json.dumps(dict(zip(fields, row))) + "\n" for row in rows).encode()
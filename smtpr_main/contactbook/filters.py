@@ -0,0 +1,160 @@
+"""
+The query parameters of contact/list and the label filter they describe, shared by the views, the async
+views, admission control and the export workers.
+
+parse_list_params() checks and normalizes them, filter_contacts() applies labels/match/exclude to a queryset
+(q= is compiled by query.plan).
+"""
+import base64
+import json
+
+from . import labels, query, serialization
+
+MAX_PAGE_SIZE = 1000  # hard cap for limit=, also the page size when only after= is given
+
+
+def encode_cursor(value):
+    # Opaque for the client, it's only a base64'd JSON of the last key we returned
+    raw = json.dumps(value, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def parse_limit(request):
+    """Returns (limit, error). limit is None when no paging was asked for."""
+    limit_param = request.GET.get("limit", "").strip()
+    if not limit_param:
+        return None, None
+    try:
+        limit = int(limit_param)
+    except ValueError:
+        return None, "limit must be an integer"
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        return None, f"limit must be between 1 and {MAX_PAGE_SIZE}"
+    return limit, None
+
+
+def parse_label_names(param):
+    return [n.strip() for n in param.split(",") if n.strip()]
+
+
+def active_label_ids(label_names):
+    """name -> id of the (not deleted) labels among label_names"""
+    return labels.resolve(label_names)
+
+
+def filter_contacts(qs, label_names, match_mode, exclude_names=(), ids_by_name=None):
+    """
+    Applies the labels/match/exclude filter of contact_list. Returns (qs, error). ids_by_name is
+    active_label_ids() of all the names, looked up here when not given.
+    """
+    if label_names and match_mode not in ("and", "or"):
+        return qs, "match must be 'and' or 'or'"
+    if not label_names and not exclude_names:
+        return qs, None
+
+    # Deleted labels don't count, their links stay around until they get purged
+    if ids_by_name is None:
+        ids_by_name = active_label_ids(list(label_names) + list(exclude_names))
+    label_ids = [ids_by_name[name] for name in label_names if name in ids_by_name]
+
+    if match_mode == "or" and label_names:
+        # OR: contact has ANY of the labels
+        qs = qs.filter(labels__in=label_ids).distinct()
+
+    elif match_mode == "and" and label_names:
+        # AND: contact must have ALL labels
+        if len(set(label_ids)) < len(set(label_names)):
+            return qs.none(), None
+        for label_id in set(label_ids):
+            qs = qs.filter(labels=label_id)
+        qs = qs.distinct()
+
+    exclude_ids = [ids_by_name[name] for name in exclude_names if name in ids_by_name]
+    if exclude_ids:
+        qs = qs.exclude(labels__in=exclude_ids)
+    return qs, None
+
+
+def parse_list_params(request):
+    """The query parameters of contact_list, returns (params, error)."""
+    labels_param = request.GET.get("labels", "").strip()  # Just in case there's blank spaces
+    exclude_param = request.GET.get("exclude", "").strip()
+    emails_only = request.GET.get("emails_only", "").lower() in ("1", "true", "yes")
+    match_mode = request.GET.get("match", "or").lower()  # default: or
+    stream = request.GET.get("stream", "").lower() in ("1", "true", "yes")
+    output_format = request.GET.get("format", "json").lower()
+    after = request.GET.get("after", "").strip()
+    query_text = request.GET.get("q", "").strip()
+    explain = request.GET.get("explain", "").lower() in ("1", "true", "yes")
+    fields_param = request.GET.get("fields", "").strip()
+
+    label_names = parse_label_names(labels_param)
+    exclude_names = parse_label_names(exclude_param)
+    if (labels_param and not label_names) or (exclude_param and not exclude_names):
+        return None, "valid label names should be separated by ','"
+    if label_names and match_mode not in ("and", "or"):
+        return None, "match must be 'and' or 'or'"
+
+    # q= is the boolean form of labels/match/exclude, see query.py
+    label_query = None
+    if query_text:
+        if label_names or exclude_names:
+            return None, "q can't be combined with labels or exclude"
+        try:
+            label_query = query.parse(query_text)
+        except query.QueryError as e:
+            return None, f"invalid q: {e}"
+    elif explain:
+        return None, "explain=1 needs q"
+
+    # fields=id,email: only those columns are read, and the labels only when asked for
+    fields = None
+    if fields_param:
+        fields = parse_label_names(fields_param)
+        unknown = sorted(set(fields) - set(serialization.ALL_FIELDS))
+        if unknown:
+            return None, f"unknown fields {', '.join(unknown)}, fields are {', '.join(serialization.ALL_FIELDS)}"
+        if emails_only:
+            return None, "fields can't be combined with emails_only"
+        fields = [field for field in serialization.ALL_FIELDS if field in fields]
+
+    limit, error = parse_limit(request)
+    if error:
+        return None, error
+    if output_format not in ("json", "ndjson"):
+        return None, "format must be 'json' or 'ndjson'"
+    if output_format == "ndjson" and not stream:
+        return None, "format=ndjson is only available with stream=1"
+
+    # Keyset paging: contacts are keyed on id, emails (distinct) on the email itself
+    sort_key = "email" if emails_only else "id"
+    cursor = None
+    if after:
+        cursor = decode_cursor(after)
+        if not isinstance(cursor, dict) or sort_key not in cursor:
+            return None, "invalid cursor"
+    return {
+        "label_names": label_names,
+        "exclude_names": exclude_names,
+        "match_mode": match_mode,
+        "emails_only": emails_only,
+        "stream": stream,
+        "output_format": output_format,
+        "limit": limit,
+        "sort_key": sort_key,
+        "cursor": cursor,
+        "paged": limit is not None or bool(after),
+        "page_size": limit or MAX_PAGE_SIZE,
+        "query_text": query_text,
+        "query": label_query,
+        "explain": explain,
+        "fields": fields,
+    }, None
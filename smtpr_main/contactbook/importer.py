@@ -0,0 +1,180 @@
+"""
+Bulk import of contacts from JSON arrays, NDJSON or CSV, read as a stream and written in batches.
+"""
+import codecs
+import csv
+import json
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import books, labels
+from .models import Contact, Label
+from .signals import send_memberships_changed, contacts_created
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000  # we keep counting after that, but stop collecting the details
+FORMATS = ("json", "ndjson", "csv")
+
+
+class ImportFormatError(ValueError):
+    """The input itself is broken (not a single row), we can't continue reading it."""
+
+
+def decode_chunks(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        text = decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def iter_json_array(chunks):
+    """Yields the items of a JSON array without ever holding the whole document."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = finished = False
+    for text in decode_chunks(chunks):
+        buf += text
+        while not finished:
+            buf = buf.lstrip()
+            if not buf:
+                break
+            if not started:
+                if buf[0] != "[":
+                    raise ImportFormatError("expected a JSON array")
+                buf = buf[1:]
+                started = True
+            elif buf[0] == "]":
+                buf = buf[1:]
+                finished = True
+            elif buf[0] == ",":
+                buf = buf[1:]
+            else:
+                try:
+                    item, end = decoder.raw_decode(buf)
+                except json.JSONDecodeError:
+                    break  # most likely cut in the middle, wait for the next chunk
+                yield item
+                buf = buf[end:]
+    if not finished or buf.strip():
+        raise ImportFormatError("invalid or truncated JSON array")
+
+
+def iter_ndjson(lines):
+    for line_no, line in enumerate(decode_chunks(lines), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            # a broken line is just a broken row, the next one can still be fine
+            yield ImportFormatError(f"line {line_no} is not valid JSON")
+
+
+def iter_csv(lines):
+    reader = csv.DictReader(decode_chunks(lines))
+    if reader.fieldnames is None:
+        return
+    missing = {"name", "email", "phone"} - set(reader.fieldnames)
+    if missing:
+        raise ImportFormatError("csv header is missing " + ", ".join(sorted(missing)))
+    yield from reader
+
+
+def iter_rows(lines, input_format):
+    """lines is any iterable of bytes/str chunks, for csv and ndjson they must be whole lines."""
+    if input_format == "json":
+        return iter_json_array(lines)
+    if input_format == "ndjson":
+        return iter_ndjson(lines)
+    if input_format == "csv":
+        return iter_csv(lines)
+    raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+
+
+def clean_row(row):
+    """Returns (contact, label_names) or raises ValidationError."""
+    if isinstance(row, Exception):
+        raise ValidationError(str(row))
+    if not isinstance(row, dict):
+        raise ValidationError("a row must be an object")
+
+    name = (row.get("name") or "").strip()
+    email = (row.get("email") or "").strip()
+    phone = (row.get("phone") or "").strip()
+    if not name or not email or not phone:
+        raise ValidationError("name, phone and email are required")
+
+    contact = Contact(name=name, email=email, phone=phone)
+    contact.clean_fields(exclude=["book"])  # the book of the request, checked by BookMiddleware
+
+    labels = row.get("labels") or []
+    if isinstance(labels, str):  # csv: "friends,work"
+        labels = labels.split(",")
+    if not isinstance(labels, list) or not all(isinstance(n, str) for n in labels):
+        raise ValidationError("labels must be a list of names")
+    label_names = {n.strip() for n in labels if n.strip()}
+    for label_name in label_names:
+        if len(label_name) > Label._meta.get_field("name").max_length:
+            raise ValidationError(f"label name too long: {label_name[:20]}...")
+    return contact, label_names
+
+
+def write_batch(batch):
+    """batch is a list of (contact, label_names), returns how many contacts were created."""
+    through = Contact.labels.through
+    with transaction.atomic(using=books.db()):
+        all_names = set().union(*(names for _, names in batch))
+        label_ids = labels.resolve(all_names, create=True) if all_names else {}
+
+        contacts = Contact.objects.bulk_create([contact for contact, _ in batch])
+        contacts_created.send(sender=Contact, contact_ids=[contact.id for contact in contacts])
+        links = [
+            through(contact_id=contact.id, label_id=label_ids[name])
+            for contact, names in batch
+            for name in names
+        ]
+        through.objects.bulk_create(links)
+        send_memberships_changed("add", [(link.contact_id, link.label_id) for link in links])
+    return len(contacts)
+
+
+def import_contacts(rows, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Validates and writes rows (dicts with name, email, phone and optionally labels). Every batch is its
+    own transaction, a bad row is reported and skipped without failing the others.
+    """
+    started = time.perf_counter()
+    report = {"rows": 0, "created": 0, "failed": 0, "errors": []}
+    batch = []
+
+    def flush():
+        report["created"] += write_batch(batch)
+        batch.clear()
+
+    try:
+        for row_no, row in enumerate(rows, start=1):
+            report["rows"] = row_no
+            try:
+                batch.append(clean_row(row))
+            except ValidationError as e:
+                report["failed"] += 1
+                if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                    report["errors"].append({"row": row_no, "error": "; ".join(e.messages)})
+                continue
+            if len(batch) >= batch_size:
+                flush()
+    except ImportFormatError as e:
+        report["fatal"] = str(e)
+    if batch:
+        flush()
+
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    report["rows_per_second"] = round(report["rows"] / report["seconds"], 1) if report["seconds"] else None
+    return report
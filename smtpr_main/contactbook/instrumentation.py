@@ -0,0 +1,336 @@
+"""
+Per-request instrumentation: SQL count and time (through connection.execute_wrapper), JSON encoding time,
+rows and bytes returned, kept as histograms per view name.
+
+Only a sample of the requests is measured (SAMPLE_RATE). With DEBUG_HEADER on a client can ask for a
+measurement with the X-Contactbook-Debug: 1 header, the response then carries the numbers in Server-Timing
+and X-Contactbook-Stats, and the executed queries show up in debug/requests. The SQL tells a lot about the
+data, so the header and debug/requests are only for staff users, or anybody when settings.DEBUG is on. The
+histograms are served by the metrics view in the Prometheus text format.
+"""
+import random
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django import http
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+try:
+    import orjson
+except ImportError:  # optional, json is used without it
+    orjson = None
+
+DEFAULTS = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 0.1,  # share of the requests measured, 0 measures only the ones asking for it
+    "DEBUG_HEADER": False,  # honour X-Contactbook-Debug: 1, from staff users or with settings.DEBUG
+}
+DEBUG_HEADER = "X-Contactbook-Debug"
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1000, 10000, 100000, 1000000, 10000000, 100000000)
+MAX_LOGGED_SQL = 500  # characters of every query kept in debug mode
+RECENT_REQUESTS = 100  # measured requests kept for debug/requests
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "CONTACTBOOK_METRICS", {})}
+
+
+def may_debug(user):
+    """Whether user may see the executed queries, user is None before (or without) the auth middleware"""
+    return settings.DEBUG or bool(user is not None and user.is_staff)
+
+
+_current = ContextVar("contactbook_request_stats", default=None)
+
+
+class RequestStats:
+    """What one request did, the execute_wrapper below hands it the queries."""
+
+    def __init__(self, keep_queries=False):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.serialize_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.keep_queries = keep_queries
+        self.query_log = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.sql_seconds += elapsed
+            if self.keep_queries:
+                self.query_log.append({"sql": sql[:MAX_LOGGED_SQL], "ms": round(elapsed * 1000, 3)})
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    # Installed on every connection for good and found through the context: the async ORM runs its
+    # queries in another thread, on that thread's connection, but with a copy of the request's context.
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_execute_wrapper(sender, connection, **kwargs):
+    if execute_wrapper not in connection.execute_wrappers:  # it's called again on every reconnect
+        connection.execute_wrappers.append(execute_wrapper)
+
+
+def add_serialization(seconds, rows):
+    """For encoders other than JSONEncoder"""
+    stats = _current.get()
+    if stats is not None:
+        stats.serialize_seconds += seconds
+        stats.rows += rows
+
+
+def rows_in(o):
+    # the objects in a response body: a list, the list of a page envelope, or a single object
+    if isinstance(o, list):
+        return len(o)
+    if isinstance(o, dict):
+        for key in ("results", "emails"):
+            if isinstance(o.get(key), list):
+                return len(o[key])
+    return 1
+
+
+class JSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder adding its time and the rows it encoded to the current request's stats"""
+
+    def encode(self, o):
+        stats = _current.get()
+        if stats is None:
+            return super().encode(o)
+        started = time.perf_counter()
+        try:
+            return super().encode(o)
+        finally:
+            stats.serialize_seconds += time.perf_counter() - started
+            stats.rows += rows_in(o)
+
+
+def django_default(o):
+    return DjangoJSONEncoder().default(o)
+
+
+class JsonResponse(http.JsonResponse):
+    """Encoded by orjson when it's installed, about 10x faster than json for our pages"""
+
+    def __init__(self, data, encoder=JSONEncoder, safe=True, json_dumps_params=None, **kwargs):
+        if orjson is None or encoder is not JSONEncoder or json_dumps_params:
+            super().__init__(data, encoder=encoder, safe=safe, json_dumps_params=json_dumps_params, **kwargs)
+            return
+        if safe and not isinstance(data, dict):
+            raise TypeError("In order to allow non-dict objects to be serialized set the safe parameter to False.")
+        kwargs.setdefault("content_type", "application/json")
+        started = time.perf_counter()
+        # dates go through django's encoder as well, so they look the same as before
+        content = orjson.dumps(data, default=django_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+        add_serialization(time.perf_counter() - started, rows_in(data))
+        http.HttpResponse.__init__(self, content, **kwargs)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # per bucket, made cumulative on output
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Histograms per (metric, view), plus the last few measured requests."""
+
+    HISTOGRAMS = {
+        "contactbook_request_duration_seconds": ("Time spent in the view and the middleware below",
+                                                 SECONDS_BUCKETS),
+        "contactbook_request_sql_seconds": ("Time spent executing SQL", SECONDS_BUCKETS),
+        "contactbook_request_serialize_seconds": ("Time spent encoding JSON", SECONDS_BUCKETS),
+        "contactbook_request_queries": ("SQL queries per request", QUERY_BUCKETS),
+        "contactbook_request_rows": ("Objects in the response body", ROW_BUCKETS),
+        "contactbook_response_bytes": ("Size of the response body", BYTE_BUCKETS),
+    }
+
+    def __init__(self, recent=RECENT_REQUESTS):
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self.recent = deque(maxlen=recent)
+
+    def record(self, view, status, duration, stats, path, queries=None):
+        values = {
+            "contactbook_request_duration_seconds": duration,
+            "contactbook_request_sql_seconds": stats.sql_seconds,
+            "contactbook_request_serialize_seconds": stats.serialize_seconds,
+            "contactbook_request_queries": stats.queries,
+            "contactbook_request_rows": stats.rows,
+            "contactbook_response_bytes": stats.bytes,
+        }
+        with self._lock:
+            for name, value in values.items():
+                key = (name, view)
+                if key not in self._histograms:
+                    self._histograms[key] = Histogram(self.HISTOGRAMS[name][1])
+                self._histograms[key].observe(value)
+            self.recent.append({
+                "view": view,
+                "path": path,
+                "status": status,
+                "ms": round(duration * 1000, 3),
+                "sql_ms": round(stats.sql_seconds * 1000, 3),
+                "serialize_ms": round(stats.serialize_seconds * 1000, 3),
+                "queries": stats.queries,
+                "rows": stats.rows,
+                "bytes": stats.bytes,
+                **({"query_log": queries} if queries is not None else {}),
+            })
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in self.HISTOGRAMS.items():
+                keys = sorted(key for key in self._histograms if key[0] == name)
+                if not keys:
+                    continue
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} histogram")
+                for _, view in keys:
+                    histogram = self._histograms[name, view]
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+                    lines.append(f'{name}_bucket{{view="{view}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{view="{view}"}} {histogram.sum:g}')
+                    lines.append(f'{name}_count{{view="{view}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+            self.recent.clear()
+
+
+metrics = Metrics()
+
+
+def view_name(request):
+    match = getattr(request, "resolver_match", None)
+    return match.view_name if match else "unresolved"
+
+
+class InstrumentationMiddleware:
+    """Goes first in MIDDLEWARE, so the duration covers the whole stack below it. Sync and async."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, debug = self.start(request)
+        if stats is None:
+            return self.get_response(request)
+        started = time.perf_counter()
+        token = _current.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        # the user is only known once the auth middleware below us ran
+        debug = debug and may_debug(getattr(request, "user", None))
+        return self.finish(request, response, stats, started, debug)
+
+    async def __acall__(self, request):
+        stats, debug = self.start(request)
+        if stats is None:
+            return await self.get_response(request)
+        started = time.perf_counter()
+        token = _current.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        debug = debug and may_debug(await request.auser() if hasattr(request, "auser") else None)
+        return self.finish(request, response, stats, started, debug)
+
+    def start(self, request):
+        """
+        Returns (stats, debug), stats is None when the request isn't measured. debug is what the client asked
+        for, finish() only gets it when may_debug() agrees.
+        """
+        config = get_config()
+        debug = config["DEBUG_HEADER"] and request.headers.get(DEBUG_HEADER) == "1"
+        if not config["ENABLED"] or not (debug or random.random() < config["SAMPLE_RATE"]):
+            return None, debug
+        return RequestStats(keep_queries=debug), debug
+
+    def finish(self, request, response, stats, started, debug):
+        if response.streaming:
+            # most of the work happens while the body is sent, the numbers are final once it is done
+            content = response.streaming_content
+            measure = self.ameasure_stream if response.is_async else self.measure_stream
+            response.streaming_content = measure(content, response, stats, started, request, debug)
+            return response
+
+        stats.bytes = len(response.content)
+        duration = time.perf_counter() - started
+        metrics.record(view_name(request), response.status_code, duration, stats, request.path,
+                       stats.query_log if debug else None)
+        if debug:
+            response["Server-Timing"] = (
+                f'sql;dur={stats.sql_seconds * 1000:.3f};desc="{stats.queries} queries", '
+                f"serialize;dur={stats.serialize_seconds * 1000:.3f}, total;dur={duration * 1000:.3f}"
+            )
+            response["X-Contactbook-Stats"] = f"queries={stats.queries}; rows={stats.rows}; bytes={stats.bytes}"
+        return response
+
+    def measure_stream(self, content, response, stats, started, request, debug):
+        _current.set(stats)  # not reset by token, the server may resume us in another context
+        try:
+            for chunk in content:
+                stats.bytes += len(chunk)
+                yield chunk
+        finally:
+            _current.set(None)
+            metrics.record(view_name(request), response.status_code, time.perf_counter() - started, stats,
+                           request.path, stats.query_log if debug else None)
+
+    async def ameasure_stream(self, content, response, stats, started, request, debug):
+        _current.set(stats)
+        try:
+            async for chunk in content:
+                stats.bytes += len(chunk)
+                yield chunk
+        finally:
+            _current.set(None)
+            metrics.record(view_name(request), response.status_code, time.perf_counter() - started, stats,
+                           request.path, stats.query_log if debug else None)
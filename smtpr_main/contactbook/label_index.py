@@ -0,0 +1,177 @@
+"""
+In-process index from label to the ids of its contacts, so label filters become set operations.
+
+Every label is kept as a bitmap in a plain python int (bit n set <=> contact n has the label), the
+AND/OR/NOT themselves then run in C and we only touch the database again to fetch the final rows by
+primary key. Bitmaps are loaded lazily per label and kept in sync through memberships_changed.
+
+The index lives in the memory of one process, so it is only correct when every write goes through
+this process (runserver, a single worker), which is why it is behind CONTACTBOOK_LABEL_INDEX.
+"""
+import re
+import threading
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import books, labels
+from .models import Contact, Label
+from .signals import memberships_changed, visibility_changed
+
+# bit positions of every byte value, so we can unpack a bitmap one byte at a time
+BYTE_BITS = [[bit for bit in range(8) if value >> bit & 1] for value in range(256)]
+NON_ZERO_BYTE = re.compile(b"[^\x00]")
+
+
+def is_enabled():
+    # label and contact ids are only unique within a database, the index covers the books on default
+    return getattr(settings, "CONTACTBOOK_LABEL_INDEX", False) and books.db() == DEFAULT_DB_ALIAS
+
+
+def ids_to_bitmap(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for an_id in ids:
+        buf[an_id >> 3] |= 1 << (an_id & 7)
+    return int.from_bytes(buf, "little")
+
+
+def bitmap_to_ids(bitmap):
+    """Returns the ids in ascending order."""
+    raw = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+    ids = []
+    # the regex skips the (usually many) empty bytes in C
+    for match in NON_ZERO_BYTE.finditer(raw):
+        base = match.start() * 8
+        ids.extend(base + bit for bit in BYTE_BITS[raw[match.start()]])
+    return ids
+
+
+class LabelIndex:
+    def __init__(self):
+        self._bitmaps = {}  # label id -> bitmap
+        self._loading = {}  # label id -> the change logs of the loads running for it
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._bitmaps.clear()
+            self._loading.clear()
+
+    def bitmap(self, label_id):
+        with self._lock:
+            if label_id in self._bitmaps:
+                return self._bitmaps[label_id]
+            # apply() logs what commits while we read, our query may or may not have seen it
+            log = []
+            self._loading.setdefault(label_id, []).append(log)
+        try:
+            # from the primary, the writes are applied on top of it and a lagging replica would miss some.
+            # Without the soft deleted contacts, soft_delete() and restore() take them out and put them back.
+            ids = (Contact.labels.through.objects.using(DEFAULT_DB_ALIAS)
+                   .filter(label_id=label_id, contact__is_deleted=False)
+                   .values_list("contact_id", flat=True))
+            bitmap = ids_to_bitmap(ids.iterator(chunk_size=10000))
+        except BaseException:
+            with self._lock:
+                self.stop_loading(label_id, log)
+            raise
+        with self._lock:
+            self.stop_loading(label_id, log)
+            # adding or removing a bit again is harmless, replaying in order ends where the database is
+            for action, delta in log:
+                if action == "forget":
+                    return bitmap  # good for this caller, too late to keep
+                bitmap = bitmap | delta if action == "add" else bitmap & ~delta
+            # somebody else may have loaded (and updated) it meanwhile, theirs wins
+            return self._bitmaps.setdefault(label_id, bitmap)
+
+    def stop_loading(self, label_id, log):
+        logs = [other for other in self._loading.get(label_id, ()) if other is not log]
+        if logs:
+            self._loading[label_id] = logs
+        else:
+            self._loading.pop(label_id, None)
+
+    def apply(self, action, pairs):
+        by_label = {}
+        for contact_id, label_id in pairs:
+            by_label.setdefault(label_id, []).append(contact_id)
+        with self._lock:
+            for label_id, contact_ids in by_label.items():
+                loaded, loading = label_id in self._bitmaps, self._loading.get(label_id)
+                if not loaded and not loading:
+                    continue  # not loaded, it will be read fresh when needed
+                # one big int operation per label, every |= copies the whole bitmap
+                delta = ids_to_bitmap(contact_ids)
+                for log in loading or ():
+                    log.append((action, delta))
+                if not loaded:
+                    continue
+                if action == "add":
+                    self._bitmaps[label_id] |= delta
+                else:
+                    self._bitmaps[label_id] &= ~delta
+
+    def forget(self, label_id):
+        with self._lock:
+            self._bitmaps.pop(label_id, None)
+            for log in self._loading.get(label_id, ()):
+                log.append(("forget", None))
+
+    def contact_ids(self, label_names, match_mode="or", exclude_names=()):
+        """
+        Ids (ascending) of the contacts having any ("or") or all ("and") of label_names and none of
+        exclude_names. label_names must not be empty.
+        """
+        wanted = set(label_names) | set(exclude_names)
+        ids_by_name = labels.resolve(wanted)
+
+        include = [ids_by_name[name] for name in label_names if name in ids_by_name]
+        if match_mode == "and" and len(include) < len(set(label_names)):
+            return []  # one of the labels doesn't exist, nobody can have all of them
+        if not include:
+            return []
+
+        bitmaps = [self.bitmap(label_id) for label_id in include]
+        if match_mode == "and":
+            bitmaps.sort(key=int.bit_count)  # the smallest first keeps the intermediates small
+            result = bitmaps[0]
+            for bitmap in bitmaps[1:]:
+                result &= bitmap
+        else:
+            result = 0
+            for bitmap in bitmaps:
+                result |= bitmap
+
+        for name in exclude_names:
+            if name in ids_by_name and result:
+                result &= ~self.bitmap(ids_by_name[name])
+        return bitmap_to_ids(result)
+
+
+label_index = LabelIndex()
+
+
+@receiver(memberships_changed)
+def update_label_index(sender, action, pairs, **kwargs):
+    if books.db() != DEFAULT_DB_ALIAS:
+        return
+    # Only what got committed goes into the index
+    transaction.on_commit(lambda: label_index.apply(action, pairs), robust=True)
+
+
+@receiver(post_delete, sender=Label)
+def drop_label_from_index(sender, instance, **kwargs):
+    label_index.forget(instance.pk)
+
+
+@receiver(visibility_changed, sender=Label)
+def drop_hidden_label_from_index(sender, ids, **kwargs):
+    # a restored label gets loaded fresh, with the memberships it kept while it was deleted
+    for label_id in ids:
+        label_index.forget(label_id)
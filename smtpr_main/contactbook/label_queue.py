@@ -0,0 +1,205 @@
+"""
+Write-behind mode for contact/add_label and contact/remove_label.
+
+At a high rate of single label writes most of the time goes to the per request transaction, the label
+lookups and the signal receivers (counters, caches, change log, segments) running for one membership at a
+time. With "ENABLED": True the two views only insert the mutation into the LabelMutation table (in the
+SQLite database, so it survives a restart) and answer 202 with its id as the ticket; contact/label_queue
+tells how it went.
+
+A worker takes up to BATCH_SIZE queued mutations every INTERVAL seconds and applies them together: per
+(contact, label) only the last one counts, so an add followed by a remove of the same label is one
+remove, the labels are resolved once, and the links are written with memberships.add_pairs/remove_pairs
+in one transaction per book, one memberships_changed per direction for the receivers. Mutations of
+contacts that don't exist (anymore) end up failed.
+
+By default a thread of the web process is the worker; with "WORKER": False run manage.py
+apply_label_queue --loop instead. Reads may see the labels as they were until the queue is applied: with
+FLUSH_ON_READ the list endpoints apply the queue of their book first, flush=1 does so for one request.
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+from django.utils import timezone
+
+from . import books, labels, memberships
+from .memberships import chunked
+from .models import Contact, LabelMutation
+
+DEFAULTS = {
+    "ENABLED": False,  # add_label / remove_label answer 202 and go through the queue
+    "WORKER": True,  # a thread of the web process applies the queue, False leaves it to apply_label_queue
+    "INTERVAL": 0.5,  # seconds between the rounds of the worker
+    "BATCH_SIZE": 5000,  # mutations applied per transaction
+    "FLUSH_ON_READ": False,  # the list endpoints apply the queue of their book before answering
+}
+
+logger = logging.getLogger(__name__)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, "CONTACTBOOK_WRITE_BEHIND", {})}
+
+
+def is_enabled():
+    return get_config()["ENABLED"]
+
+
+def enqueue(action, contact_id, names):
+    """Saves the mutation for the worker, returns it. Its id is the ticket."""
+    mutation = LabelMutation.objects.create(action=action, contact_id=contact_id, labels=list(names))
+    if get_config()["WORKER"]:
+        start_worker()
+    return mutation
+
+
+def pending():
+    """How many mutations of the current book (of all books outside of one) wait"""
+    return LabelMutation.objects.filter(status=LabelMutation.QUEUED).count()
+
+
+def coalesce(mutations):
+    """(contact_id, label name) -> the action of the last mutation touching it"""
+    final = {}
+    for mutation in mutations:
+        for name in mutation.labels:
+            final[(mutation.contact_id, name)] = mutation.action
+    return final
+
+
+def live_contacts(contact_ids):
+    live = set()
+    for chunk in chunked(sorted(contact_ids)):
+        live.update(Contact.objects.filter(id__in=chunk).values_list("id", flat=True))
+    return live
+
+
+def apply_mutations(mutations):
+    """Applies mutations of the current book, in one transaction of its database. Returns the counts."""
+    final = coalesce(mutations)
+    live = live_contacts({mutation.contact_id for mutation in mutations})
+    adds = [(contact_id, name) for (contact_id, name), action in final.items()
+            if action == LabelMutation.ADD and contact_id in live]
+    removes = [(contact_id, name) for (contact_id, name), action in final.items()
+               if action == LabelMutation.REMOVE and contact_id in live]
+
+    with transaction.atomic(using=books.db()):
+        add_ids = labels.resolve({name for _, name in adds}, create=True) if adds else {}
+        remove_ids = labels.resolve({name for _, name in removes}) if removes else {}
+        added = memberships.add_pairs([(contact_id, add_ids[name]) for contact_id, name in adds])
+        removed = memberships.remove_pairs([(contact_id, remove_ids[name]) for contact_id, name in removes
+                                            if name in remove_ids])
+
+    failed = [mutation.id for mutation in mutations if mutation.contact_id not in live]
+    mark([mutation.id for mutation in mutations if mutation.contact_id in live], LabelMutation.APPLIED)
+    mark(failed, LabelMutation.FAILED, "contact not found")
+    return {
+        "mutations": len(mutations),
+        # (contact, label) writes saved by coalescing, e.g. an add and a remove of the same label
+        "coalesced": sum(len(mutation.labels) for mutation in mutations) - len(final),
+        "added": added,
+        "removed": removed,
+        "failed": len(failed),
+    }
+
+
+def mark(ids, status, error=""):
+    for chunk in chunked(ids):
+        LabelMutation.objects.filter(id__in=chunk).update(status=status, error=error, applied_date=timezone.now())
+
+
+def apply_pending(batch_size=None):
+    """
+    Applies the queued mutations of the current book (of all books outside of one), oldest first,
+    batch_size at a time. Returns the counts.
+    """
+    batch_size = batch_size or get_config()["BATCH_SIZE"]
+    counts = dict.fromkeys(("mutations", "coalesced", "added", "removed", "failed"), 0)
+    while True:
+        # the transactions take the write lock right away (transaction_mode IMMEDIATE): one worker at a
+        # time, in every process, and a batch is never applied twice. The queue lives on default, the
+        # book (of a request) maybe elsewhere.
+        with transaction.atomic(using=books.db()), transaction.atomic(using=DEFAULT_DB_ALIAS):
+            batch = list(LabelMutation.objects.filter(status=LabelMutation.QUEUED).order_by("id")[:batch_size])
+            by_book = defaultdict(list)
+            for mutation in batch:
+                by_book[mutation.book_id].append(mutation)
+            for book_id, mutations in by_book.items():
+                with books.use_book(book_id):
+                    for key, value in apply_book(mutations).items():
+                        counts[key] += value
+        if len(batch) < batch_size:
+            return counts
+
+
+def apply_book(mutations):
+    try:
+        with transaction.atomic(using=books.db()):
+            return apply_mutations(mutations)
+    except OperationalError:
+        raise  # e.g. locked, they stay queued for the next round
+    except Exception as e:
+        # whatever fails here fails again next time, don't keep the rest of the queue behind it
+        mark([mutation.id for mutation in mutations], LabelMutation.FAILED, str(e))
+        return {"mutations": len(mutations), "failed": len(mutations)}
+
+
+def flush(request):
+    if not is_enabled():
+        return
+    wanted = get_config()["FLUSH_ON_READ"] or request.GET.get("flush", "").lower() in ("1", "true", "yes")
+    if wanted and LabelMutation.objects.filter(status=LabelMutation.QUEUED).exists():
+        apply_pending()
+
+
+def flushed(view):
+    """Applies the queued label mutations of the book before the view (sync or async) reads, see flush()"""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            await sync_to_async(flush)(request)
+            return await view(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        flush(request)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def start_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=work, name="contactbook-label-queue", daemon=True)
+            _worker.start()
+
+
+def work():
+    while True:
+        time.sleep(get_config()["INTERVAL"])
+        try:
+            work_round()
+        finally:
+            # the thread lives on between rounds, its connections must not
+            connections.close_all()
+
+
+def work_round():
+    """One round of the worker, whatever goes wrong the worker must live on for the next one"""
+    try:
+        apply_pending()
+    except OperationalError:
+        pass  # locked, the next round tries again
+    except Exception:
+        logger.exception("applying the label queue failed")
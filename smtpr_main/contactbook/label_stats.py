@@ -0,0 +1,136 @@
+"""
+Denormalized label counters: LabelStat (contacts per label) and LabelPairStat (contacts carrying both
+labels), so label/list?with_counts=1 and contact/facets don't have to count the through table.
+
+They follow memberships_changed inside the writing transaction, every path that adds or removes
+memberships (add_label, remove_label, batch_label, the importer, soft delete and restore of contacts)
+moves them along with its own rows. Only live contacts count. A soft deleted label keeps its counters,
+its memberships are only hidden, and they are dropped (cascade) when it is purged.
+"""
+from collections import Counter, defaultdict
+from itertools import permutations
+
+from django.db import connections, transaction
+from django.dispatch import receiver
+
+from . import books
+from .memberships import chunked
+from .models import Contact, Label, LabelStat, LabelPairStat
+from .signals import memberships_changed, visibility_changed
+
+UPSERT_CHUNK_SIZE = 300  # rows per INSERT, 3 parameters each
+
+
+def upsert_counts(model, columns, deltas, drop_empty=False):
+    """
+    Adds the deltas ({key tuple: delta}) to contact_count. Rows which don't exist yet are created by the
+    increments; the decrements are plain UPDATEs, sqlite checks contact_count >= 0 on the row it would
+    insert before it looks for the conflict. With drop_empty rows falling to 0 are deleted.
+    """
+    connection = connections[books.db()]
+    increments = [(*key, delta) for key, delta in deltas.items() if delta > 0]
+    decrements = [(-delta, *key) for key, delta in deltas.items() if delta < 0]
+    table = connection.ops.quote_name(model._meta.db_table)
+    names = ", ".join(connection.ops.quote_name(c) for c in columns)
+    where = " AND ".join(f"{connection.ops.quote_name(c)} = %s" for c in columns)
+    row = "(" + ", ".join(["%s"] * (len(columns) + 1)) + ")"
+    with connection.cursor() as cursor:
+        for chunk in chunked(increments, UPSERT_CHUNK_SIZE):
+            cursor.execute(
+                f"INSERT INTO {table} ({names}, contact_count) VALUES {', '.join([row] * len(chunk))} "
+                f"ON CONFLICT ({names}) DO UPDATE SET contact_count = {table}.contact_count + excluded.contact_count",
+                [value for values in chunk for value in values],
+            )
+        if decrements:
+            cursor.executemany(f"UPDATE {table} SET contact_count = contact_count - %s WHERE {where}", decrements)
+            if drop_empty:
+                cursor.executemany(f"DELETE FROM {table} WHERE {where} AND contact_count = 0",
+                                   [key for _, *key in decrements])
+
+
+def live_labels_of(contact_ids):
+    """contact id -> set of label ids, for the live ones among contact_ids"""
+    through = Contact.labels.through
+    labels = defaultdict(set)
+    for chunk in chunked(sorted(contact_ids)):
+        links = through.objects.filter(contact_id__in=chunk, contact__is_deleted=False)
+        for contact_id, label_id in links.values_list("contact_id", "label_id"):
+            labels[contact_id].add(label_id)
+    return labels
+
+
+def apply(action, pairs):
+    """
+    Moves the counters along with memberships that were just added or removed. Runs after the write, so
+    the labels a contact has now are in the database and the ones it had before follow from the pairs.
+    """
+    changed = defaultdict(set)
+    for contact_id, label_id in pairs:
+        changed[contact_id].add(label_id)
+    now = live_labels_of(changed)
+
+    label_deltas = Counter()
+    pair_deltas = Counter()
+    sign = 1 if action == "add" else -1
+    for contact_id, label_ids in changed.items():
+        after = now.get(contact_id, set())
+        before = after - label_ids if action == "add" else after | label_ids
+        label_deltas.update({(label_id,): sign for label_id in label_ids})
+        pair_deltas.update(set(permutations(after, 2)) - set(permutations(before, 2)))
+        pair_deltas.subtract(set(permutations(before, 2)) - set(permutations(after, 2)))
+
+    upsert_counts(LabelStat, ["label_id"], label_deltas)
+    upsert_counts(LabelPairStat, ["label_id", "other_id"], pair_deltas, drop_empty=True)
+
+
+def rebuild(label_ids=None):
+    """Counts everything (or what involves label_ids) again from the through table."""
+    connection = connections[books.db()]
+    through = Contact.labels.through._meta.db_table
+    contact = Contact._meta.db_table
+    label = Label._meta.db_table
+    stat = LabelStat._meta.db_table
+    pair_stat = LabelPairStat._meta.db_table
+    only, only_pairs, params = "", "", []
+    if label_ids is not None:
+        label_ids = list(label_ids)
+        if not label_ids:
+            return
+        marks = ", ".join(["%s"] * len(label_ids))
+        only = f" WHERE l.id IN ({marks})"
+        only_pairs = f" AND (a.label_id IN ({marks}) OR b.label_id IN ({marks}))"
+        params = label_ids
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        if label_ids is None:
+            cursor.execute(f"DELETE FROM {stat}")
+            cursor.execute(f"DELETE FROM {pair_stat}")
+        else:
+            cursor.execute(f"DELETE FROM {stat} WHERE label_id IN ({marks})", params)
+            cursor.execute(f"DELETE FROM {pair_stat} WHERE label_id IN ({marks}) OR other_id IN ({marks})",
+                           params * 2)
+        cursor.execute(
+            f"INSERT INTO {stat} (label_id, contact_count) "
+            f"SELECT l.id, (SELECT COUNT(*) FROM {through} cl JOIN {contact} c ON c.id = cl.contact_id "
+            f"WHERE cl.label_id = l.id AND NOT c.is_deleted) FROM {label} l{only}",
+            params,
+        )
+        cursor.execute(
+            f"INSERT INTO {pair_stat} (label_id, other_id, contact_count) "
+            f"SELECT a.label_id, b.label_id, COUNT(*) FROM {through} a "
+            f"JOIN {through} b ON b.contact_id = a.contact_id AND b.label_id <> a.label_id "
+            f"JOIN {contact} c ON c.id = a.contact_id WHERE NOT c.is_deleted{only_pairs} "
+            f"GROUP BY a.label_id, b.label_id",
+            params * 2,
+        )
+
+
+@receiver(memberships_changed)
+def update_label_stats(sender, action, pairs, **kwargs):
+    apply(action, pairs)
+
+
+@receiver(visibility_changed, sender=Label)
+def recount_restored_labels(sender, ids, visible, **kwargs):
+    # a label being purged loses its links without memberships_changed, if it comes back count again
+    if visible:
+        rebuild(ids)
@@ -0,0 +1,165 @@
+"""
+Label names to ids, for every endpoint that takes label names: one normalization, one name__in query for
+the whole batch, and a bulk INSERT for the ones that don't exist yet.
+
+Two requests creating the same label at the same time both INSERT with ignore_conflicts, the unique
+constraint lets one of them win, and both read the ids back with one more query. Nobody retries.
+
+Resolved ids of live labels are kept in a small LRU for CACHE_TTL seconds. Deleting a label in this process
+drops it right away; one deleted by another process may be handed out until its entry expires, which links
+contacts to a hidden label (as if the link was made just before the delete).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.db import IntegrityError, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import books, deletion
+from .models import Label, current_book_id
+from .signals import labels_created, visibility_changed
+
+CACHE_SIZE = 1000  # names
+CACHE_TTL = 60  # seconds
+CREATE_ATTEMPTS = 3  # inserts tried by create_missing while others keep creating the same names
+
+
+def normalize(names):
+    """The stripped, non-empty names, without duplicates, in their first order"""
+    return list(dict.fromkeys(name.strip() for name in names if name.strip()))
+
+
+class NameCache:
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._ids = OrderedDict()  # (book id, name) -> (id, expires), the same name is another label in every book
+        self._lock = threading.Lock()
+
+    def get_many(self, names):
+        now = time.monotonic()
+        book_id = current_book_id()
+        found = {}
+        with self._lock:
+            for name in names:
+                key = (book_id, name)
+                entry = self._ids.get(key)
+                if entry is None:
+                    continue
+                if entry[1] < now:
+                    del self._ids[key]
+                    continue
+                self._ids.move_to_end(key)
+                found[name] = entry[0]
+        return found
+
+    def set_many(self, ids):
+        book_id = current_book_id()
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for name, label_id in ids.items():
+                self._ids[book_id, name] = (label_id, expires)
+                self._ids.move_to_end((book_id, name))
+            while len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+
+    def forget_ids(self, label_ids):
+        label_ids = set(label_ids)
+        with self._lock:
+            for key in [key for key, (label_id, _) in self._ids.items() if label_id in label_ids]:
+                del self._ids[key]
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+name_cache = NameCache()
+
+
+def resolve(names, create=False):
+    """
+    name -> id of the live labels among names (normalized first). With create the missing labels are
+    created and deleted ones brought back, so every name is in the answer.
+    """
+    names = normalize(names)
+    ids = name_cache.get_many(names)
+    misses = [name for name in names if name not in ids]
+    if not misses:
+        return ids
+
+    found = {}
+    deleted = []
+    for label_id, name, is_deleted in (Label.all_objects.filter(name__in=misses)
+                                       .values_list("id", "name", "is_deleted")):
+        if is_deleted:
+            deleted.append((name, label_id))
+        else:
+            found[name] = label_id
+    if create and deleted:
+        deletion.restore(Label, [label_id for _, label_id in deleted])
+        found.update(deleted)
+    if create and len(found) < len(misses):
+        found.update(create_missing([name for name in misses if name not in found]))
+
+    # only what is committed goes into the cache, a rolled back creation must not stay behind
+    if found:
+        transaction.on_commit(lambda: name_cache.set_many(found), using=books.db(), robust=True)
+    ids.update(found)
+    return ids
+
+
+def create_missing(names):
+    """
+    Creates the labels, whoever inserts a name first wins. Returns name -> id of all of them, labels_created
+    only tells about the ones inserted here.
+    """
+    names = list(names)
+    with transaction.atomic(using=books.db(), savepoint=False):
+        for attempt in range(CREATE_ATTEMPTS):
+            existing = set(Label.all_objects.filter(name__in=names).values_list("name", flat=True))
+            try:
+                # in a savepoint, the conflict must not break the transaction we're in
+                with transaction.atomic(using=books.db()):
+                    Label.objects.bulk_create([Label(name=name) for name in names if name not in existing])
+                break
+            except IntegrityError:
+                # somebody inserted one of them after our read, whatever the lock mode of the transaction:
+                # read again and insert the rest
+                if attempt == CREATE_ATTEMPTS - 1:
+                    raise
+        ids = dict(Label.all_objects.filter(name__in=names).values_list("name", "id"))
+        created = [label_id for name, label_id in ids.items() if name not in existing]
+        if created:
+            labels_created.send(sender=Label, label_ids=created)
+    return ids
+
+
+def get_or_create(name):
+    """(label, created) for one name, like Label.objects.get_or_create but bringing back a deleted label"""
+    [name] = normalize([name])
+    cached = name_cache.get_many([name])
+    if cached:
+        return Label(id=cached[name], name=name), False
+    row = Label.all_objects.filter(name=name).values_list("id", "is_deleted").first()
+    if row is None:
+        label_id, created = create_missing([name])[name], True
+    else:
+        (label_id, is_deleted), created = row, False
+        if is_deleted:
+            deletion.restore(Label, [label_id])
+    transaction.on_commit(lambda: name_cache.set_many({name: label_id}), using=books.db(), robust=True)
+    return Label(id=label_id, name=name), created
+
+
+@receiver(visibility_changed, sender=Label)
+def forget_deleted_labels(sender, ids, visible, **kwargs):
+    if not visible:
+        name_cache.forget_ids(ids)
+
+
+@receiver(post_delete, sender=Label)
+def forget_purged_label(sender, instance, **kwargs):
+    name_cache.forget_ids([instance.pk])
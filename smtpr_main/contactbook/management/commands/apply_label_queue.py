@@ -0,0 +1,27 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from contactbook import books, label_queue
+
+
+class Command(BaseCommand):
+    help = "Applies the add_label / remove_label mutations of the write-behind queue, once or every --interval"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, help="mutations per transaction, defaults to BATCH_SIZE")
+        parser.add_argument("--loop", action="store_true", help="keep running, one round every --interval")
+        parser.add_argument("--interval", type=float, help="seconds between rounds, defaults to INTERVAL")
+        parser.add_argument("--book", help="slug of the book, all the books without")
+
+    def handle(self, *args, **options):
+        interval = options["interval"] or label_queue.get_config()["INTERVAL"]
+        while True:
+            with books.book_option(options["book"]):
+                counts = label_queue.apply_pending(batch_size=options["batch_size"])
+            if counts["mutations"] or not options["loop"]:
+                self.stdout.write(json.dumps(counts))
+            if not options["loop"]:
+                return
+            time.sleep(interval)
@@ -0,0 +1,124 @@
+import asyncio
+import importlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import ThreadSensitiveContext
+from django.core.management.base import BaseCommand
+from django.db.backends.signals import connection_created
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import clear_url_caches, reverse
+
+from contactbook import urls
+from contactbook.benchmarks import temporary_database, generate_contacts, percentile
+
+# a cheap page and a slow unpaged listing, the one that pins a thread for long
+QUERIES = {
+    "page": "limit=100",
+    "label_page": "labels=label_0&limit=100",
+    "label_full": "labels=label_5",
+}
+
+
+def use_async_views(enabled):
+    # urls.py picks the views when it is imported
+    with override_settings(CONTACTBOOK_ASYNC_VIEWS=enabled):
+        importlib.reload(urls)
+    clear_url_caches()
+
+
+def add_latency(seconds):
+    """Makes every query on a new connection wait, like a database across the network would"""
+    def delay(execute, sql, params, many, context):
+        time.sleep(seconds)
+        return execute(sql, params, many, context)
+
+    def install(sender, connection, **kwargs):
+        if delay not in connection.execute_wrappers:
+            connection.execute_wrappers.append(delay)
+    connection_created.connect(install, weak=False)
+    return install
+
+
+def summary(latencies, wall):
+    latencies = sorted(latencies)
+    return (f"{len(latencies) / wall:.0f} req/s, p50 {percentile(latencies, 50) * 1000:.1f}ms "
+            f"p95 {percentile(latencies, 95) * 1000:.1f}ms p99 {percentile(latencies, 99) * 1000:.1f}ms")
+
+
+class Command(BaseCommand):
+    help = ("Concurrent contact/list requests through the WSGI handler (sync views, a thread pool like "
+            "gunicorn --threads) and through the ASGI handler (async views on one event loop, like uvicorn)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=20000)
+        parser.add_argument("--labels", type=int, default=50)
+        parser.add_argument("--requests", type=int, default=200, help="requests per query and mode")
+        parser.add_argument("--concurrency", type=int, default=32, help="clients sending requests back to back")
+        parser.add_argument("--threads", type=int, default=8, help="WSGI worker threads")
+        parser.add_argument("--db-latency-ms", type=float, default=0,
+                            help="added to every query; sqlite in-process never waits on I/O, a server does")
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        latency = add_latency(options["db_latency_ms"] / 1000) if options["db_latency_ms"] else None
+        try:
+            with override_settings(CONTACTBOOK_CACHE={"BACKEND": None},
+                                   CONTACTBOOK_METRICS={"ENABLED": False}), temporary_database():
+                self.stdout.write(f"generating {options['contacts']} contacts...")
+                generate_contacts(options["contacts"], options["labels"])
+                for name, query in QUERIES.items():
+                    path = reverse("contact_list") + "?" + query
+                    use_async_views(False)
+                    self.stdout.write(f"{name} wsgi: {self.run_wsgi(path, options)}")
+                    use_async_views(True)
+                    self.stdout.write(f"{name} asgi: {self.run_asgi(path, options)}")
+        finally:
+            use_async_views(False)
+            teardown_test_environment()
+            if latency:
+                connection_created.disconnect(latency)
+
+    def run_wsgi(self, path, options):
+        local = threading.local()
+
+        def one():
+            if not hasattr(local, "client"):
+                local.client = Client()
+            response = local.client.get(path)
+            assert response.status_code == 200, response.status_code
+
+        # every client waits for a free worker thread, like behind gunicorn --threads
+        with ThreadPoolExecutor(max_workers=options["threads"]) as workers, \
+                ThreadPoolExecutor(max_workers=options["concurrency"]) as clients:
+            def send(_):
+                started = time.perf_counter()
+                workers.submit(one).result()
+                return time.perf_counter() - started
+
+            started = time.perf_counter()
+            latencies = list(clients.map(send, range(options["requests"])))
+            wall = time.perf_counter() - started
+        return summary(latencies, wall)
+
+    def run_asgi(self, path, options):
+        async def main():
+            client = AsyncClient()
+            in_flight = asyncio.Semaphore(options["concurrency"])
+
+            async def one():
+                # ASGIHandler gives every request its own thread for the sync parts, AsyncClient doesn't
+                async with in_flight, ThreadSensitiveContext():
+                    started = time.perf_counter()
+                    response = await client.get(path)
+                    assert response.status_code == 200, response.status_code
+                    return time.perf_counter() - started
+
+            started = time.perf_counter()
+            latencies = await asyncio.gather(*(one() for _ in range(options["requests"])))
+            return latencies, time.perf_counter() - started
+
+        latencies, wall = asyncio.run(main())
+        return summary(latencies, wall)
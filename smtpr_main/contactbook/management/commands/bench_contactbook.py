@@ -0,0 +1,181 @@
+import json
+import platform
+import sqlite3
+import tempfile
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from contactbook.benchmarks import (temporary_database, generate_contacts, Scenario, run_scenario,
+                                    compare_to_baseline)
+from contactbook import exports, segments
+from contactbook.models import Label
+from contactbook.urls import urlpatterns
+
+
+def build_scenarios(n_contacts, n_labels, spare_label_ids, export_id):
+    """
+    Reads first, so they see the generated data only. Writes pick a fresh target per request,
+    label_del and segment_del delete the spare labels and segments one by one. export_id is a finished
+    export of the rare label. Segments come last: every contact write re-evaluates all of them.
+    """
+    common, second, rare = "label_0", f"label_{min(1, n_labels - 1)}", f"label_{n_labels - 1}"
+    spare_segment_ids = []
+
+    def create_spare_segments(count):
+        spare_segment_ids.extend(segments.create(f"bench_del_{i}", f"{rare} AND NOT {common}").id
+                                 for i in range(count))
+
+    return [
+        Scenario("list_page", "contact_list", query="limit=100"),
+        Scenario("list_common_label", "contact_list", query=f"labels={common}&limit=100"),
+        Scenario("list_rare_label", "contact_list", query=f"labels={rare}&limit=100"),
+        Scenario("list_and", "contact_list", query=f"labels={common},{second}&match=and&limit=100"),
+        Scenario("list_exclude", "contact_list", query=f"labels={common}&exclude={second}&limit=100"),
+        Scenario("list_emails_only", "contact_list", query=f"labels={common}&emails_only=1"),
+        # the same pages as list_page and list_common_label without the labels, compare queries and bytes
+        Scenario("list_fields_id_email", "contact_list", query="fields=id,email&limit=100"),
+        Scenario("list_fields_no_labels", "contact_list", query=f"labels={common}&fields=id,name,phone&limit=100"),
+        Scenario("list_stream_ndjson", "contact_list", query=f"labels={rare}&stream=1&format=ndjson"),
+        Scenario("export_status", "export_status", query=f"id={export_id}"),
+        Scenario("export_download", "export_download", query=f"id={export_id}"),
+        Scenario("changes", "changes", query="since=0&limit=500"),
+        Scenario("search_selective", "contact_search", query="q=rutger.hauer1"),
+        Scenario("search_common", "contact_search", query="q=bol.com"),
+        Scenario("facets_all", "contact_facets"),
+        Scenario("facets_common_label", "contact_facets", query=f"labels={common}"),
+        Scenario("facets_and", "contact_facets", query=f"labels={common},{second}&match=and"),
+        Scenario("duplicates_dry_run", "contact_duplicates"),
+        Scenario("segment_list", "segment_list"),
+        Scenario("label_list", "label_list"),
+        Scenario("label_list_counts", "label_list", query="with_counts=1"),
+        Scenario("label_queue_status", "label_queue_status"),
+        Scenario("cache_stats", "cache_stats"),
+        Scenario("admission_stats", "admission_stats"),
+        Scenario("metrics", "metrics"),
+        Scenario("debug_requests", "debug_requests"),  # a 403: staff only, and DEBUG is off here
+        Scenario("api_test_page", "api_test_page"),
+        Scenario("true_del", "true_del"),
+
+        Scenario("contact_create", "contact_create", method="POST",
+                 body=lambda n: {"name": f"Bench {n}", "email": f"bench{n}@smart.pr", "phone": "112"}),
+        Scenario("contact_bulk_create_100", "contact_bulk_create", method="POST", body=lambda n: [
+            {"name": f"Bulk {n} {i}", "email": f"bulk{n}.{i}@smart.pr", "phone": "112", "labels": [rare]}
+            for i in range(100)
+        ]),
+        # only the request, the jobs are left pending (WORKERS 0)
+        Scenario("contact_export", "contact_export", method="POST",
+                 body={"labels": [rare], "format": "csv", "compression": "gzip"}),
+        Scenario("label_create", "label_create", method="POST", body=lambda n: {"name": f"bench_label_{n}"}),
+        Scenario("add_label", "add_label", method="POST",
+                 body=lambda n: {"contact_id": n % n_contacts + 1, "labels": [second, "bench_added"]}),
+        Scenario("remove_label", "remove_label", method="POST",
+                 body=lambda n: {"contact_id": n % n_contacts + 1, "labels": ["bench_added"]}),
+        # alternates, otherwise every request after the first has nothing left to do
+        Scenario("batch_label_filter", "batch_label", method="POST", body=lambda n: {
+            "filter": {"labels": [rare]}, ("add" if n % 2 == 0 else "remove"): ["bench_batch"],
+        }),
+        Scenario("contact_del", "contact_del", query=lambda n: f"id={n_contacts - n}"),
+        Scenario("label_del", "label_del", query=lambda n: f"id={spare_label_ids[n]}"),
+        Scenario("segment_create", "segment_create", method="POST",
+                 body=lambda n: {"name": f"bench_{n}", "q": f"{common} AND {second}"}),
+        Scenario("segment_del", "segment_del", query=lambda n: f"id={spare_segment_ids[n]}",
+                 setup=create_spare_segments),
+    ]
+
+
+class Command(BaseCommand):
+    help = "Drives every contactbook URL in-process against synthetic data, reports latency percentiles as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=100000)
+        parser.add_argument("--labels", type=int, default=200, help="label cardinality")
+        parser.add_argument("--labels-per-contact", type=int, default=3)
+        parser.add_argument("--skew", type=float, default=1.0, help="zipf exponent of label popularity, 0 is even")
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--requests", type=int, default=50, help="timed requests per scenario")
+        parser.add_argument("--only", default="", help="comma separated scenario names")
+        parser.add_argument("--cache", action="store_true", help="keep the result cache on (off by default)")
+        parser.add_argument("--output", help="write the JSON report here instead of stdout")
+        parser.add_argument("--baseline", help="a previous JSON report to compare with")
+        parser.add_argument("--max-regression", type=float, default=20.0,
+                            help="p95 increase in percent that counts as a regression")
+        parser.add_argument("--fail-on-regression", action="store_true")
+
+    def handle(self, *args, **options):
+        if options["contacts"] < options["requests"] + 2 or options["labels"] < 2:
+            raise CommandError("need at least --requests + 2 contacts and 2 labels")
+        baseline = None
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)["scenarios"]
+
+        only = {name.strip() for name in options["only"].split(",") if name.strip()}
+        cache_settings = {} if options["cache"] else {"CONTACTBOOK_CACHE": {"BACKEND": None}}
+        # testserver as allowed host, and DEBUG off so queries aren't kept around
+        setup_test_environment(debug=False)
+        try:
+            with tempfile.TemporaryDirectory() as export_dir, \
+                    override_settings(CONTACTBOOK_EXPORTS={"DIR": export_dir, "WORKERS": 0}, **cache_settings), \
+                    temporary_database():
+                self.stderr.write(f"generating {options['contacts']} contacts, {options['labels']} labels...")
+                generate_contacts(options["contacts"], options["labels"], options["labels_per_contact"],
+                                  options["skew"], options["seed"])
+                spare = Label.objects.bulk_create(
+                    [Label(name=f"bench_del_{i}") for i in range(options["requests"] + 2)]
+                )
+                export = exports.create_job([f"label_{options['labels'] - 1}"], background=False)
+                exports.run(export.id)
+                scenarios = build_scenarios(options["contacts"], options["labels"], [label.id for label in spare],
+                                            export.id)
+                if only:
+                    scenarios = [s for s in scenarios if s.name in only]
+                else:
+                    covered = {s.url_name for s in scenarios}
+                    for pattern in urlpatterns:
+                        if pattern.name not in covered:
+                            self.stderr.write(f"warning: no scenario for {pattern.name}")
+
+                client = Client()
+                results = {}
+                for scenario in scenarios:
+                    results[scenario.name] = result = run_scenario(client, scenario, options["requests"])
+                    self.stderr.write(
+                        f"{scenario.name}: p50 {result['p50_ms']:.2f}ms p95 {result['p95_ms']:.2f}ms "
+                        f"p99 {result['p99_ms']:.2f}ms, {result['queries']} queries, "
+                        f"{result['peak_memory_kb']:.0f}KB peak, status {result['status']}"
+                    )
+        finally:
+            teardown_test_environment()
+
+        report = {
+            "meta": {
+                "contacts": options["contacts"],
+                "labels": options["labels"],
+                "labels_per_contact": options["labels_per_contact"],
+                "skew": options["skew"],
+                "seed": options["seed"],
+                "requests": options["requests"],
+                "cache": options["cache"],
+                "python": platform.python_version(),
+                "django": django.get_version(),
+                "sqlite": sqlite3.sqlite_version,
+            },
+            "scenarios": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            self.stdout.write(json.dumps(report, indent=2))
+
+        if baseline is not None:
+            lines, regressions = compare_to_baseline(results, baseline, options["max_regression"])
+            for line in lines:
+                self.stderr.write(line)
+            if regressions:
+                self.stderr.write("regressions: " + ", ".join(regressions))
+                if options["fail_on_regression"]:
+                    raise CommandError(f"{len(regressions)} scenario(s) regressed")
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from contactbook.benchmarks import temporary_database, generate_contacts, time_call
+from contactbook.label_index import LabelIndex
+from contactbook.models import Contact
+from contactbook.filters import filter_contacts
+
+
+class Command(BaseCommand):
+    help = "Compares the label index with the ORM joins for AND/OR filters on 1, 3 and 8 labels"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=100000)
+        parser.add_argument("--labels", type=int, default=20)
+        parser.add_argument("--labels-per-contact", type=int, default=6)
+        parser.add_argument("--skew", type=float, default=0.5)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        with temporary_database():
+            self.stdout.write(f"generating {options['contacts']} contacts...")
+            generate_contacts(options["contacts"], options["labels"],
+                              options["labels_per_contact"], options["skew"])
+            index = LabelIndex()
+
+            for match_mode in ("and", "or"):
+                for n_labels in (1, 3, 8):
+                    names = [f"label_{i}" for i in range(n_labels)]
+
+                    def orm():
+                        qs, _ = filter_contacts(Contact.objects.all(), names, match_mode)
+                        return list(qs.values_list("id", flat=True))
+
+                    index.clear()
+                    cold, _ = time_call(lambda: index.contact_ids(names, match_mode), repeat=1)
+                    orm_time, orm_ids = time_call(orm, options["repeat"])
+                    index_time, index_ids = time_call(lambda: index.contact_ids(names, match_mode),
+                                                      options["repeat"])
+                    assert sorted(orm_ids) == index_ids
+
+                    self.stdout.write(
+                        f"match={match_mode} labels={n_labels} rows={len(index_ids)}: "
+                        f"orm {orm_time * 1000:.1f}ms, index {index_time * 1000:.1f}ms "
+                        f"(cold {cold * 1000:.1f}ms), x{orm_time / max(index_time, 1e-9):.1f}"
+                    )
@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from contactbook.benchmarks import temporary_database, generate_contacts, time_call
+from contactbook.models import Contact
+from contactbook.search import search_contacts, fts_tokenizer
+
+# from very selective to matching a big part of the book
+QUERIES = ["rutger.hauer12345", "12345678", "tanaka99", "Rutger Hauer", "bol.com"]
+
+
+class Command(BaseCommand):
+    help = "Compares contact/search (FTS5) with a name/email/phone icontains scan"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=1000000)
+        parser.add_argument("--limit", type=int, default=20, help="page size, as contact/search would fetch")
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        limit = options["limit"]
+        with temporary_database():
+            self.stdout.write(f"generating {options['contacts']} contacts...")
+            generate_contacts(options["contacts"], n_labels=10, labels_per_contact=1)
+            self.stdout.write(f"tokenizer: {fts_tokenizer()}")
+
+            for q in QUERIES:
+                def scan():
+                    condition = Q(name__icontains=q) | Q(email__icontains=q) | Q(phone__icontains=q)
+                    return list(Contact.objects.filter(condition).order_by("id").values_list("id", flat=True)[:limit])
+
+                def fts():
+                    return search_contacts(Contact.objects.all(), q, limit)
+
+                scan_time, scan_ids = time_call(scan, options["repeat"])
+                fts_time, fts_ids = time_call(fts, options["repeat"])
+                self.stdout.write(
+                    f"q={q!r}: scan {scan_time * 1000:.1f}ms ({len(scan_ids)} rows), "
+                    f"fts {fts_time * 1000:.1f}ms ({len(fts_ids)} rows), x{scan_time / max(fts_time, 1e-9):.1f}"
+                )
@@ -0,0 +1,73 @@
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from contactbook import instrumentation, serialization
+from contactbook.benchmarks import temporary_database, generate_contacts, time_call
+from contactbook.instrumentation import JsonResponse
+from contactbook.models import Contact
+from contactbook.views import project, serialize_contact, serialize_fields
+
+
+class Command(BaseCommand):
+    help = "Compares the model + JsonResponse path of contact/list with the flat rows of serialization.py"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=100000)
+        parser.add_argument("--labels", type=int, default=50)
+        parser.add_argument("--labels-per-contact", type=int, default=3)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        n = options["contacts"]
+        with temporary_database():
+            self.stdout.write(f"generating {n} contacts...")
+            generate_contacts(n, options["labels"], options["labels_per_contact"])
+            qs = Contact.objects.order_by("id")
+
+            def models():
+                return JsonResponse([serialize_contact(c) for c in qs.prefetch_related("labels")], safe=False).content
+
+            def models_json():
+                with mock.patch.object(instrumentation, "orjson", None):
+                    return models()
+
+            def rows():
+                return serialization.encode_array(list(serialization.contact_rows(qs)))
+
+            variants = [("models + json", models_json)]
+            if instrumentation.orjson is not None:
+                variants.append(("models + orjson", models))
+            variants.append(("rows", rows))
+            baseline = None
+            for name, func in variants:
+                elapsed, body = time_call(func, options["repeat"])
+                baseline = baseline or elapsed
+                self.stdout.write(f"{name}: {elapsed * 1e6 / n:.1f}us/contact, {len(body)} bytes, "
+                                  f"x{baseline / elapsed:.1f}")
+
+            # where the time of the fast path goes
+            fetch_time, fetched = time_call(lambda: list(serialization.contact_rows(qs)), options["repeat"])
+            encode_time, _ = time_call(lambda: serialization.encode_array(fetched), options["repeat"])
+            self.stdout.write(f"rows: fetch {fetch_time * 1e6 / n:.1f}us/contact, "
+                              f"encode {encode_time * 1e6 / n:.1f}us/contact")
+
+            # fields=: what leaving columns and the labels out saves, on both paths
+            for fields in [None, ["id", "name", "phone"], ["id", "email"]]:
+                def projected_models():
+                    contacts = [serialize_fields(c, fields) for c in project(qs, fields)]
+                    return JsonResponse(contacts, safe=False).content
+
+                def projected_rows():
+                    rows = list(serialization.contact_rows(qs, fields))
+                    return serialization.encode_array(rows, serialization.row_encoder(fields))
+
+                for name, func in [("models", projected_models), ("rows", projected_rows)]:
+                    elapsed, body = time_call(func, options["repeat"])
+                    with CaptureQueriesContext(connection) as ctx:
+                        func()
+                    self.stdout.write(f"fields={','.join(fields or serialization.ALL_FIELDS)} {name}: "
+                                      f"{elapsed * 1e6 / n:.1f}us/contact, {len(ctx.captured_queries)} queries, "
+                                      f"{len(body)} bytes")
@@ -0,0 +1,120 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from contactbook.benchmarks import generate_contacts, percentile
+
+# what the sqlite backend does without any configuration
+PLAIN = {"OPTIONS": {}, "CONN_MAX_AGE": 0, "SQLITE": {"ENABLED": False}}
+TUNED = {"OPTIONS": {"transaction_mode": "IMMEDIATE"}, "CONN_MAX_AGE": 60, "SQLITE": {"ENABLED": True}}
+
+
+@contextmanager
+def database_file(mode):
+    """A freshly migrated sqlite file with the connection settings of mode, for every thread"""
+    directory = tempfile.mkdtemp()
+    config = connections.settings["default"]
+    old = {key: config.get(key) for key in ("NAME", "OPTIONS", "CONN_MAX_AGE")}
+    config.update(NAME=os.path.join(directory, "bench.sqlite3"), OPTIONS=mode["OPTIONS"],
+                  CONN_MAX_AGE=mode["CONN_MAX_AGE"])
+    connections["default"].close()
+    del connections["default"]  # the wrapper of this thread copied the old settings
+    try:
+        with override_settings(CONTACTBOOK_SQLITE=mode["SQLITE"]):
+            call_command("migrate", verbosity=0)
+            yield
+    finally:
+        connections.close_all()
+        del connections["default"]
+        config.update(old)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+class Command(BaseCommand):
+    help = ("Concurrent mixed contact/list reads and add_label/remove_label writes against an sqlite file, with "
+            "the plain sqlite settings and with the tuned ones (WAL, IMMEDIATE transactions, busy_timeout...)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=20000)
+        parser.add_argument("--labels", type=int, default=50)
+        parser.add_argument("--threads", type=int, default=8)
+        parser.add_argument("--seconds", type=float, default=10, help="per mode")
+        parser.add_argument("--write-ratio", type=float, default=0.2, help="share of the requests that write")
+
+    def handle(self, *args, **options):
+        setup_test_environment(debug=False)
+        results = {}
+        try:
+            with override_settings(CONTACTBOOK_CACHE={"BACKEND": None}, CONTACTBOOK_METRICS={"ENABLED": False}):
+                for name, mode in [("plain", PLAIN), ("tuned", TUNED)]:
+                    with database_file(mode):
+                        self.stdout.write(f"{name}: generating {options['contacts']} contacts...")
+                        generate_contacts(options["contacts"], options["labels"])
+                        connections.close_all()
+                        results[name] = self.run_mixed(options)
+                    self.stdout.write(f"{name}: {json.dumps(results[name])}")
+        finally:
+            teardown_test_environment()
+        plain, tuned = results["plain"], results["tuned"]
+        self.stdout.write(f"tuned/plain: x{tuned['requests_per_second'] / max(plain['requests_per_second'], 1):.2f} "
+                          f"throughput, errors {plain['errors']} -> {tuned['errors']}")
+
+    def run_mixed(self, options):
+        n_contacts = options["contacts"]
+        stop_at = time.perf_counter() + options["seconds"]
+        lock = threading.Lock()
+        latencies = {"read": [], "write": []}
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            client = Client(raise_request_exception=False)
+            while time.perf_counter() < stop_at:
+                if rng.random() < options["write_ratio"]:
+                    kind = "write"
+                    url = reverse(rng.choice(["add_label", "remove_label"]))
+                    body = {"contact_id": rng.randrange(n_contacts) + 1, "labels": ["bench_rw"]}
+                    started = time.perf_counter()
+                    response = client.post(url, data=json.dumps(body), content_type="application/json")
+                else:
+                    kind = "read"
+                    query = f"labels=label_{rng.randrange(5)}&limit=100"
+                    started = time.perf_counter()
+                    response = client.get(reverse("contact_list") + "?" + query)
+                elapsed = time.perf_counter() - started
+                with lock:
+                    if response.status_code == 200:
+                        latencies[kind].append(elapsed)
+                    else:
+                        errors.append(response.status_code)
+            connections.close_all()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options["threads"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - started
+
+        result = {"requests_per_second": round(sum(map(len, latencies.values())) / wall, 1), "errors": len(errors)}
+        for kind, values in latencies.items():
+            if not values:
+                continue
+            values.sort()
+            result[kind] = {"count": len(values), "p50_ms": round(percentile(values, 50) * 1000, 2),
+                            "p95_ms": round(percentile(values, 95) * 1000, 2)}
+        return result
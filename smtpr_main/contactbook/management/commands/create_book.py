@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from contactbook.models import Book
+
+
+class Command(BaseCommand):
+    help = ("Creates a book, the clients name it in the X-Contactbook-Book header. List it in "
+            "CONTACTBOOK_BOOK_DATABASES first when it gets a database of its own")
+
+    def add_arguments(self, parser):
+        parser.add_argument("slug")
+        parser.add_argument("--name", default="")
+
+    def handle(self, *args, **options):
+        books = Book.objects.using(DEFAULT_DB_ALIAS)
+        if books.filter(slug=options["slug"]).exists():
+            raise CommandError(f"book {options['slug']} exists already")
+        book = books.create(slug=options["slug"], name=options["name"])
+        self.stdout.write(f"book {book.slug}: {book.id}")
@@ -0,0 +1,25 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from contactbook import books, dedupe
+from contactbook.models import DEFAULT_BOOK_ID
+
+
+class Command(BaseCommand):
+    help = ("Finds contacts with the same email, or the same phone and name, and merges them: the oldest one "
+            "gets the labels of the others, which are soft deleted. Only reports without --merge")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--merge", action="store_true", help="merge, the default is a dry run")
+        parser.add_argument("--chunk-size", type=int, help="contacts per transaction, defaults to CHUNK_SIZE")
+        parser.add_argument("--country-code", help="of phone numbers without one, defaults to COUNTRY_CODE")
+        parser.add_argument("--book", help="slug of the book, defaults to the default one")
+
+    def handle(self, *args, **options):
+        if options["chunk_size"] is not None and options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        with books.use_book(options["book"] or DEFAULT_BOOK_ID):
+            report = dedupe.dedupe(dry_run=not options["merge"], chunk_size=options["chunk_size"],
+                                   country_code=options["country_code"])
+        self.stdout.write(json.dumps(report))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from contactbook import books, exports
+from contactbook.models import DEFAULT_BOOK_ID, ExportJob
+from contactbook.filters import parse_label_names
+
+
+class Command(BaseCommand):
+    help = ("Writes the contacts (or emails) of a label filter to a compressed CSV or NDJSON file, "
+            "or with --pending runs the jobs contact/export left for a worker")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--labels", default="", help="comma separated, as for contact/list")
+        parser.add_argument("--exclude", default="")
+        parser.add_argument("--match", default="or", choices=["or", "and"])
+        parser.add_argument("--emails-only", action="store_true")
+        parser.add_argument("--format", default="csv", choices=exports.FORMATS)
+        parser.add_argument("--compression", default="gzip", choices=exports.COMPRESSIONS)
+        parser.add_argument("--book", help="slug of the book to export, defaults to the default one")
+        parser.add_argument("--pending", action="store_true", help="run the pending jobs instead")
+
+    def handle(self, *args, **options):
+        if options["pending"]:
+            self.stdout.write(f"{exports.run_pending()} jobs run")
+            return
+        error = exports.check_options(options["format"], options["compression"])
+        if error:
+            raise CommandError(error)
+        with books.use_book(options["book"] or DEFAULT_BOOK_ID):
+            job = exports.create_job(parse_label_names(options["labels"]), parse_label_names(options["exclude"]),
+                                     options["match"], options["emails_only"], options["format"],
+                                     options["compression"], background=False)
+        exports.run(job.id)
+        job.refresh_from_db()
+        if job.status == ExportJob.FAILED:
+            raise CommandError(job.error)
+        self.stdout.write(f"{job.rows} rows, {job.size} bytes: {exports.file_path(job)}")
@@ -0,0 +1,46 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from contactbook import books, importer
+from contactbook.models import DEFAULT_BOOK_ID
+
+
+class Command(BaseCommand):
+    help = "Imports contacts from a JSON array, NDJSON or CSV file (use - for stdin)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=importer.FORMATS,
+                            help="defaults to the file extension, json for stdin")
+        parser.add_argument("--batch-size", type=int, default=importer.DEFAULT_BATCH_SIZE)
+        parser.add_argument("--book", help="slug of the book to import into, defaults to the default one")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        input_format = options["format"] or (path.rsplit(".", 1)[-1].lower() if "." in path else "json")
+        if input_format == "jsonl":
+            input_format = "ndjson"
+        if input_format not in importer.FORMATS:
+            raise CommandError(f"can't tell the format of {path}, use --format")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be positive")
+
+        with books.use_book(options["book"] or DEFAULT_BOOK_ID):
+            if path == "-":
+                report = importer.import_contacts(importer.iter_rows(sys.stdin.buffer, input_format),
+                                                  options["batch_size"])
+            else:
+                try:
+                    with open(path, "rb") as f:
+                        report = importer.import_contacts(importer.iter_rows(f, input_format),
+                                                          options["batch_size"])
+                except OSError as e:
+                    raise CommandError(str(e))
+
+        for error in report["errors"]:
+            self.stderr.write(f"row {error['row']}: {error['error']}")
+        self.stdout.write(json.dumps({k: v for k, v in report.items() if k != "errors"}))
+        if "fatal" in report:
+            raise CommandError(report["fatal"])
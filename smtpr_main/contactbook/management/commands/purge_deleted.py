@@ -0,0 +1,40 @@
+import json
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from contactbook import books, deletion
+
+
+class Command(BaseCommand):
+    help = "Hard deletes soft deleted contacts and labels in bounded batches, once or every --interval seconds"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=deletion.DEFAULT_BATCH_SIZE,
+                            help="rows per transaction")
+        parser.add_argument("--older-than-hours", type=float,
+                            help="grace period, defaults to settings.CONTACTBOOK_PURGE_AFTER_HOURS")
+        parser.add_argument("--max-batches", type=int, help="stop a round after this many batches")
+        parser.add_argument("--pause", type=float, default=0, help="seconds to sleep between batches")
+        parser.add_argument("--loop", action="store_true", help="keep running, one round every --interval")
+        parser.add_argument("--interval", type=float, default=24 * 60 * 60, help="seconds between rounds")
+        parser.add_argument("--book", help="slug of the book, all the books on default without")
+
+    def handle(self, *args, **options):
+        older_than = None
+        if options["older_than_hours"] is not None:
+            older_than = timedelta(hours=options["older_than_hours"])
+
+        while True:
+            with books.book_option(options["book"]):
+                counts = deletion.purge_deleted(
+                    batch_size=options["batch_size"],
+                    older_than=older_than,
+                    max_batches=options["max_batches"],
+                    pause=options["pause"],
+                )
+            self.stdout.write(json.dumps(counts))
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
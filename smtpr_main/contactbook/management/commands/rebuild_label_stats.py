@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from contactbook import books, label_stats
+from contactbook.models import LabelStat, LabelPairStat
+
+
+class Command(BaseCommand):
+    help = ("Counts the label counters of contact/facets and label/list?with_counts=1 again from the memberships, "
+            "after writes that went around memberships_changed (raw SQL, loaddata)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--book", help="slug of a book, counts everything in the database holding it")
+
+    def handle(self, *args, **options):
+        with books.book_option(options["book"]):
+            label_stats.rebuild()
+            self.stdout.write(f"{LabelStat.objects.count()} labels, {LabelPairStat.objects.count()} label pairs")
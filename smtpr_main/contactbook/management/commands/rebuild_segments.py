@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from contactbook import books, segments
+from contactbook.models import Segment
+
+
+class Command(BaseCommand):
+    help = ("Fills the saved segments again from their label expressions, after writes that went around the "
+            "signals (raw SQL, loaddata)")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--name", help="only this segment")
+        parser.add_argument("--book", help="slug of the book, all the books on default without")
+
+    def handle(self, *args, **options):
+        with books.book_option(options["book"]):
+            saved = Segment.objects.order_by("id")
+            if options["name"]:
+                saved = saved.filter(name=options["name"])
+            for segment in saved:
+                with books.use_book(segment.book_id):
+                    segments.rebuild(segment)
+                    self.stdout.write(f"{segment.name}: {segment.members.count()} contacts")
@@ -0,0 +1,24 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from contactbook import books, changes
+
+
+class Command(BaseCommand):
+    help = ("Deletes change log events older than the retention (CONTACTBOOK_CHANGES RETENTION_DAYS). Clients "
+            "syncing from a trimmed seq get a 410 and download the book again")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=float, help="defaults to RETENTION_DAYS")
+        parser.add_argument("--batch-size", type=int, default=changes.TRIM_BATCH_SIZE, help="rows per DELETE")
+        parser.add_argument("--book", help="slug of the book, all the books on default without")
+
+    def handle(self, *args, **options):
+        older_than = None
+        if options["older_than_days"] is not None:
+            older_than = timedelta(days=options["older_than_days"])
+        with books.book_option(options["book"]):
+            trimmed = changes.trim(older_than=older_than, batch_size=options["batch_size"])
+        self.stdout.write(json.dumps({"trimmed": trimmed}))
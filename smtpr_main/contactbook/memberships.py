@@ -0,0 +1,112 @@
+"""
+Set based writes on the Contact.labels through table, for many contacts at once.
+"""
+from django.db import transaction
+
+from . import books
+from .models import Contact
+from .signals import send_memberships_changed
+
+CHUNK_SIZE = 500  # contacts per transaction
+
+
+def chunked(ids, size=CHUNK_SIZE):
+    for start in range(0, len(ids), size):
+        yield ids[start:start + size]
+
+
+def iter_id_chunks(qs, size=CHUNK_SIZE):
+    """Walks the ids of a contact queryset in keyset pages, so it stays cheap however large it is."""
+    last_id = 0
+    qs = qs.order_by("id").values_list("id", flat=True)
+    while True:
+        chunk = list(qs.filter(id__gt=last_id)[:size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1]
+
+
+def existing_pairs(contact_ids, label_ids):
+    through = Contact.labels.through
+    return set(
+        through.objects.filter(contact_id__in=contact_ids, label_id__in=label_ids)
+        .values_list("contact_id", "label_id")
+    )
+
+
+def add_memberships(contact_ids, label_ids):
+    """Gives every contact every label, returns how many links were really added."""
+    through = Contact.labels.through
+    with transaction.atomic(using=books.db()):
+        existing = existing_pairs(contact_ids, label_ids)
+        new_pairs = [
+            (contact_id, label_id)
+            for contact_id in contact_ids
+            for label_id in label_ids
+            if (contact_id, label_id) not in existing
+        ]
+        through.objects.bulk_create(
+            [through(contact_id=contact_id, label_id=label_id) for contact_id, label_id in new_pairs],
+            ignore_conflicts=True,  # a concurrent writer may have added some meanwhile
+        )
+        send_memberships_changed("add", new_pairs)
+    return len(new_pairs)
+
+
+def remove_memberships(contact_ids, label_ids):
+    """Takes the labels away from every contact, returns how many links were really removed."""
+    through = Contact.labels.through
+    with transaction.atomic(using=books.db()):
+        links = through.objects.filter(contact_id__in=contact_ids, label_id__in=label_ids)
+        removed_pairs = list(links.values_list("contact_id", "label_id"))
+        if removed_pairs:
+            links.delete()
+        send_memberships_changed("remove", removed_pairs)
+    return len(removed_pairs)
+
+
+def add_pairs(pairs):
+    """Adds exactly these (contact_id, label_id) links, in the current transaction. Returns how many were new."""
+    through = Contact.labels.through
+    pairs = sorted(set(pairs))
+    new_pairs = []
+    for chunk in chunked(pairs):
+        existing = existing_pairs({contact_id for contact_id, _ in chunk}, {label_id for _, label_id in chunk})
+        new_pairs.extend(pair for pair in chunk if pair not in existing)
+    through.objects.bulk_create(
+        [through(contact_id=contact_id, label_id=label_id) for contact_id, label_id in new_pairs],
+        ignore_conflicts=True,
+    )
+    send_memberships_changed("add", new_pairs)
+    return len(new_pairs)
+
+
+def remove_pairs(pairs):
+    """Removes exactly these (contact_id, label_id) links, in the current transaction. Returns how many existed."""
+    through = Contact.labels.through
+    pairs = sorted(set(pairs))
+    removed_pairs = []
+    for chunk in chunked(pairs):
+        existing = existing_pairs({contact_id for contact_id, _ in chunk}, {label_id for _, label_id in chunk})
+        removed_pairs.extend(pair for pair in chunk if pair in existing)
+    by_label = {}
+    for contact_id, label_id in removed_pairs:
+        by_label.setdefault(label_id, []).append(contact_id)
+    for label_id, contact_ids in by_label.items():
+        for chunk in chunked(contact_ids):
+            through.objects.filter(label_id=label_id, contact_id__in=chunk).delete()
+    send_memberships_changed("remove", removed_pairs)
+    return len(removed_pairs)
+
+
+def apply_to_contacts(id_chunks, add_label_ids=(), remove_label_ids=()):
+    """Runs the changes chunk by chunk, each chunk in its own transaction. Returns the counts."""
+    counts = {"contacts": 0, "added": 0, "removed": 0}
+    for chunk in id_chunks:
+        counts["contacts"] += len(chunk)
+        if add_label_ids:
+            counts["added"] += add_memberships(chunk, list(add_label_ids))
+        if remove_label_ids:
+            counts["removed"] += remove_memberships(chunk, list(remove_label_ids))
+    return counts
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='deleted_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='deleted_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,55 @@
+from django.db import migrations
+
+FTS_TABLE = "contactbook_contact_fts"
+
+TRIGGERS = [
+    f"""CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON contactbook_contact BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, email, phone) VALUES (new.id, new.name, new.email, new.phone);
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON contactbook_contact BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, email, phone)
+        VALUES ('delete', old.id, old.name, old.email, old.phone);
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF name, email, phone ON contactbook_contact BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, email, phone)
+        VALUES ('delete', old.id, old.name, old.email, old.phone);
+        INSERT INTO {FTS_TABLE}(rowid, name, email, phone) VALUES (new.id, new.name, new.email, new.phone);
+    END""",
+]
+
+
+def create_fts(apps, schema_editor):
+    # FTS5 is sqlite only, other databases fall back to icontains, see contactbook/search.py
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return
+    if connection.Database.sqlite_version_info >= (3, 34, 0):
+        tokenize = "tokenize='trigram'"  # any fragment of 3+ characters matches
+    else:
+        tokenize = "tokenize='unicode61', prefix='2 3'"  # token prefixes only
+    schema_editor.execute(
+        f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(name, email, phone, "
+        f"content='contactbook_contact', content_rowid='id', {tokenize})"
+    )
+    for sql in TRIGGERS:
+        schema_editor.execute(sql)
+    schema_editor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def drop_fts(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for suffix in ("ai", "ad", "au"):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{suffix}")
+    schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0002_soft_delete'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts, drop_fts),
+    ]
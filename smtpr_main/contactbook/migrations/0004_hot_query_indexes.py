@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0003_contact_fts'),
+    ]
+
+    operations = [
+        # The through table is created by django, so no Meta.indexes for it. Label filters look up a
+        # label's contacts, with contact_id in the index they never have to visit the table.
+        migrations.RunSQL(
+            "CREATE INDEX contactbook_contact_labels_label_contact_idx "
+            "ON contactbook_contact_labels (label_id, contact_id)",
+            "DROP INDEX contactbook_contact_labels_label_contact_idx",
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['email', 'is_deleted'], name='contact_live_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(condition=models.Q(('is_deleted', True)), fields=['deleted_date'], name='contact_purge_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='label',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['id', 'name', 'is_deleted'], name='label_live_id_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='label',
+            index=models.Index(condition=models.Q(('is_deleted', True)), fields=['deleted_date'], name='label_purge_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.8 on 2026-10-18 16:46
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0004_hot_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelStat',
+            fields=[
+                ('label', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stat', serialize=False, to='contactbook.label')),
+                ('contact_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LabelPairStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contact_count', models.PositiveIntegerField(default=0)),
+                ('label', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contactbook.label')),
+                ('other', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contactbook.label')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('label', 'other'), name='label_pair_stat_unique')],
+            },
+        ),
+        # the counters of what is there already, the same queries as label_stats.rebuild()
+        migrations.RunSQL(
+            [
+                "INSERT INTO contactbook_labelstat (label_id, contact_count) "
+                "SELECT l.id, (SELECT COUNT(*) FROM contactbook_contact_labels cl "
+                "JOIN contactbook_contact c ON c.id = cl.contact_id WHERE cl.label_id = l.id AND NOT c.is_deleted) "
+                "FROM contactbook_label l",
+                "INSERT INTO contactbook_labelpairstat (label_id, other_id, contact_count) "
+                "SELECT a.label_id, b.label_id, COUNT(*) FROM contactbook_contact_labels a "
+                "JOIN contactbook_contact_labels b ON b.contact_id = a.contact_id AND b.label_id <> a.label_id "
+                "JOIN contactbook_contact c ON c.id = a.contact_id WHERE NOT c.is_deleted "
+                "GROUP BY a.label_id, b.label_id",
+            ],
+            migrations.RunSQL.noop,
+        ),
+    ]
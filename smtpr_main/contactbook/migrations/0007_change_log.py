@@ -0,0 +1,26 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0006_export_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('contact_created', 'contact_created'), ('contact_deleted', 'contact_deleted'), ('contact_restored', 'contact_restored'), ('label_created', 'label_created'), ('label_deleted', 'label_deleted'), ('label_restored', 'label_restored'), ('label_added', 'label_added'), ('label_removed', 'label_removed')], max_length=20)),
+                ('contact_id', models.BigIntegerField(blank=True, null=True)),
+                ('label_id', models.BigIntegerField(blank=True, null=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_date'], name='change_event_trim_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,104 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:06
+
+import importlib
+
+import contactbook.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+fts = importlib.import_module("contactbook.migrations.0003_contact_fts")
+
+
+def create_default_book(apps, schema_editor):
+    # everything there is so far goes into it, like whatever comes without a book later on
+    Book = apps.get_model("contactbook", "Book")
+    Book.objects.using(schema_editor.connection.alias).get_or_create(
+        id=contactbook.models.DEFAULT_BOOK_ID, defaults={"slug": "default", "name": "Default"})
+
+
+def recreate_fts_triggers(apps, schema_editor):
+    # sqlite adds the book column by copying contactbook_contact into a new table, the triggers of the FTS
+    # index went with the old one. The rowids stayed, the index itself is still right.
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for suffix in ("ai", "ad", "au"):
+        schema_editor.execute(f"DROP TRIGGER IF EXISTS {fts.FTS_TABLE}_{suffix}")
+    for sql in fts.TRIGGERS:
+        schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0007_change_log'),
+    ]
+
+    operations = [
+        # going back copies the table once more, the triggers are made again once that's done
+        migrations.RunPython(migrations.RunPython.noop, recreate_fts_triggers),
+        migrations.CreateModel(
+            name='Book',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(max_length=100, unique=True)),
+                ('name', models.CharField(blank=True, max_length=200)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('trimmed_seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_default_book, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='contact',
+            name='contact_live_email_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='label',
+            name='label_live_id_name_idx',
+        ),
+        migrations.AlterField(
+            model_name='label',
+            name='name',
+            field=models.CharField(max_length=100),
+        ),
+        migrations.AddField(
+            model_name='changeevent',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, db_index=False, default=contactbook.models.current_book_id, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='contactbook.book'),
+        ),
+        migrations.AddField(
+            model_name='contact',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, db_index=False, default=contactbook.models.current_book_id, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='contactbook.book'),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, db_index=False, default=contactbook.models.current_book_id, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='contactbook.book'),
+        ),
+        migrations.AddField(
+            model_name='label',
+            name='book',
+            field=models.ForeignKey(db_constraint=False, db_index=False, default=contactbook.models.current_book_id, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='contactbook.book'),
+        ),
+        migrations.AddIndex(
+            model_name='changeevent',
+            index=models.Index(fields=['book', 'id'], name='change_event_book_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(fields=['book', 'id'], name='contact_book_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['book', 'email', 'is_deleted'], name='contact_live_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='label',
+            index=models.Index(condition=models.Q(('is_deleted', False)), fields=['book', 'id', 'name', 'is_deleted'], name='label_live_id_name_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='label',
+            constraint=models.UniqueConstraint(fields=('book', 'name'), name='label_book_name_unique'),
+        ),
+        migrations.RunPython(recreate_fts_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:14
+
+import contactbook.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0008_books'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Segment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('query', models.TextField()),
+                ('key', models.TextField()),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('refreshed_date', models.DateTimeField(blank=True, null=True)),
+                ('book', models.ForeignKey(db_constraint=False, db_index=False, default=contactbook.models.current_book_id, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='contactbook.book')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SegmentMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='contactbook.contact')),
+                ('segment', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='members', to='contactbook.segment')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='segment',
+            index=models.Index(fields=['book', 'key'], name='segment_book_key_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='segment',
+            constraint=models.UniqueConstraint(fields=('book', 'name'), name='segment_book_name_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='segmentmember',
+            constraint=models.UniqueConstraint(fields=('segment', 'contact'), name='segment_member_unique'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:21
+
+import contactbook.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0009_segments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabelMutation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('add', 'add'), ('remove', 'remove')], max_length=10)),
+                ('contact_id', models.BigIntegerField()),
+                ('labels', models.JSONField(default=list)),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('applied', 'applied'), ('failed', 'failed')], default='queued', max_length=10)),
+                ('error', models.TextField(blank=True)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+                ('applied_date', models.DateTimeField(blank=True, null=True)),
+                ('book', models.ForeignKey(db_constraint=False, db_index=False, default=contactbook.models.current_book_id, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='contactbook.book')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 'queued')), fields=['book', 'id'], name='label_mutation_queued_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 17:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contactbook', '0010_label_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='started_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -1,19 +1,85 @@
+from contextvars import ContextVar
+
 from django.db import models
 
 # Create your models here.
 from django.db import models
 
+DEFAULT_BOOK_ID = 1  # created by migration 0008, for the clients that don't name a book
+
+# the Book of the request (books.BookMiddleware) or of books.use_book()
+_current_book = ContextVar("contactbook_book", default=None)
+
+
+def current_book_id():
+    book = _current_book.get()
+    return DEFAULT_BOOK_ID if book is None else book.id
+
+
+class BookManager(models.Manager):
+    """The rows of the current book. Outside of one (commands, workers) it's all of them."""
+
+    def get_queryset(self):
+        book = _current_book.get()
+        qs = super().get_queryset()
+        return qs if book is None else qs.filter(book_id=book.id)
+
+
+class ActiveManager(BookManager):
+    """Hides what has been deleted, manage.py purge_deleted removes it for real later on"""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(is_deleted=False)
+
+
+class Book(models.Model):
+    """One customer's address book. Where its rows live is up to books.BookRouter."""
+    slug = models.SlugField(max_length=100, unique=True)
+    name = models.CharField(max_length=200, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    # the newest change log event of the book trim_changes deleted, clients behind it have to start over
+    trimmed_seq = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.slug
+
+
+def book_field():
+    # no constraint: the rows of a book may live in another database than the book itself
+    return models.ForeignKey(Book, on_delete=models.DO_NOTHING, default=current_book_id, related_name="+",
+                             db_constraint=False, db_index=False)
+
+
 class Label(models.Model):
-    name = models.CharField(max_length=100, unique=True)
+    book = book_field()
+    name = models.CharField(max_length=100)
     created_date = models.DateTimeField(auto_now=True)
+    # instead of deleting right away we hide the 'deleted' ones and purge them after a while
     is_deleted = models.BooleanField(default=False)
-    # TODO:instead of deleting right away we hide the 'deleted' ones and detect & delete them every 24 hours
+    deleted_date = models.DateTimeField(null=True, blank=True)
+
+    objects = ActiveManager()
+    all_objects = BookManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["book", "name"], name="label_book_name_unique"),
+        ]
+        indexes = [
+            # label/list reads id and name of the live labels of a book straight from the index, is_deleted
+            # is in there too or sqlite would visit the table just to check the condition again
+            models.Index(fields=["book", "id", "name", "is_deleted"], condition=models.Q(is_deleted=False),
+                         name="label_live_id_name_idx"),
+            models.Index(fields=["deleted_date"], condition=models.Q(is_deleted=True),
+                         name="label_purge_idx"),
+        ]
 
     def __str__(self):
         return self.name
 
 
 class Contact(models.Model):
+    book = book_field()
     name = models.CharField(max_length=200)
     phone = models.CharField(max_length=32)
     email = models.EmailField()
@@ -24,6 +90,147 @@ class Contact(models.Model):
                                     blank=True)
 
     is_deleted = models.BooleanField(default=False)
+    deleted_date = models.DateTimeField(null=True, blank=True)
+
+    objects = ActiveManager()
+    all_objects = BookManager()
+
+    class Meta:
+        indexes = [
+            # the contacts of a book in id order, what every listing walks
+            models.Index(fields=["book", "id"], name="contact_book_idx"),
+            # emails_only: DISTINCT email of the live contacts, sorted and covered by the index
+            models.Index(fields=["book", "email", "is_deleted"], condition=models.Q(is_deleted=False),
+                         name="contact_live_email_idx"),
+            models.Index(fields=["deleted_date"], condition=models.Q(is_deleted=True),
+                         name="contact_purge_idx"),
+        ]
 
     def __str__(self):
         return self.name
+
+
+class LabelStat(models.Model):
+    """How many live contacts carry the label. Kept up to date by label_stats.py, in the writing transaction."""
+    label = models.OneToOneField(Label, on_delete=models.CASCADE, primary_key=True, related_name="stat")
+    contact_count = models.PositiveIntegerField(default=0)
+
+
+class LabelPairStat(models.Model):
+    """How many live contacts carry both labels, for the facets of a label. Stored both ways around."""
+    label = models.ForeignKey(Label, on_delete=models.CASCADE, related_name="+")
+    other = models.ForeignKey(Label, on_delete=models.CASCADE, related_name="+")
+    contact_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["label", "other"], name="label_pair_stat_unique"),
+        ]
+
+
+class ExportJob(models.Model):
+    """A contact/export request, written to a file by the workers of exports.py"""
+    PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+    STATUSES = [(s, s) for s in (PENDING, RUNNING, DONE, FAILED)]
+
+    book = book_field()
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    # labels, exclude, match and emails_only, as for contact/list
+    params = models.JSONField(default=dict)
+    file_format = models.CharField(max_length=10)
+    compression = models.CharField(max_length=10)
+    rows = models.PositiveBigIntegerField(default=0)
+    size = models.PositiveBigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    started_date = models.DateTimeField(null=True, blank=True)
+    finished_date = models.DateTimeField(null=True, blank=True)
+
+    objects = BookManager()
+
+
+class ChangeEvent(models.Model):
+    """One entry of the change log (changes.py), the id is the sequence number clients sync from"""
+    CONTACT_CREATED, CONTACT_DELETED, CONTACT_RESTORED = "contact_created", "contact_deleted", "contact_restored"
+    LABEL_CREATED, LABEL_DELETED, LABEL_RESTORED = "label_created", "label_deleted", "label_restored"
+    LABEL_ADDED, LABEL_REMOVED = "label_added", "label_removed"  # to / from a contact
+    ACTIONS = [(a, a) for a in (CONTACT_CREATED, CONTACT_DELETED, CONTACT_RESTORED, LABEL_CREATED,
+                                LABEL_DELETED, LABEL_RESTORED, LABEL_ADDED, LABEL_REMOVED)]
+
+    book = book_field()
+    action = models.CharField(max_length=20, choices=ACTIONS)
+    # plain ids, not foreign keys: the log outlives purged rows
+    contact_id = models.BigIntegerField(null=True, blank=True)
+    label_id = models.BigIntegerField(null=True, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    objects = BookManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["book", "id"], name="change_event_book_idx"),
+            models.Index(fields=["created_date"], name="change_event_trim_idx"),
+        ]
+
+
+class Segment(models.Model):
+    """A saved label expression (the q= language of query.py), its contacts are kept in SegmentMember"""
+    book = book_field()
+    name = models.CharField(max_length=100)
+    query = models.TextField()
+    # the expression in a canonical form (segments.key_of), what a contact/list filter is matched on
+    key = models.TextField()
+    created_date = models.DateTimeField(auto_now_add=True)
+    refreshed_date = models.DateTimeField(null=True, blank=True)
+
+    objects = BookManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["book", "name"], name="segment_book_name_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["book", "key"], name="segment_book_key_idx"),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
+class SegmentMember(models.Model):
+    """A live contact matching the expression of the segment. Kept up to date by segments.py."""
+    segment = models.ForeignKey(Segment, on_delete=models.CASCADE, related_name="members", db_index=False)
+    contact = models.ForeignKey(Contact, on_delete=models.CASCADE, related_name="+")
+
+    class Meta:
+        constraints = [
+            # the contacts of a segment, read in id order straight from the index
+            models.UniqueConstraint(fields=["segment", "contact"], name="segment_member_unique"),
+        ]
+
+
+class LabelMutation(models.Model):
+    """An add_label / remove_label taken in write-behind mode (label_queue.py), the id is its ticket"""
+    ADD, REMOVE = "add", "remove"
+    ACTIONS = [(a, a) for a in (ADD, REMOVE)]
+    QUEUED, APPLIED, FAILED = "queued", "applied", "failed"
+    STATUSES = [(s, s) for s in (QUEUED, APPLIED, FAILED)]
+
+    book = book_field()
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    # a plain id, not a foreign key: the contact is checked when the mutation is applied
+    contact_id = models.BigIntegerField()
+    labels = models.JSONField(default=list)  # names
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    error = models.TextField(blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    applied_date = models.DateTimeField(null=True, blank=True)
+
+    objects = BookManager()
+
+    class Meta:
+        indexes = [
+            # the queue: only the rows still waiting, oldest first
+            models.Index(fields=["book", "id"], name="label_mutation_queued_idx",
+                         condition=models.Q(status="queued")),
+        ]
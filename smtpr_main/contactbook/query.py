@@ -0,0 +1,339 @@
+"""
+The q= label expressions of contact/list: (vip OR partner) AND NOT unsubscribed.
+
+parse() turns the text into a tree of Label / Not / And / Or. plan() looks up how many contacts every label
+has (the LabelStat counters), estimates each node from those assuming the labels are independent, and
+compiles the tree into one SELECT on the contacts:
+
+- a driver, the most selective positive part, as "id IN (SELECT contact_id ... WHERE label_id IN (...))",
+  read from the (label_id, contact_id) index. For an AND of labels of a similar size one GROUP BY ... HAVING
+  COUNT over all of them is cheaper than probing every row of the smallest, the costs decide.
+- the rest as EXISTS / NOT EXISTS probes on the (contact_id, label_id) primary key, most selective first.
+
+Without a positive part (NOT spam) there's no driver and the contacts are scanned. explain=1 shows the plan.
+The counters only shape the plan, a label counted at 0 is still looked up: only labels that don't exist are
+left out.
+"""
+import math
+import re
+from functools import reduce
+
+from django.db.models import Count, Exists, Max, OuterRef, Q, Subquery
+
+from . import labels
+from .models import Contact, LabelStat
+
+MAX_QUERY_LENGTH = 2000
+MAX_TERMS = 64
+MAX_DEPTH = 32
+# a probe is a b-tree descent, reading on along the index is a step; what one costs in steps
+PROBE_COST = 4
+KEYWORDS = {"AND", "OR", "NOT"}
+TOKEN = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))')
+
+
+class QueryError(ValueError):
+    pass
+
+
+class Label:
+    def __init__(self, name):
+        self.name = name
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if not match:
+            raise QueryError(f"unexpected character at {position}")
+        opening, closing, quoted, word = match.groups()
+        if opening or closing:
+            tokens.append(opening or closing)
+        elif quoted is not None:
+            tokens.append(Label(re.sub(r"\\(.)", r"\1", quoted)))
+        elif word.upper() in KEYWORDS:
+            tokens.append(word.upper())
+        else:
+            tokens.append(Label(word))
+        position = match.end()
+    return tokens
+
+
+class Parser:
+    """expr := and (OR and)*, and := not (AND not)*, not := NOT not | ( expr ) | label"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expression(self):
+        children = [self.conjunction()]
+        while self.peek() == "OR":
+            self.take()
+            children.append(self.conjunction())
+        return children[0] if len(children) == 1 else Or(children)
+
+    def conjunction(self):
+        children = [self.negation()]
+        while self.peek() == "AND":
+            self.take()
+            children.append(self.negation())
+        return children[0] if len(children) == 1 else And(children)
+
+    def negation(self):
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise QueryError("q is nested too deep")
+        token = self.take()
+        if token == "NOT":
+            node = Not(self.negation())
+        elif token == "(":
+            node = self.expression()
+            if self.take() != ")":
+                raise QueryError("missing ')'")
+        elif isinstance(token, Label):
+            node = token
+        else:
+            raise QueryError("expected a label name, '(' or NOT" + ("" if token is None else f", got {describe(token)}"))
+        self.depth -= 1
+        return node
+
+
+def parse(text):
+    if len(text) > MAX_QUERY_LENGTH:
+        raise QueryError(f"q is longer than {MAX_QUERY_LENGTH} characters")
+    tokens = tokenize(text)
+    if not tokens:
+        raise QueryError("q is empty")
+    if sum(isinstance(token, Label) for token in tokens) > MAX_TERMS:
+        raise QueryError(f"q has more than {MAX_TERMS} labels")
+    parser = Parser(tokens)
+    node = parser.expression()
+    if parser.peek() is not None:
+        raise QueryError(f"unexpected {describe(parser.peek())}")
+    return flatten(node)
+
+
+def describe(token):
+    return f"label '{token.name}'" if isinstance(token, Label) else f"'{token}'"
+
+
+def flatten(node):
+    # a AND (b AND c) is one AND of three, which the planner can order freely
+    if isinstance(node, Not):
+        return Not(flatten(node.child))
+    if isinstance(node, (And, Or)):
+        children = []
+        for child in map(flatten, node.children):
+            children.extend(child.children if type(child) is type(node) else [child])
+        return type(node)(children)
+    return node
+
+
+def label_names(node):
+    if isinstance(node, Label):
+        return {node.name}
+    if isinstance(node, Not):
+        return label_names(node.child)
+    return set().union(*map(label_names, node.children))
+
+
+def has_not(node):
+    if isinstance(node, Label):
+        return False
+    if isinstance(node, Not):
+        return True
+    return any(map(has_not, node.children))
+
+
+def positive_label_names(node):
+    """The names whose contacts can be in the answer, the ones not under a NOT"""
+    if isinstance(node, Label):
+        return {node.name}
+    if isinstance(node, Not):
+        return set()
+    return set().union(*map(positive_label_names, node.children))
+
+
+class Step:
+    """A planned node: what it estimates to, and its children in the order they are applied"""
+
+    def __init__(self, node, estimate, children=(), label_id=None):
+        self.node = node
+        self.estimate = estimate
+        self.children = list(children)
+        self.label_id = label_id
+        self.role = None
+
+    @property
+    def op(self):
+        return type(self.node).__name__.lower()
+
+    def is_label_set(self):
+        # a label, or an OR of labels: one label_id IN (...) on the through table
+        return isinstance(self.node, Label) or (
+            isinstance(self.node, Or) and all(isinstance(child.node, Label) for child in self.children))
+
+    def label_ids(self):
+        return [self.label_id] if isinstance(self.node, Label) else [child.label_id for child in self.children]
+
+    def explain(self):
+        data = {"op": self.op, "estimate": round(self.estimate)}
+        if isinstance(self.node, Label):
+            data["name"] = self.node.name
+            data["label_id"] = self.label_id
+        if self.role:
+            data["role"] = self.role
+        if self.children:
+            data["children"] = [child.explain() for child in self.children]
+        return data
+
+
+class Plan:
+    def __init__(self, text, root, total, counts):
+        self.text = text
+        self.root = root
+        self.total = total
+        self.counts = counts
+        self.strategy = None
+        self.queryset = self.compile(Contact.objects.all())
+
+    def compile(self, qs):
+        root = self.root
+        if self.missing(root):
+            self.strategy = "empty"
+            return qs.none()
+        if root.is_label_set():
+            root.role = "driver"
+            self.strategy = "index"
+            return qs.filter(id__in=members(root.label_ids()))
+        if isinstance(root.node, And):
+            drivers = [child for child in root.children if child.is_label_set()]
+            if drivers:
+                return self.compile_and(qs, root, drivers)
+        self.strategy = "scan"
+        return qs.filter(condition(root))
+
+    def compile_and(self, qs, root, drivers):
+        smallest = min(drivers, key=lambda step: step.estimate)
+        terms = [child for child in root.children if isinstance(child.node, Label)]
+        probe_cost = smallest.estimate * (1 + PROBE_COST * (len(terms) - (smallest in terms)))
+        group_cost = sum(step.estimate for step in terms)
+        if len(terms) > 1 and group_cost < probe_cost:
+            self.strategy = "group_by"
+            for step in terms:
+                step.role = "group"
+            rest = [child for child in root.children if child not in terms]
+            qs = qs.filter(id__in=members_of_all([step.label_id for step in terms]))
+            root.children = terms + rest
+        else:
+            self.strategy = "index"
+            smallest.role = "driver"
+            rest = [child for child in root.children if child is not smallest]
+            qs = qs.filter(id__in=members(smallest.label_ids()))
+            root.children = [smallest] + rest
+        for child in rest:  # already ordered, the most selective first
+            child.role = "filter"
+            qs = qs.filter(condition(child))
+        return qs
+
+    def missing(self, step):
+        # only labels that don't exist make the answer empty for sure, the counters are estimates and may drift
+        if isinstance(step.node, Label):
+            return step.label_id is None
+        if isinstance(step.node, And):
+            return any(self.missing(child) for child in step.children)
+        if isinstance(step.node, Or):
+            return all(self.missing(child) for child in step.children)
+        return False
+
+    def explain(self):
+        return {
+            "q": self.text,
+            "strategy": self.strategy,
+            "estimated_rows": round(self.root.estimate),
+            "total_estimate": self.total,
+            "label_counts": self.counts,
+            "plan": self.root.explain(),
+            "sql": str(self.queryset.query) if self.strategy != "empty" else None,
+        }
+
+
+def members(label_ids):
+    through = Contact.labels.through
+    return Subquery(through.objects.filter(label_id__in=label_ids).values("contact_id"))
+
+
+def members_of_all(label_ids):
+    through = Contact.labels.through
+    return Subquery(through.objects.filter(label_id__in=label_ids).values("contact_id")
+                    .annotate(n=Count("label_id")).filter(n=len(label_ids)).values("contact_id"))
+
+
+def condition(step):
+    through = Contact.labels.through
+    if step.is_label_set():
+        ids = step.label_ids()
+        return Q(Exists(through.objects.filter(contact_id=OuterRef("id"), label_id__in=ids)))
+    if isinstance(step.node, Not):
+        return ~condition(step.children[0])
+    combine = (lambda a, b: a & b) if isinstance(step.node, And) else (lambda a, b: a | b)
+    return reduce(combine, map(condition, step.children))
+
+
+def estimate(node, ids, counts, total):
+    """Step tree with estimates, AND children the most selective first, OR children the largest first"""
+    if isinstance(node, Label):
+        label_id = ids.get(node.name)
+        return Step(node, counts.get(label_id, 0) if label_id else 0, label_id=label_id)
+    if isinstance(node, Not):
+        child = estimate(node.child, ids, counts, total)
+        return Step(node, max(total - child.estimate, 0), [child])
+    children = [estimate(child, ids, counts, total) for child in node.children]
+    shares = [min(child.estimate / total, 1) if total else 0 for child in children]
+    if isinstance(node, And):
+        children.sort(key=lambda step: step.estimate)
+        return Step(node, total * math.prod(shares), children)
+    # labels that don't exist add nothing, the ones counted at 0 stay: a counter is only an estimate
+    children = [child for child in children if child.label_id is not None or not isinstance(child.node, Label)]
+    children.sort(key=lambda step: -step.estimate)
+    if not children:  # only unknown labels
+        return Step(node, 0, [estimate(node.children[0], ids, counts, total)])
+    return Step(node, total * (1 - math.prod(1 - share for share in shares)), children)
+
+
+def plan(text, node=None):
+    """The Plan of q, node is parse(text) when that has been done already"""
+    node = node or parse(text)
+    ids = labels.resolve(label_names(node))
+    counts = dict(LabelStat.objects.filter(label_id__in=ids.values()).values_list("label_id", "contact_count"))
+    # the highest id is a cheap upper bound of the number of contacts, counting them is a full index scan
+    total = Contact.all_objects.aggregate(top=Max("id"))["top"] or 0
+    return Plan(text, estimate(node, ids, counts, total), total, {name: counts.get(i, 0) for name, i in ids.items()})
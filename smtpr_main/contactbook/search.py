@@ -0,0 +1,93 @@
+"""
+Search over contact name, email and phone.
+
+On sqlite this uses the FTS5 table of migration 0003 (trigram tokens when sqlite is recent enough), which
+the triggers there keep in sync with every write to contactbook_contact, bulk ones included. Results are
+ranked by bm25 (FTS5's rank), best first. Other databases, and fragments too short for trigrams, get an
+unranked icontains scan.
+"""
+import re
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from . import books
+
+FTS_TABLE = "contactbook_contact_fts"
+TRIGRAM_MIN_LENGTH = 3  # shorter fragments have no trigram to look up
+
+
+_tokenizer = {}
+
+
+def fts_tokenizer():
+    """ "trigram", "unicode61" or None when there is no FTS table"""
+    connection = connections[books.db()]
+    if connection.vendor != "sqlite":
+        return None
+    if connection.alias not in _tokenizer:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sql FROM sqlite_master WHERE name = %s", [FTS_TABLE])
+            row = cursor.fetchone()
+        if row is None:
+            _tokenizer[connection.alias] = None
+        else:
+            _tokenizer[connection.alias] = "trigram" if "trigram" in row[0] else "unicode61"
+    return _tokenizer[connection.alias]
+
+
+def quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def match_expression(q, tokenizer):
+    """The FTS5 query for q, None when the index can't answer it."""
+    if tokenizer == "trigram":
+        # every whitespace separated fragment must appear somewhere
+        terms = q.split()
+        if any(len(term) < TRIGRAM_MIN_LENGTH for term in terms):
+            return None
+        return " AND ".join(quote(term) for term in terms)
+    terms = re.findall(r"\w+", q)
+    if not terms:
+        return None
+    return " AND ".join(quote(term) + "*" for term in terms)
+
+
+def scan_filter(q):
+    condition = Q()
+    for term in q.split():
+        condition &= Q(name__icontains=term) | Q(email__icontains=term) | Q(phone__icontains=term)
+    return condition
+
+
+def search_contacts(qs, q, limit, after=None):
+    """
+    Up to limit (contact id, rank) tuples of the contacts in qs matching q, best first. rank is None
+    when q could not be answered from the index, the rows are then just ordered by id. after is the
+    last (id, rank) of the previous page.
+    """
+    match = match_expression(q, fts_tokenizer())
+    if match is None:
+        qs = qs.filter(scan_filter(q))
+        if after:
+            qs = qs.filter(id__gt=after[0])
+        return [(contact_id, None) for contact_id in qs.order_by("id").values_list("id", flat=True)[:limit]]
+
+    # The FTS table drives the query and bm25 is computed once per match. The label filters (and soft
+    # deletes) of qs are checked per match with a primary key lookup.
+    connection = connections[books.db()]
+    table = connection.ops.quote_name(FTS_TABLE)
+    per_match = qs.order_by().filter(id=RawSQL(f"{table}.rowid", ())).values("id")
+    filter_sql, filter_params = per_match.query.sql_with_params()
+    sql = f"SELECT rowid, rank FROM {table} WHERE {table} MATCH %s AND EXISTS ({filter_sql})"
+    params = [match, *filter_params]
+    if after:
+        sql += " AND (rank > %s OR (rank = %s AND rowid > %s))"
+        params += [after[1], after[1], after[0]]
+    sql += " ORDER BY rank, rowid LIMIT %s"
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [tuple(row) for row in cursor.fetchall()]
@@ -0,0 +1,205 @@
+"""
+Saved segments: a named label expression (the q= language of query.py) whose contacts are materialized in
+SegmentMember, so a hot filter like newsletter AND active is one range of the (segment, contact) index
+instead of the label JOINs on every contact/list.
+
+contact/list looks its filter up by the canonical form of the expression (key_of): labels=a,b&match=and,
+q=b AND a and a segment saved as "a AND b" are the same. When there is a segment the contacts come from
+its members and the answer says so in X-Contactbook-Segment.
+
+The members follow the writes, in the writing transaction, through the signals every write path sends
+already (memberships_changed, contacts_created, visibility_changed): the contacts a write touched are
+checked against the segments that use one of the labels it touched, and added or removed. Deleting or
+restoring a label changes a lot of contacts at once, the segments using it are rebuilt, one
+INSERT ... SELECT of the planned query. manage.py rebuild_segments does the same for all of them.
+"""
+import json
+from functools import lru_cache, reduce, wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef, Q, Subquery
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import books, labels, query
+from .memberships import chunked
+from .models import Contact, Label, Segment, SegmentMember
+from .signals import contacts_created, memberships_changed, visibility_changed
+
+HEADER = "X-Contactbook-Segment"
+
+
+class SegmentError(ValueError):
+    pass
+
+
+@lru_cache(maxsize=256)
+def parsed(text):
+    return query.parse(text)
+
+
+def key_of(node):
+    """The canonical form of an expression: AND / OR children sorted and without duplicates"""
+    if isinstance(node, query.Label):
+        return json.dumps(node.name)
+    if isinstance(node, query.Not):
+        return f"NOT({key_of(node.child)})"
+    keys = sorted({key_of(child) for child in node.children})
+    if len(keys) == 1:
+        return keys[0]
+    return f"{type(node).__name__.upper()}({','.join(keys)})"
+
+
+def filter_node(label_names, match_mode, exclude_names):
+    """The expression of a labels/match/exclude filter of contact/list, None without one"""
+    parts = []
+    if label_names:
+        positive = [query.Label(name) for name in label_names]
+        parts.append(positive[0] if len(positive) == 1 else
+                     query.And(positive) if match_mode == "and" else query.Or(positive))
+    parts.extend(query.Not(query.Label(name)) for name in exclude_names)
+    if not parts:
+        return None
+    return query.flatten(parts[0] if len(parts) == 1 else query.And(parts))
+
+
+def for_request(params):
+    """(id, name) of the segment answering the filter of contact/list params, None when there's none"""
+    node = params["query"]
+    if node is None:
+        node = filter_node(params["label_names"], params["match_mode"], params["exclude_names"])
+    if node is None or params["explain"]:
+        return None
+    return Segment.objects.filter(key=key_of(node)).values_list("id", "name").first()
+
+
+def contacts(segment_id):
+    return Contact.objects.filter(
+        id__in=Subquery(SegmentMember.objects.filter(segment_id=segment_id).values("contact_id")))
+
+
+def reports_segment(view):
+    """Sets X-Contactbook-Segment on the answers a segment served, the view leaves its name on the request"""
+    def report(request, response):
+        segment = getattr(request, "contactbook_segment", None)
+        if segment is not None:
+            response[HEADER] = segment
+        return response
+
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            return report(request, await view(request, *args, **kwargs))
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        return report(request, view(request, *args, **kwargs))
+    return wrapper
+
+
+def create(name, text):
+    """Saves the segment of the expression text and fills it. SegmentError for a bad name or expression."""
+    name = (name or "").strip()
+    if not name:
+        raise SegmentError("name is required")
+    try:
+        node = parsed(text.strip())
+    except query.QueryError as e:
+        raise SegmentError(f"invalid q: {e}")
+    with transaction.atomic(using=books.db()):
+        if Segment.objects.filter(name=name).exists():
+            raise SegmentError(f"segment {name} exists already")
+        segment = Segment.objects.create(name=name, query=text.strip(), key=key_of(node))
+        rebuild(segment)
+    segment.refresh_from_db()  # rebuild() set refreshed_date with an update
+    return segment
+
+
+def rebuild(segment):
+    """Fills the segment again from scratch, with the planned query of its expression"""
+    plan = query.plan(segment.query, parsed(segment.query))
+    connection = connections[books.db()]
+    with transaction.atomic(using=connection.alias):
+        SegmentMember.objects.filter(segment_id=segment.id).delete()
+        if plan.strategy != "empty":
+            sql, params = plan.queryset.values("id").query.sql_with_params()
+            table = connection.ops.quote_name(SegmentMember._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(f"INSERT INTO {table} (segment_id, contact_id) SELECT %s, id FROM ({sql})",
+                               [segment.id, *params])
+        Segment.objects.filter(id=segment.id).update(refreshed_date=timezone.now())
+
+
+def condition(node, ids):
+    # a contact at a time, every label an EXISTS on the (contact_id, label_id) key
+    if isinstance(node, query.Label):
+        if node.name not in ids:
+            return Q(pk__in=[])
+        through = Contact.labels.through
+        return Q(Exists(through.objects.filter(contact_id=OuterRef("id"), label_id=ids[node.name])))
+    if isinstance(node, query.Not):
+        return ~condition(node.child, ids)
+    combine = (lambda a, b: a & b) if isinstance(node, query.And) else (lambda a, b: a | b)
+    return reduce(combine, (condition(child, ids) for child in node.children))
+
+
+def refresh(contact_ids, label_ids=None):
+    """
+    Checks contact_ids against the segments using one of label_ids (all of them for None) and adds or
+    removes their memberships, in the current transaction
+    """
+    contact_ids = sorted(set(contact_ids))
+    if not contact_ids:
+        return
+    label_ids = None if label_ids is None else set(label_ids)
+    for segment_id, text in Segment.objects.values_list("id", "query"):
+        node = parsed(text)
+        ids = labels.resolve(query.label_names(node))
+        if label_ids is not None and not label_ids & set(ids.values()):
+            continue
+        for chunk in chunked(contact_ids):
+            matching = set(Contact.objects.filter(id__in=chunk).filter(condition(node, ids))
+                           .values_list("id", flat=True))
+            members = SegmentMember.objects.filter(segment_id=segment_id, contact_id__in=chunk)
+            current = set(members.values_list("contact_id", flat=True))
+            if current - matching:
+                members.filter(contact_id__in=current - matching).delete()
+            SegmentMember.objects.bulk_create([SegmentMember(segment_id=segment_id, contact_id=contact_id)
+                                               for contact_id in sorted(matching - current)], ignore_conflicts=True)
+
+
+def rebuild_using(label_ids):
+    """Rebuilds the segments whose expression names one of the labels"""
+    names = set(Label.all_objects.filter(id__in=label_ids).values_list("name", flat=True))
+    for segment in Segment.objects.all():
+        if query.label_names(parsed(segment.query)) & names:
+            rebuild(segment)
+
+
+@receiver(memberships_changed)
+def refresh_memberships(sender, action, pairs, **kwargs):
+    pairs = list(pairs)
+    refresh([contact_id for contact_id, _ in pairs], {label_id for _, label_id in pairs})
+
+
+@receiver(contacts_created)
+def refresh_created_contacts(sender, contact_ids, **kwargs):
+    # without labels they are only in the segments of a NOT, the labels they come with follow as memberships
+    refresh(contact_ids)
+
+
+@receiver(post_save, sender=Contact)
+def refresh_saved_contact(sender, instance, created, **kwargs):
+    if created:
+        refresh([instance.pk])
+
+
+@receiver(visibility_changed)
+def refresh_visibility(sender, ids, visible, **kwargs):
+    if sender is Contact:
+        refresh(ids)
+    elif sender is Label:
+        rebuild_using(ids)
@@ -0,0 +1,67 @@
+from django.db.models.signals import m2m_changed, pre_delete, post_delete
+from django.dispatch import Signal, receiver
+
+from .models import Contact
+
+# Sent whenever (contact, label) memberships appear or go away. Unlike m2m_changed it is also sent by
+# the bulk code paths which write the through table directly.
+# kwargs: action ("add" or "remove"), pairs (list of (contact_id, label_id) tuples)
+memberships_changed = Signal()
+
+# Sent by the bulk code paths which create contacts without post_save. kwargs: contact_ids
+contacts_created = Signal()
+
+# Sent by labels.py, which creates labels with bulk_create and so without post_save. kwargs: label_ids
+labels_created = Signal()
+
+# Sent when contacts or labels (sender) are soft deleted or restored. kwargs: ids, visible (bool)
+# For contacts memberships_changed is sent as well. A label keeps its memberships while it is deleted,
+# they are just hidden, so for labels this is the only signal.
+visibility_changed = Signal()
+
+
+def send_memberships_changed(action, pairs):
+    pairs = list(pairs)
+    if pairs:
+        memberships_changed.send(sender=Contact, action=action, pairs=pairs)
+
+
+def to_pairs(instance, reverse, pk_set):
+    if reverse:  # label.contacts.add(...)
+        return [(contact_id, instance.pk) for contact_id in pk_set]
+    return [(instance.pk, label_id) for label_id in pk_set]
+
+
+@receiver(m2m_changed, sender=Contact.labels.through)
+def bridge_m2m_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "post_add":
+        # Django already left out the ones that existed before
+        send_memberships_changed("add", to_pairs(instance, reverse, pk_set))
+
+    elif action in ("pre_remove", "pre_clear"):
+        # remove() reports whatever it was asked to remove, so we look up what really exists
+        column, other = ("label_id", "contact_id") if reverse else ("contact_id", "label_id")
+        existing = sender.objects.filter(**{column: instance.pk})
+        if action == "pre_remove":
+            existing = existing.filter(**{other + "__in": pk_set})
+        instance._contactbook_removed = list(existing.values_list("contact_id", "label_id"))
+
+    elif action in ("post_remove", "post_clear"):
+        send_memberships_changed("remove", getattr(instance, "_contactbook_removed", []))
+        instance._contactbook_removed = []
+
+
+@receiver(pre_delete, sender=Contact)
+def remember_contact_memberships(sender, instance, **kwargs):
+    # The cascade on the through table does not send m2m_changed. Soft deleted contacts have
+    # reported theirs already.
+    if instance.is_deleted:
+        return
+    instance._contactbook_removed = list(
+        Contact.labels.through.objects.filter(contact_id=instance.pk).values_list("contact_id", "label_id")
+    )
+
+
+@receiver(post_delete, sender=Contact)
+def forget_contact_memberships(sender, instance, **kwargs):
+    send_memberships_changed("remove", getattr(instance, "_contactbook_removed", []))
@@ -1,15 +1,42 @@
 from django.test import TestCase
 
 # Create your tests here.
+import gzip
+import io
 import json
-from django.test import TestCase, Client
+import math
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, AsyncRequestFactory, Client, RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from .models import Contact, Label
+from django.utils import timezone
+from . import admission, async_views, books, changes, conditional, dedupe, deletion, exports, filters, label_queue, label_stats, labels, query, \
+    segments, serialization, views
+from .benchmarks import Scenario, compare_to_baseline, percentile, run_scenario
+from .cache import get_result_cache
+from .database import ReadReplicaRouter, read_only_view
+from .instrumentation import metrics
+from . import label_index as label_index_module
+from .label_index import label_index, ids_to_bitmap, bitmap_to_ids
+from .models import Book, ChangeEvent, Contact, ExportJob, Label, LabelMutation, LabelStat, LabelPairStat, Segment, \
+    SegmentMember
+from .signals import labels_created
+from .views import serialize_contact
 
 
 class ContactAPITestCase(TestCase):
     def setUp(self):
         self.client = Client()
+        get_result_cache().clear()
 
     def test_contact_create_success(self):
         payload = {
@@ -243,6 +270,11 @@ class ContactAPITestCase(TestCase):
         self.assertEqual(data["deleted_id"], str(a_contact.id))
 
         self.assertEqual(Contact.objects.count(), 0)
+        # only hidden until it gets purged
+        self.assertTrue(Contact.all_objects.get(id=a_contact.id).is_deleted)
+
+        resp = self.client.get(f"/contactbook/contact/del?id={a_contact.id}")
+        self.assertEqual(resp.status_code, 400)
 
     def test_label_delete(self):
         a_label = Label.objects.create(name="temp")
@@ -255,3 +287,1707 @@ class ContactAPITestCase(TestCase):
         self.assertEqual(data["deleted_id"], str(a_label.id))
 
         self.assertEqual(Label.objects.count(), 0)
+
+    def test_contact_list_keyset_pagination(self):
+        label = Label.objects.create(name="friends")
+        contacts = [
+            Contact.objects.create(name=f"Contact {i}", email=f"c{i}@smart.pr", phone=str(i))
+            for i in range(5)
+        ]
+        for c in contacts[:3]:
+            c.labels.add(label)
+
+        resp = self.client.get("/contactbook/contact/list?limit=2")
+        self.assertEqual(resp.status_code, 200)
+        page1 = resp.json()
+        self.assertEqual([c["id"] for c in page1["results"]], [contacts[0].id, contacts[1].id])
+        self.assertIsNotNone(page1["next"])
+
+        resp = self.client.get(f"/contactbook/contact/list?limit=2&after={page1['next']}")
+        page2 = resp.json()
+        self.assertEqual([c["id"] for c in page2["results"]], [contacts[2].id, contacts[3].id])
+
+        resp = self.client.get(f"/contactbook/contact/list?limit=2&after={page2['next']}")
+        page3 = resp.json()
+        self.assertEqual([c["id"] for c in page3["results"]], [contacts[4].id])
+        self.assertIsNone(page3["next"])
+
+        # paging works together with the label filter
+        resp = self.client.get("/contactbook/contact/list?labels=friends&limit=2")
+        page = resp.json()
+        self.assertEqual(len(page["results"]), 2)
+        self.assertEqual(page["results"][0]["labels"], ["friends"])
+        resp = self.client.get(f"/contactbook/contact/list?labels=friends&limit=2&after={page['next']}")
+        self.assertEqual([c["id"] for c in resp.json()["results"]], [contacts[2].id])
+
+        # emails are paged on the email itself
+        resp = self.client.get("/contactbook/contact/list?emails_only=1&limit=3")
+        page = resp.json()
+        self.assertEqual(page["emails"], ["c0@smart.pr", "c1@smart.pr", "c2@smart.pr"])
+        resp = self.client.get(f"/contactbook/contact/list?emails_only=1&limit=3&after={page['next']}")
+        self.assertEqual(resp.json()["emails"], ["c3@smart.pr", "c4@smart.pr"])
+
+    def test_contact_list_pagination_bad_params(self):
+        self.assertEqual(self.client.get("/contactbook/contact/list?limit=abc").status_code, 400)
+        self.assertEqual(self.client.get("/contactbook/contact/list?limit=0").status_code, 400)
+        self.assertEqual(self.client.get("/contactbook/contact/list?after=nonsense").status_code, 400)
+        self.assertEqual(self.client.get("/contactbook/contact/list?format=ndjson").status_code, 400)
+
+    def test_contact_list_stream(self):
+        label = Label.objects.create(name="friends")
+        c1 = Contact.objects.create(name="Boss smart pr", email="a1@smart.pr", phone="111")
+        c2 = Contact.objects.create(name="Nice reporter", email="a2@nu.nl", phone="222")
+        c1.labels.add(label)
+
+        resp = self.client.get("/contactbook/contact/list?stream=1")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.streaming)
+        data = json.loads(b"".join(resp.streaming_content))
+        self.assertEqual([c["id"] for c in data], [c1.id, c2.id])
+        self.assertEqual(data[0]["labels"], ["friends"])
+
+        resp = self.client.get("/contactbook/contact/list?stream=1&format=ndjson")
+        self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+        lines = b"".join(resp.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)["email"] for line in lines], ["a1@smart.pr", "a2@nu.nl"])
+
+        resp = self.client.get("/contactbook/contact/list?stream=1&emails_only=1&labels=friends")
+        data = json.loads(b"".join(resp.streaming_content))
+        self.assertEqual(data, {"emails": ["a1@smart.pr"]})
+
+        empty = self.client.get("/contactbook/contact/list?stream=1&labels=nobody")
+        self.assertEqual(json.loads(b"".join(empty.streaming_content)), [])
+
+    def test_contact_bulk_create_json(self):
+        Label.objects.create(name="friends")
+        rows = [
+            {"name": "Rutger", "email": "rutger@smart.pr", "phone": "112", "labels": ["friends", "work"]},
+            {"name": "No email", "phone": "113"},
+            {"name": "Hiro", "email": "not an email", "phone": "114"},
+            {"name": "Jan", "email": "jan@smart.pr", "phone": "115", "labels": ["work"]},
+        ]
+        resp = self.client.post(
+            "/contactbook/contact/bulk_create?batch_size=1",
+            data=json.dumps(rows),
+            content_type="application/json",
+        )
+        self.assertEqual(resp.status_code, 200)
+        report = resp.json()
+        self.assertEqual(report["rows"], 4)
+        self.assertEqual(report["created"], 2)
+        self.assertEqual(report["failed"], 2)
+        self.assertEqual([e["row"] for e in report["errors"]], [2, 3])
+        self.assertIn("rows_per_second", report)
+
+        self.assertEqual(Label.objects.count(), 2)
+        rutger = Contact.objects.get(email="rutger@smart.pr")
+        self.assertCountEqual([a_label.name for a_label in rutger.labels.all()], ["friends", "work"])
+        self.assertEqual(Contact.objects.get(email="jan@smart.pr").labels.get().name, "work")
+
+    def test_contact_bulk_create_ndjson_and_csv(self):
+        ndjson = '{"name": "A", "email": "a@smart.pr", "phone": "1"}\nnot json\n\n' \
+                 '{"name": "B", "email": "b@smart.pr", "phone": "2", "labels": ["x"]}\n'
+        resp = self.client.post("/contactbook/contact/bulk_create", data=ndjson,
+                                content_type="application/x-ndjson")
+        report = resp.json()
+        self.assertEqual((report["created"], report["failed"]), (2, 1))
+
+        csv_body = 'name,email,phone,labels\nC,c@smart.pr,3,"x,y"\nD,d@smart.pr,4,\n'
+        resp = self.client.post("/contactbook/contact/bulk_create", data=csv_body, content_type="text/csv")
+        self.assertEqual(resp.json()["created"], 2)
+        self.assertCountEqual([a_label.name for a_label in Contact.objects.get(name="C").labels.all()],
+                              ["x", "y"])
+        self.assertEqual(Label.objects.count(), 2)
+
+        resp = self.client.post("/contactbook/contact/bulk_create", data='[{"name": "E", "email": "e@smart.pr"',
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn("fatal", resp.json())
+
+        resp = self.client.post("/contactbook/contact/bulk_create?format=xml", data="",
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+    def test_contact_bulk_create_queries_per_batch(self):
+        rows = [{"name": f"N{i}", "email": f"n{i}@smart.pr", "phone": str(i), "labels": ["x"]} for i in range(100)]
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.post("/contactbook/contact/bulk_create", data=json.dumps(rows),
+                                    content_type="application/json")
+        self.assertEqual(resp.json()["created"], 100)
+        # nothing per row: the book of the contacts isn't looked up again for every one
+        self.assertFalse([q for q in ctx.captured_queries if "contactbook_book" in q["sql"]])
+        self.assertLess(len(ctx.captured_queries), 30)
+
+    def test_import_contacts_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write("name,email,phone,labels\nC,c@smart.pr,3,friends\nD,,4,\n")
+        self.addCleanup(os.remove, f.name)
+        out, err = io.StringIO(), io.StringIO()
+        call_command("import_contacts", f.name, "--batch-size", "10", stdout=out, stderr=err)
+        self.assertEqual(json.loads(out.getvalue())["created"], 1)
+        self.assertIn("row 2", err.getvalue())
+        self.assertEqual(Contact.objects.get().labels.get().name, "friends")
+
+    def test_batch_label(self):
+        friends = Label.objects.create(name="friends")
+        contacts = [
+            Contact.objects.create(name=f"Contact {i}", email=f"c{i}@smart.pr", phone=str(i))
+            for i in range(4)
+        ]
+        contacts[0].labels.add(friends)
+
+        resp = self.client.post(
+            "/contactbook/contact/batch_label",
+            data=json.dumps({"contact_ids": [contacts[0].id, contacts[1].id, 999999], "add": ["friends", "vip"]}),
+            content_type="application/json",
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json(), {"contacts": 2, "added": 3, "removed": 0})
+        self.assertCountEqual([a_label.name for a_label in contacts[1].labels.all()], ["friends", "vip"])
+
+        # everyone with friends AND vip loses friends and becomes a partner
+        resp = self.client.post(
+            "/contactbook/contact/batch_label",
+            data=json.dumps({"filter": {"labels": "friends,vip", "match": "and"},
+                             "add": ["partner"], "remove": ["friends"]}),
+            content_type="application/json",
+        )
+        self.assertEqual(resp.json(), {"contacts": 2, "added": 2, "removed": 2})
+        self.assertEqual(friends.contacts.count(), 0)
+        self.assertEqual(Label.objects.get(name="partner").contacts.count(), 2)
+        self.assertEqual(contacts[2].labels.count(), 0)
+
+    def test_batch_label_bad_requests(self):
+        def post(payload):
+            return self.client.post("/contactbook/contact/batch_label", data=json.dumps(payload),
+                                    content_type="application/json").status_code
+
+        self.assertEqual(post({"contact_ids": [1]}), 400)
+        self.assertEqual(post({"add": ["x"]}), 400)
+        self.assertEqual(post({"contact_ids": [1], "filter": {"labels": "x"}, "add": ["x"]}), 400)
+        self.assertEqual(post({"contact_ids": "1", "add": ["x"]}), 400)
+        self.assertEqual(post({"filter": {"labels": "x", "match": "xor"}, "add": ["y"]}), 400)
+        self.assertEqual(post({"contact_ids": [1], "add": ["x"], "remove": ["x"]}), 400)
+
+    def test_soft_deleted_rows_are_hidden(self):
+        friends = Label.objects.create(name="friends")
+        work = Label.objects.create(name="work")
+        c1 = Contact.objects.create(name="Boss smart pr", email="a1@smart.pr", phone="111")
+        c2 = Contact.objects.create(name="Nice reporter", email="a2@nu.nl", phone="222")
+        c1.labels.add(friends, work)
+        c2.labels.add(friends)
+
+        self.client.get(f"/contactbook/contact/del?id={c2.id}")
+        self.client.get(f"/contactbook/label/del?id={work.id}")
+
+        data = self.client.get("/contactbook/contact/list").json()
+        self.assertEqual([(c["id"], c["labels"]) for c in data], [(c1.id, ["friends"])])
+        self.assertEqual(self.client.get("/contactbook/contact/list?labels=friends").json()[0]["id"], c1.id)
+        self.assertEqual(self.client.get("/contactbook/contact/list?labels=work").json(), [])
+        self.assertEqual(len(self.client.get("/contactbook/contact/list?labels=friends&exclude=work").json()), 1)
+        self.assertEqual([a_label["name"] for a_label in self.client.get("/contactbook/label/list").json()],
+                         ["friends"])
+
+        # using the name again brings the label back, with its contacts
+        resp = self.client.post("/contactbook/label/create", data=json.dumps({"name": "work"}),
+                                content_type="application/json")
+        self.assertEqual(resp.json(), {"id": work.id, "name": "work", "created": False})
+        self.assertEqual([c["id"] for c in self.client.get("/contactbook/contact/list?labels=work").json()],
+                         [c1.id])
+
+    def test_purge_deleted(self):
+        friends = Label.objects.create(name="friends")
+        contacts = [
+            Contact.objects.create(name=f"Contact {i}", email=f"c{i}@smart.pr", phone=str(i))
+            for i in range(5)
+        ]
+        for c in contacts:
+            c.labels.add(friends)
+        self.client.get(f"/contactbook/contact/del?id={contacts[0].id}")
+        self.client.get(f"/contactbook/label/del?id={friends.id}")
+
+        # still within the grace period
+        out = io.StringIO()
+        call_command("purge_deleted", stdout=out)
+        self.assertEqual(json.loads(out.getvalue())["contacts"], 0)
+        self.assertEqual(Contact.all_objects.count(), 5)
+
+        # the label's 4 remaining links go 3 per batch, then the label itself
+        out = io.StringIO()
+        call_command("purge_deleted", "--older-than-hours", "0", "--batch-size", "3", stdout=out)
+        self.assertEqual(json.loads(out.getvalue()), {"contacts": 1, "labels": 1, "links": 5, "batches": 4})
+        self.assertEqual(Contact.all_objects.count(), 4)
+        self.assertEqual(Label.all_objects.count(), 0)
+        self.assertEqual(Contact.labels.through.objects.count(), 0)
+
+        resp = self.client.get("/contactbook/true_del")
+        self.assertEqual(resp.json()["batches"], 0)
+
+    def test_contact_search(self):
+        friends = Label.objects.create(name="friends")
+        c1 = Contact.objects.create(name="Rutger Hauer", email="rutger@smart.pr", phone="+31 6 1234")
+        c2 = Contact.objects.create(name="Hiro", email="hiro@smart.pr", phone="+81 90 5678")
+        c3 = Contact.objects.create(name="Rutger Jansen", email="jansen@bol.com", phone="112")
+        c3.labels.add(friends)
+
+        def search(query):
+            resp = self.client.get("/contactbook/contact/search?" + query)
+            self.assertEqual(resp.status_code, 200)
+            return resp.json()
+
+        self.assertCountEqual([c["id"] for c in search("q=rutger")["results"]], [c1.id, c3.id])
+        self.assertEqual([c["id"] for c in search("q=smart.pr%20hiro")["results"]], [c2.id])
+        self.assertEqual([c["id"] for c in search("q=1234")["results"]], [c1.id])
+        self.assertEqual(search("q=rutger&labels=friends")["results"][0]["labels"], ["friends"])
+        self.assertEqual([c["id"] for c in search("q=rutger&exclude=friends")["results"]], [c1.id])
+        # too short for trigrams, scanned instead
+        self.assertEqual([c["id"] for c in search("q=90")["results"]], [c2.id])
+
+        # paged in rank order
+        page1 = search("q=smart&limit=1")
+        page2 = search(f"q=smart&limit=1&after={page1['next']}")
+        self.assertCountEqual([page1["results"][0]["id"], page2["results"][0]["id"]], [c1.id, c2.id])
+        self.assertIsNone(page2["next"])
+
+        # the index follows updates and deletes
+        Contact.objects.filter(id=c2.id).update(name="Hironobu")
+        self.assertEqual([c["id"] for c in search("q=hironobu")["results"]], [c2.id])
+        self.client.get(f"/contactbook/contact/del?id={c2.id}")
+        self.assertEqual(search("q=hironobu")["results"], [])
+        self.assertEqual(self.client.get("/contactbook/contact/search").status_code, 400)
+
+
+@override_settings(CONTACTBOOK_LABEL_INDEX=True)
+class LabelIndexTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        label_index.clear()
+        get_result_cache().clear()
+        self.friends = Label.objects.create(name="friends")
+        self.work = Label.objects.create(name="work")
+        self.bff = Label.objects.create(name="bff")
+        self.c1 = Contact.objects.create(name="Boss smart pr", email="a1@smart.pr", phone="111")
+        self.c2 = Contact.objects.create(name="Nice reporter", email="a2@nu.nl", phone="222")
+        self.c3 = Contact.objects.create(name="Bol boss", email="a3@bol.com", phone="333")
+        self.c1.labels.add(self.friends)
+        self.c2.labels.add(self.work, self.bff)
+        self.c3.labels.add(self.friends, self.work)
+
+    def ids(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return [c["id"] for c in resp.json()]
+
+    def test_bitmap_roundtrip(self):
+        self.assertEqual(bitmap_to_ids(ids_to_bitmap([0, 7, 8, 1000, 3])), [0, 3, 7, 8, 1000])
+        self.assertEqual(bitmap_to_ids(0), [])
+
+    def test_changes_during_a_load_are_kept(self):
+        index = type(label_index)()
+        real = label_index_module.ids_to_bitmap
+
+        def load_while_written(ids):
+            label_index_module.ids_to_bitmap = real  # apply() builds its deltas with it too
+            bitmap = real(ids)  # read before the changes below committed
+            index.apply("add", [(self.c2.id, self.friends.id)])
+            index.apply("remove", [(self.c1.id, self.friends.id)])
+            return bitmap
+
+        label_index_module.ids_to_bitmap = load_while_written
+        try:
+            loaded = index.bitmap(self.friends.id)
+        finally:
+            label_index_module.ids_to_bitmap = real
+        self.assertEqual(bitmap_to_ids(loaded), [self.c2.id, self.c3.id])
+        self.assertEqual(bitmap_to_ids(index.bitmap(self.friends.id)), [self.c2.id, self.c3.id])
+
+    def test_and_or_not(self):
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=friends"), [self.c1.id, self.c3.id])
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=friends,work&match=and"), [self.c3.id])
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=friends,bff&match=or"),
+                         [self.c1.id, self.c2.id, self.c3.id])
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=work&exclude=bff"), [self.c3.id])
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=work,nothing&match=and"), [])
+
+        resp = self.client.get("/contactbook/contact/list?labels=work&emails_only=1")
+        self.assertEqual(resp.json(), {"emails": ["a2@nu.nl", "a3@bol.com"]})
+
+        resp = self.client.get("/contactbook/contact/list?labels=friends,work&limit=1")
+        page = resp.json()
+        self.assertEqual([c["id"] for c in page["results"]], [self.c1.id])
+        resp = self.client.get(f"/contactbook/contact/list?labels=friends,work&limit=5&after={page['next']}")
+        self.assertEqual([c["id"] for c in resp.json()["results"]], [self.c2.id, self.c3.id])
+
+    def test_fresh_bitmap_leaves_out_soft_deleted_contacts(self):
+        c4 = Contact.objects.create(name="New friend", email="a4@smart.pr", phone="444")
+        c4.labels.add(self.friends)
+        deletion.soft_delete(Contact, [self.c1.id])
+        label_index.clear()
+        self.assertEqual(bitmap_to_ids(label_index.bitmap(self.friends.id)), [self.c3.id, c4.id])
+
+        page = self.client.get("/contactbook/contact/list?labels=friends&limit=1").json()
+        self.assertEqual([c["id"] for c in page["results"]], [self.c3.id])
+        self.assertIsNotNone(page["next"])
+        page = self.client.get(f"/contactbook/contact/list?labels=friends&limit=1&after={page['next']}").json()
+        self.assertEqual([c["id"] for c in page["results"]], [c4.id])
+
+    def test_index_follows_writes(self):
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=bff"), [self.c2.id])  # loads the bitmap
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                "/contactbook/contact/add_label",
+                data=json.dumps({"contact_id": self.c1.id, "labels": ["bff"]}),
+                content_type="application/json",
+            )
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=bff"), [self.c1.id, self.c2.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                "/contactbook/contact/remove_label",
+                data=json.dumps({"contact_id": self.c2.id, "labels": ["bff"]}),
+                content_type="application/json",
+            )
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=bff"), [self.c1.id])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.c1.delete()
+        self.assertEqual(self.ids("/contactbook/contact/list?labels=bff"), [])
+
+
+class ResultCacheTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        get_result_cache().clear()
+        self.friends = Label.objects.create(name="friends")
+        self.work = Label.objects.create(name="work")
+        self.c1 = Contact.objects.create(name="Boss smart pr", email="a1@smart.pr", phone="111")
+        self.c2 = Contact.objects.create(name="Nice reporter", email="a2@nu.nl", phone="222")
+        self.c1.labels.add(self.friends)
+        self.c2.labels.add(self.work)
+
+    def get(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    def test_hit_and_normalized_key(self):
+        self.assertEqual(self.get("/contactbook/contact/list?labels=friends,work")["X-Contactbook-Cache"], "miss")
+        resp = self.get("/contactbook/contact/list?labels=work,%20friends&match=OR")
+        self.assertEqual(resp["X-Contactbook-Cache"], "hit")
+        self.assertEqual(len(resp.json()), 2)
+        self.assertEqual(get_result_cache().stats()["hits"], 1)
+
+        resp = self.client.get("/contactbook/cache/stats")
+        self.assertEqual(resp.json()["misses"], 1)
+
+    def test_targeted_invalidation(self):
+        self.get("/contactbook/contact/list?labels=friends")
+        self.get("/contactbook/contact/list?labels=work")
+        self.get("/contactbook/contact/list")
+
+        # a new contact only changes the unfiltered listing
+        Contact.objects.create(name="Bol boss", email="a3@bol.com", phone="333")
+        self.assertEqual(self.get("/contactbook/contact/list")["X-Contactbook-Cache"], "miss")
+        self.assertEqual(self.get("/contactbook/contact/list?labels=friends")["X-Contactbook-Cache"], "hit")
+
+        # labelling c2 as friend changes friends, and work too since c2's labels show up there
+        self.client.post(
+            "/contactbook/contact/add_label",
+            data=json.dumps({"contact_id": self.c2.id, "labels": ["friends"]}),
+            content_type="application/json",
+        )
+        resp = self.get("/contactbook/contact/list?labels=friends")
+        self.assertEqual(resp["X-Contactbook-Cache"], "miss")
+        self.assertEqual(len(resp.json()), 2)
+        resp = self.get("/contactbook/contact/list?labels=work")
+        self.assertEqual(resp["X-Contactbook-Cache"], "miss")
+        self.assertCountEqual(resp.json()[0]["labels"], ["work", "friends"])
+
+        self.get("/contactbook/contact/list?labels=work")
+        self.client.get(f"/contactbook/contact/del?id={self.c2.id}")
+        self.assertEqual(self.get("/contactbook/contact/list?labels=work").json(), [])
+
+    def test_exclude_only_listing_sees_new_contacts(self):
+        self.assertEqual(len(self.get("/contactbook/contact/list?exclude=friends").json()), 1)
+        self.client.post("/contactbook/contact/create",
+                         data=json.dumps({"name": "Bol boss", "email": "a3@bol.com", "phone": "333"}),
+                         content_type="application/json")
+        resp = self.get("/contactbook/contact/list?exclude=friends")
+        self.assertEqual(resp["X-Contactbook-Cache"], "miss")
+        self.assertEqual(len(resp.json()), 2)
+
+    def test_label_list(self):
+        self.assertEqual(len(self.get("/contactbook/label/list").json()), 2)
+        self.assertEqual(self.get("/contactbook/label/list")["X-Contactbook-Cache"], "hit")
+        self.client.get(f"/contactbook/label/del?id={self.work.id}")
+        self.assertEqual(len(self.get("/contactbook/label/list").json()), 1)
+
+    def test_lru_eviction(self):
+        with override_settings(CONTACTBOOK_CACHE={"BACKEND": "locmem", "MAX_ENTRIES": 2}):
+            self.get("/contactbook/contact/list?labels=friends")
+            self.get("/contactbook/contact/list?labels=work")
+            self.get("/contactbook/contact/list?labels=friends")  # friends is now the most recent
+            self.get("/contactbook/contact/list")  # pushes out work
+            stats = get_result_cache().stats()
+            self.assertEqual((stats["evictions"], stats["entries"]), (1, 2))
+            self.assertEqual(self.get("/contactbook/contact/list?labels=friends")["X-Contactbook-Cache"], "hit")
+            self.assertEqual(self.get("/contactbook/contact/list?labels=work")["X-Contactbook-Cache"], "miss")
+
+    def test_django_cache_backend(self):
+        config = {"BACKEND": "django", "ALIAS": "default"}
+        with override_settings(CONTACTBOOK_CACHE=config):
+            get_result_cache().clear()
+            self.assertEqual(self.get("/contactbook/label/list")["X-Contactbook-Cache"], "miss")
+            self.assertEqual(self.get("/contactbook/label/list")["X-Contactbook-Cache"], "hit")
+            Label.objects.create(name="new")
+            resp = self.get("/contactbook/label/list")
+            self.assertEqual(resp["X-Contactbook-Cache"], "miss")
+            self.assertEqual(len(resp.json()), 3)
+
+    def test_disabled(self):
+        with override_settings(CONTACTBOOK_CACHE={"BACKEND": None}):
+            self.assertNotIn("X-Contactbook-Cache", self.get("/contactbook/label/list"))
+
+
+class LabelResolutionTestCase(TestCase):
+    def setUp(self):
+        labels.name_cache.clear()
+        self.addCleanup(labels.name_cache.clear)
+        self.friends = Label.objects.create(name="friends")
+        self.work = Label.objects.create(name="work")
+
+    def test_a_batch_is_one_query(self):
+        with self.assertNumQueries(1):
+            ids = labels.resolve([" friends", "work ", "friends", "", "nope"])
+        self.assertEqual(ids, {"friends": self.friends.id, "work": self.work.id})
+
+        deletion.soft_delete(Label, [self.work.id])
+        # look up, see which are there now, insert the missing ones in a savepoint, read their ids back, log them
+        with self.assertNumQueries(7):
+            ids = labels.resolve(["friends", "new", "newer"], create=True)
+        self.assertEqual(set(ids), {"friends", "new", "newer"})
+        ids = labels.resolve(["work"], create=True)
+        self.assertEqual(ids, {"work": self.work.id})
+        self.assertFalse(Label.all_objects.get(id=self.work.id).is_deleted)
+
+    def test_concurrent_creators_share_the_winner(self):
+        # the other request inserted "friends" after our lookup missed it
+        sent = []
+        receiver = lambda sender, label_ids, **kwargs: sent.extend(label_ids)  # noqa: E731
+        labels_created.connect(receiver)
+        self.addCleanup(labels_created.disconnect, receiver)
+        ids = labels.create_missing(["friends", "vip"])
+        self.assertEqual(ids["friends"], self.friends.id)
+        self.assertEqual(Label.objects.filter(name__in=["friends", "vip"]).count(), 2)
+        self.assertEqual(sent, [ids["vip"]])  # only the one inserted here is new
+
+    def test_insert_between_the_reads_is_retried(self):
+        vip = Label.objects.create(name="vip")  # by the other request, after our first read
+        sent = []
+        receiver = lambda sender, label_ids, **kwargs: sent.extend(label_ids)  # noqa: E731
+        labels_created.connect(receiver)
+        self.addCleanup(labels_created.disconnect, receiver)
+        real = Label.all_objects.filter
+
+        def stale_read(**kwargs):
+            del Label.all_objects.filter  # once
+            return real(name__in=[])
+
+        Label.all_objects.filter = stale_read
+        self.addCleanup(lambda: Label.all_objects.__dict__.pop("filter", None))
+        ids = labels.create_missing(["vip", "new"])
+        self.assertEqual(ids["vip"], vip.id)
+        self.assertEqual(sent, [ids["new"]])
+
+    def test_name_cache(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            labels.resolve(["friends", "work"])
+        with self.assertNumQueries(0):
+            self.assertEqual(labels.resolve(["friends"]), {"friends": self.friends.id})
+        deletion.soft_delete(Label, [self.friends.id])
+        self.assertEqual(labels.resolve(["friends", "work"]), {"work": self.work.id})
+
+    def test_endpoints_normalize_the_same_way(self):
+        contact = Contact.objects.create(name="Boss smart pr", email="a1@smart.pr", phone="111")
+
+        def post(url, names):
+            return self.client.post(url, data=json.dumps({"contact_id": contact.id, "labels": names}),
+                                    content_type="application/json")
+
+        self.assertEqual(post("/contactbook/contact/add_label", [" friends ", "vip", " "]).json()["labels"],
+                         ["friends", "vip"])
+        self.assertEqual(post("/contactbook/contact/remove_label", ["friends  ", " vip"]).json()["labels"], [])
+        self.assertEqual(post("/contactbook/contact/add_label", [" "]).status_code, 400)
+        resp = self.client.post("/contactbook/label/create", data=json.dumps({"name": "  "}),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 400)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class LabelStatsTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.friends = Label.objects.create(name="friends")
+        self.work = Label.objects.create(name="work")
+        self.contacts = [
+            Contact.objects.create(name=f"Contact {i}", email=f"c{i}@smart.pr", phone=str(i))
+            for i in range(4)
+        ]
+
+    def post(self, url, data):
+        resp = self.client.post(url, data=json.dumps(data), content_type="application/json")
+        self.assertEqual(resp.status_code, 200)
+        return resp
+
+    def counters(self):
+        return (
+            {row["label_id"]: row["contact_count"] for row in LabelStat.objects.values() if row["contact_count"]},
+            {(row["label_id"], row["other_id"]): row["contact_count"] for row in LabelPairStat.objects.values()},
+        )
+
+    def assertCountersAreExact(self):
+        kept = self.counters()
+        label_stats.rebuild()
+        self.assertEqual(kept, self.counters())
+
+    def test_counters_follow_every_write(self):
+        c0, c1, c2, c3 = self.contacts
+        self.post("/contactbook/contact/add_label", {"contact_id": c0.id, "labels": ["friends", "work", "vip"]})
+        self.post("/contactbook/contact/add_label", {"contact_id": c1.id, "labels": ["friends", "work"]})
+        self.assertCountersAreExact()
+        vip = Label.objects.get(name="vip")
+        self.assertEqual(LabelStat.objects.get(label=self.friends).contact_count, 2)
+        self.assertEqual(LabelPairStat.objects.get(label=self.friends, other=vip).contact_count, 1)
+
+        self.post("/contactbook/contact/remove_label", {"contact_id": c0.id, "labels": ["work", "vip"]})
+        self.assertCountersAreExact()
+        self.assertFalse(LabelPairStat.objects.filter(label=self.friends, other=vip).exists())
+
+        self.post("/contactbook/contact/batch_label", {"contact_ids": [c1.id, c2.id, c3.id], "add": ["vip"],
+                                                       "remove": ["friends"]})
+        self.assertCountersAreExact()
+        self.post("/contactbook/contact/bulk_create", [
+            {"name": "Rutger", "email": "rutger@smart.pr", "phone": "112", "labels": ["friends", "vip"]},
+        ])
+        self.assertCountersAreExact()
+
+        self.client.get(f"/contactbook/contact/del?id={c1.id}")
+        self.assertCountersAreExact()
+        self.assertEqual(LabelStat.objects.get(label=self.work).contact_count, 0)
+        deletion.restore(Contact, [c1.id])
+        self.assertCountersAreExact()
+        self.assertEqual(LabelStat.objects.get(label=self.work).contact_count, 1)
+
+        # a deleted label keeps its counters, it is just hidden
+        self.client.get(f"/contactbook/label/del?id={vip.id}")
+        self.assertCountersAreExact()
+        deletion.restore(Label, [vip.id])
+        self.assertCountersAreExact()
+
+        c3.labels.clear()
+        self.assertCountersAreExact()
+        self.client.get(f"/contactbook/label/del?id={vip.id}")
+        self.client.get(f"/contactbook/contact/del?id={c0.id}")
+        deletion.purge_deleted(older_than=timedelta(0))
+        self.assertCountersAreExact()
+        self.assertFalse(LabelPairStat.objects.filter(other=vip).exists())
+
+    def test_label_list_with_counts(self):
+        self.contacts[0].labels.add(self.friends)
+        self.contacts[1].labels.add(self.friends)
+        Contact.objects.get(id=self.contacts[1].id).delete()
+        resp = self.client.get("/contactbook/label/list?with_counts=1")
+        self.assertEqual(resp.json(), [
+            {"id": self.friends.id, "name": "friends", "contacts": 1},
+            {"id": self.work.id, "name": "work", "contacts": 0},
+        ])
+        self.assertNotIn("contacts", self.client.get("/contactbook/label/list").json()[0])
+
+    def test_facets(self):
+        c0, c1, c2, c3 = self.contacts
+        vip = Label.objects.create(name="vip")
+        c0.labels.add(self.friends, self.work)
+        c1.labels.add(self.friends, self.work, vip)
+        c2.labels.add(self.friends)
+        c3.labels.add(vip)
+
+        def facets(query=""):
+            resp = self.client.get("/contactbook/contact/facets" + query)
+            self.assertEqual(resp.status_code, 200)
+            data = resp.json()
+            return data["source"], data["total"], [(f["name"], f["contacts"]) for f in data["facets"]]
+
+        self.assertEqual(facets(), ("counters", 4, [("friends", 3), ("work", 2), ("vip", 2)]))
+        self.assertEqual(facets("?labels=friends"), ("counters", 3, [("work", 2), ("vip", 1)]))
+        self.assertEqual(facets("?labels=nope"), ("counters", 0, []))
+        self.assertEqual(facets("?labels=friends,work&match=and"), ("query", 2, [("vip", 1)]))
+        self.assertEqual(facets("?labels=work,vip"), ("query", 3, [("friends", 2)]))
+        self.assertEqual(facets("?labels=friends&exclude=vip"), ("query", 2, [("work", 1)]))
+
+        # both ways hide deleted labels and contacts
+        self.client.get(f"/contactbook/label/del?id={self.work.id}")
+        self.client.get(f"/contactbook/contact/del?id={c3.id}")
+        self.assertEqual(facets("?labels=friends"), ("counters", 3, [("vip", 1)]))
+        self.assertEqual(facets("?labels=friends,vip"), ("query", 3, []))
+        self.assertEqual(self.client.get("/contactbook/contact/facets?match=xor&labels=a").status_code, 400)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class LabelQueryTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        names = ["vip", "partner", "unsubscribed", "press"]
+        self.labels = {name: Label.objects.create(name=name) for name in names}
+        # contact i has label k when bit k of i is set
+        self.contacts = []
+        for i in range(16):
+            c = Contact.objects.create(name=f"Contact {i}", email=f"c{i}@smart.pr", phone=str(i))
+            c.labels.add(*[self.labels[name] for k, name in enumerate(names) if i >> k & 1])
+            self.contacts.append(c)
+
+    def ids(self, q):
+        resp = self.client.get("/contactbook/contact/list", {"q": q})
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return [c["id"] for c in resp.json()]
+
+    def expected(self, test):
+        return [c.id for i, c in enumerate(self.contacts) if test(i)]
+
+    def test_parse(self):
+        node = query.parse('vip or partner AND NOT ("unsubscribed" OR press)')
+        self.assertIsInstance(node, query.Or)
+        self.assertIsInstance(node.children[1], query.And)
+        self.assertEqual(query.label_names(node), {"vip", "partner", "unsubscribed", "press"})
+        self.assertEqual(query.positive_label_names(node), {"vip", "partner"})
+        self.assertEqual(len(query.parse("vip AND (partner AND press)").children), 3)
+        self.assertEqual(query.parse(r'"new \"york\" (office)"').name, 'new "york" (office)')
+        for bad in ["(vip", "vip AND", "vip partner", ")", "NOT", "vip OR OR press"]:
+            with self.subTest(q=bad), self.assertRaises(query.QueryError):
+                query.parse(bad)
+
+    def test_results(self):
+        vip, partner, unsubscribed, press = (lambda i, k=k: bool(i >> k & 1) for k in range(4))
+        cases = {
+            "vip": vip,
+            "(vip OR partner) AND NOT unsubscribed": lambda i: (vip(i) or partner(i)) and not unsubscribed(i),
+            "vip AND partner AND press": lambda i: vip(i) and partner(i) and press(i),
+            "NOT vip AND NOT press": lambda i: not vip(i) and not press(i),
+            "vip AND (partner OR NOT press)": lambda i: vip(i) and (partner(i) or not press(i)),
+            "nope OR press": press,
+            "nope AND press": lambda i: False,
+            "NOT nope AND press": press,
+        }
+        for q, test in cases.items():
+            with self.subTest(q=q):
+                self.assertEqual(self.ids(q), self.expected(test))
+
+        # deleted labels don't match, deleted contacts don't show up
+        self.client.get(f"/contactbook/label/del?id={self.labels['press'].id}")
+        self.client.get(f"/contactbook/contact/del?id={self.contacts[1].id}")
+        self.assertEqual(self.ids("vip OR press"), self.expected(lambda i: vip(i) and i != 1))
+
+    def test_drifted_counters_only_change_the_plan(self):
+        empty = Label.objects.create(name="empty")
+        # written past the signals, the counter of "empty" stays at 0
+        Contact.labels.through.objects.create(contact=self.contacts[0], label=empty)
+        self.assertEqual(LabelStat.objects.filter(label=empty, contact_count__gt=0).count(), 0)
+        self.assertEqual(self.ids("empty"), [self.contacts[0].id])
+        self.assertEqual(self.ids("empty OR vip"), self.expected(lambda i: i == 0 or i & 1))
+        self.assertEqual(self.ids("empty AND NOT vip"), [self.contacts[0].id])
+
+    def test_explain_picks_the_most_selective_driver(self):
+        resp = self.client.get("/contactbook/contact/list", {"q": "NOT unsubscribed AND (vip OR press) AND partner",
+                                                             "explain": "1"})
+        plan = resp.json()
+        self.assertEqual(plan["label_counts"]["vip"], 8)
+        self.assertEqual(plan["strategy"], "index")
+        self.assertEqual(plan["estimated_rows"], 3)
+        children = plan["plan"]["children"]
+        self.assertEqual([(c["op"], c.get("name"), c["role"]) for c in children],
+                         [("label", "partner", "driver"), ("not", None, "filter"), ("or", None, "filter")])
+        self.assertEqual([c["estimate"] for c in children], [8, 8, 12])
+        self.assertIn("EXISTS", plan["sql"])
+
+        # two labels of a similar size are cheaper to group than to probe
+        plan = self.client.get("/contactbook/contact/list", {"q": "vip AND partner", "explain": "1"}).json()
+        self.assertEqual(plan["strategy"], "group_by")
+        self.assertEqual(self.ids("vip AND partner"), self.expected(lambda i: i & 3 == 3))
+
+    def test_bad_requests(self):
+        for params in [{"q": "vip AND"}, {"q": "vip", "labels": "vip"}, {"explain": "1"}]:
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get("/contactbook/contact/list", params).status_code, 400)
+
+    def test_cached_answers_follow_contacts_matched_by_not(self):
+        with override_settings(CONTACTBOOK_CACHE={"BACKEND": "locmem"}):
+            get_result_cache().clear()
+            before = self.ids("NOT vip")
+            Contact.objects.create(name="New", email="new@smart.pr", phone="1")
+            self.assertEqual(len(self.ids("NOT vip")), len(before) + 1)
+
+    def test_facets_and_async_view(self):
+        resp = self.client.get("/contactbook/contact/facets", {"q": "vip AND NOT partner"})
+        data = resp.json()
+        self.assertEqual((data["source"], data["total"]), ("query", 4))
+        self.assertEqual({f["name"]: f["contacts"] for f in data["facets"]}, {"unsubscribed": 2, "press": 2})
+
+        request = AsyncRequestFactory().get("/", {"q": "vip AND NOT partner"})
+        response = async_to_sync(async_views.contact_list)(request)
+        self.assertEqual([c["id"] for c in json.loads(response.content)], self.expected(lambda i: i & 3 == 1))
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class ChangeLogTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.friends = Label.objects.create(name="friends")
+        self.contact = Contact.objects.create(name="Old", email="old@smart.pr", phone="1")
+        self.contact.labels.add(self.friends)
+
+    def changes(self, **params):
+        resp = self.client.get("/contactbook/changes", params)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        return resp.json()
+
+    def actions(self, page):
+        return [(c["action"], c.get("contact_id"), c.get("label_id")) for c in page["changes"]]
+
+    def post(self, url, data):
+        return self.client.post(url, data=json.dumps(data), content_type="application/json")
+
+    def test_writes_are_logged(self):
+        start = self.changes()
+        self.assertEqual(start["changes"], [])
+
+        new_id = self.post("/contactbook/contact/create", {"name": "New", "email": "n@smart.pr", "phone": "2"}).json()["id"]
+        self.post("/contactbook/contact/add_label", {"contact_id": new_id, "labels": ["friends", "vip"]})
+        self.post("/contactbook/contact/remove_label", {"contact_id": self.contact.id, "labels": ["friends"]})
+        vip = Label.objects.get(name="vip")
+
+        page = self.changes(since=start["next"])
+        self.assertEqual(self.actions(page), [
+            ("contact_created", new_id, None),
+            ("label_created", None, vip.id),
+            ("label_added", new_id, self.friends.id),
+            ("label_added", new_id, vip.id),
+            ("label_removed", self.contact.id, self.friends.id),
+        ])
+        # what the created contact and label look like now, no other request needed
+        self.assertEqual(page["contacts"], [{"id": new_id, "name": "New", "email": "n@smart.pr", "phone": "2",
+                                             "labels": ["friends", "vip"]}])
+        self.assertEqual(page["labels"], [{"id": vip.id, "name": "vip"}])
+        self.assertEqual((page["next"], page["more"]), (page["changes"][-1]["seq"], False))
+        self.assertEqual(self.changes(since=page["next"])["changes"], [])
+
+    def test_a_deleted_contact_is_one_event(self):
+        start = self.changes()["next"]
+        self.client.get(f"/contactbook/contact/del?id={self.contact.id}")
+        self.client.get(f"/contactbook/label/del?id={self.friends.id}")
+        deletion.restore(Contact, [self.contact.id])
+        self.assertEqual(self.actions(self.changes(since=start)), [
+            ("contact_deleted", self.contact.id, None),
+            ("label_deleted", None, self.friends.id),
+            ("label_added", self.contact.id, self.friends.id),
+            ("contact_restored", self.contact.id, None),
+        ])
+
+    def test_paging_and_errors(self):
+        first = self.changes(since=0, limit=2)
+        self.assertEqual([c["action"] for c in first["changes"]], ["label_created", "contact_created"])
+        self.assertTrue(first["more"])
+        rest = self.changes(since=first["next"], limit=2)
+        self.assertEqual(self.actions(rest), [("label_added", self.contact.id, self.friends.id)])
+        self.assertFalse(rest["more"])
+
+        for params in [{"since": "-1"}, {"since": "x"}, {"limit": "0"}, {"wait": "3600"}]:
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get("/contactbook/changes", params).status_code, 400)
+
+        # the client is behind the retention, it has to start over
+        self.assertEqual(changes.trim(older_than=timedelta(0)), 3)
+        Contact.objects.create(name="Next", email="next@smart.pr", phone="3")
+        self.assertEqual(self.client.get("/contactbook/changes", {"since": 0}).status_code, 410)
+        self.assertEqual(len(self.changes(since=rest["next"])["changes"]), 1)
+
+    def test_long_poll(self):
+        started = time.monotonic()
+        page = self.changes(since=changes.head(), wait="0.2")
+        self.assertEqual(page["changes"], [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+        # woken up by a commit of another thread, well before the timeout
+        generation = changes.notifier.generation
+        threading.Timer(0.05, changes.notifier.notify).start()
+        self.assertTrue(changes.notifier.wait(generation, 5))
+        self.assertFalse(changes.notifier.wait(changes.notifier.generation, 0.01))
+
+        async def woken():
+            generation = changes.notifier.generation
+            threading.Timer(0.05, changes.notifier.notify).start()
+            return await changes.notifier.async_wait(generation, 5)
+        self.assertTrue(async_to_sync(woken)())
+
+        request = AsyncRequestFactory().get("/", {"since": 0})
+        response = async_to_sync(async_views.changes_since)(request)
+        self.assertEqual(len(json.loads(response.content)["changes"]), 3)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class ConditionalRequestTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.friends = Label.objects.create(name="friends")
+        for i in range(30):
+            Contact.objects.create(name=f"Contact {i}", email=f"c{i}@smart.pr", phone=str(i)).labels.add(self.friends)
+
+    def test_unchanged_list_is_not_sent_again(self):
+        first = self.client.get("/contactbook/contact/list", {"labels": "friends"})
+        etag = first["ETag"]
+        self.assertEqual(first["Cache-Control"], "no-cache")
+        with self.assertNumQueries(1):  # the change log head, no rows
+            second = self.client.get("/contactbook/contact/list", {"labels": "friends"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((second.status_code, second["ETag"], second.content), (304, etag, b""))
+
+        # other parameters are another answer, any write is a new version
+        self.assertNotEqual(self.client.get("/contactbook/contact/list")["ETag"], etag)
+        self.assertNotEqual(self.client.get("/contactbook/label/list")["ETag"], etag)
+        self.client.post("/contactbook/contact/remove_label", data=json.dumps(
+            {"contact_id": Contact.objects.first().id, "labels": ["friends"]}), content_type="application/json")
+        third = self.client.get("/contactbook/contact/list", {"labels": "friends"}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(len(third.json()), 29)
+        self.assertNotEqual(third["ETag"], etag)
+
+    def test_if_modified_since(self):
+        # a write within the current second gets no Last-Modified, the next one could share its second
+        ChangeEvent.objects.update(created_date=timezone.now() + timedelta(milliseconds=1))
+        self.assertNotIn("Last-Modified", self.client.get("/contactbook/label/list"))
+
+        ChangeEvent.objects.update(created_date=timezone.now() - timedelta(minutes=5))
+        response = self.client.get("/contactbook/label/list")
+        last_modified = response["Last-Modified"]
+        self.assertEqual(self.client.get("/contactbook/label/list", HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                         304)
+        Label.objects.create(name="new")
+        self.assertEqual(self.client.get("/contactbook/label/list", HTTP_IF_MODIFIED_SINCE=last_modified).status_code,
+                         200)
+
+    def test_compression(self):
+        plain = self.client.get("/contactbook/contact/list")
+        self.assertNotIn("Content-Encoding", plain)
+        self.assertIn("Accept-Encoding", plain["Vary"])
+
+        response = self.client.get("/contactbook/contact/list", HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertEqual(response["ETag"], plain["ETag"][:-1] + '-gzip"')
+        # either variant validates the other
+        self.assertEqual(self.client.get("/contactbook/contact/list", HTTP_IF_NONE_MATCH=response["ETag"]).status_code,
+                         304)
+
+        streamed = self.client.get("/contactbook/contact/list", {"stream": 1}, HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(streamed["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(b"".join(streamed.streaming_content))), plain.json())
+
+        # too small to be worth it, or not wanted
+        self.assertNotIn("Content-Encoding", self.client.get("/contactbook/label/list", HTTP_ACCEPT_ENCODING="gzip"))
+        self.assertNotIn("Content-Encoding", self.client.get("/contactbook/contact/list",
+                                                             HTTP_ACCEPT_ENCODING="gzip;q=0, identity"))
+
+    def test_negotiate(self):
+        best = "br" if conditional.brotli is not None else "gzip"
+        self.assertEqual(conditional.negotiate("gzip, deflate, br"), best)
+        self.assertEqual(conditional.negotiate("*"), best)
+        self.assertEqual(conditional.negotiate("br;q=0.5, gzip;q=0.8"), "gzip")
+        self.assertIsNone(conditional.negotiate(""))
+        self.assertIsNone(conditional.negotiate("identity, *;q=0"))
+
+    async def test_async_views(self):
+        first = await self.async_client.get("/contactbook/contact/list", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(first["Content-Encoding"], "gzip")
+        request = AsyncRequestFactory().get("/contactbook/label/list")
+        etag = (await async_views.label_list(request))["ETag"]
+        request = AsyncRequestFactory().get("/contactbook/label/list", headers={"If-None-Match": etag})
+        self.assertEqual((await async_views.label_list(request)).status_code, 304)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class SegmentTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.newsletter = Label.objects.create(name="newsletter")
+        self.active = Label.objects.create(name="active")
+        self.both = Contact.objects.create(name="Both", email="both@smart.pr", phone="1")
+        self.both.labels.add(self.newsletter, self.active)
+        self.one = Contact.objects.create(name="One", email="one@smart.pr", phone="2")
+        self.one.labels.add(self.newsletter)
+
+    def post(self, url, data):
+        return self.client.post(url, data=json.dumps(data), content_type="application/json")
+
+    def members(self, name="hot"):
+        return set(SegmentMember.objects.filter(segment__name=name).values_list("contact_id", flat=True))
+
+    def test_list_is_served_from_the_segment(self):
+        resp = self.post("/contactbook/segment/create", {"name": "hot", "q": "newsletter AND active"})
+        self.assertEqual(resp.json()["contacts"], 1)
+        for params in [{"labels": "active,newsletter", "match": "and"}, {"q": "active and newsletter"}]:
+            with self.subTest(params=params):
+                resp = self.client.get("/contactbook/contact/list", params)
+                self.assertEqual(resp["X-Contactbook-Segment"], "hot")
+                self.assertEqual([c["id"] for c in resp.json()], [self.both.id])
+        resp = self.client.get("/contactbook/contact/list", {"labels": "active,newsletter"})
+        self.assertFalse(resp.has_header("X-Contactbook-Segment"))
+        self.assertEqual(len(resp.json()), 2)
+
+        self.assertEqual(self.post("/contactbook/segment/create", {"name": "hot", "q": "active"}).status_code, 400)
+        self.assertEqual(self.post("/contactbook/segment/create", {"name": "x", "q": "(active"}).status_code, 400)
+        self.assertEqual([s["name"] for s in self.client.get("/contactbook/segment/list").json()], ["hot"])
+
+    def test_segment_header_survives_the_cache(self):
+        created = self.post("/contactbook/segment/create", {"name": "hot", "q": "newsletter AND active"}).json()
+        self.assertIsNotNone(created["refreshed_date"])
+        with override_settings(CONTACTBOOK_CACHE={"BACKEND": "locmem"}):
+            get_result_cache().clear()
+            params = {"labels": "active,newsletter", "match": "and"}
+            first = self.client.get("/contactbook/contact/list", params)
+            second = self.client.get("/contactbook/contact/list", params)
+        self.assertEqual((first["X-Contactbook-Cache"], second["X-Contactbook-Cache"]), ("miss", "hit"))
+        self.assertEqual(second["X-Contactbook-Segment"], "hot")
+
+    def test_members_follow_the_writes(self):
+        segments.create("hot", "newsletter AND active")
+        segments.create("quiet", "NOT newsletter")
+        self.post("/contactbook/contact/add_label", {"contact_id": self.one.id, "labels": ["active"]})
+        self.assertEqual(self.members(), {self.both.id, self.one.id})
+        self.post("/contactbook/contact/remove_label", {"contact_id": self.both.id, "labels": ["newsletter"]})
+        self.assertEqual(self.members(), {self.one.id})
+        self.assertEqual(self.members("quiet"), {self.both.id})
+
+        new_id = self.post("/contactbook/contact/create", {"name": "New", "email": "n@smart.pr", "phone": "3"}).json()["id"]
+        self.assertEqual(self.members("quiet"), {self.both.id, new_id})
+        self.client.get("/contactbook/contact/del", {"id": self.one.id})
+        self.assertEqual(self.members(), set())
+        deletion.restore(Contact, [self.one.id])
+        self.assertEqual(self.members(), {self.one.id})
+
+        # a deleted label matches nobody, the segments using it are filled again
+        self.client.get("/contactbook/label/del", {"id": self.active.id})
+        self.assertEqual(self.members(), set())
+        deletion.restore(Label, [self.active.id])
+        self.assertEqual(self.members(), {self.one.id})
+
+    def test_rebuild_command(self):
+        segments.create("hot", "newsletter AND active")
+        Contact.labels.through.objects.create(contact=self.one, label=self.active)  # around the signals
+        out = io.StringIO()
+        call_command("rebuild_segments", stdout=out)
+        self.assertEqual(out.getvalue().strip(), "hot: 2 contacts")
+        self.assertEqual(self.client.get(f"/contactbook/segment/del?id={Segment.objects.get().id}").status_code, 200)
+        self.assertFalse(SegmentMember.objects.exists())
+
+
+class DedupeTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        get_result_cache().clear()
+        self.friends = Label.objects.create(name="friends")
+        self.work = Label.objects.create(name="work")
+        self.ann = Contact.objects.create(name="Ann de Vries", email="ann@smart.pr", phone="+31 6 1234 5678")
+        self.ann_again = Contact.objects.create(name="Ann", email=" ANN@smart.pr", phone="112")
+        self.ann_phone = Contact.objects.create(name="de vries, Ann", email="ann@home.nl", phone="0031612345678")
+        self.office = Contact.objects.create(name="Bob", email="bob@smart.pr", phone="+31612345678")
+        self.ann.labels.add(self.friends)
+        self.ann_again.labels.add(self.work)
+        self.ann_phone.labels.add(self.friends)
+
+    def test_blocking_keys(self):
+        self.assertEqual(dedupe.phone_key("06-12 34 56 78", "31"), "+31612345678")
+        self.assertEqual(dedupe.phone_key("06-12 34 56 78"), "0612345678")
+        self.assertEqual(dedupe.phone_key("112"), "")
+        self.assertEqual(dedupe.name_key("Smit, Jösé"), "jose smit")
+        self.assertEqual(dedupe.blocking_keys("", "no email", ""), [])
+
+    def test_dry_run_then_merge(self):
+        report = self.client.get("/contactbook/contact/duplicates").json()
+        # ann_again by email, ann_phone by phone and name; the shared office phone is not enough
+        self.assertEqual((report["groups"], report["duplicates"]), (1, 2))
+        self.assertEqual(report["links"], {"email": 1, "phone_name": 1})
+        self.assertEqual(report["sample"], [{"keep": self.ann.id, "merge": [self.ann_again.id, self.ann_phone.id]}])
+        self.assertEqual(Contact.objects.count(), 4)
+
+        report = self.client.post("/contactbook/contact/duplicates").json()
+        self.assertEqual((report["merged"], report["labels_added"]), (2, 1))
+        self.assertEqual(set(Contact.objects.values_list("id", flat=True)), {self.ann.id, self.office.id})
+        self.assertEqual(set(self.ann.labels.values_list("name", flat=True)), {"friends", "work"})
+        self.assertEqual(LabelStat.objects.get(label=self.friends).contact_count, 1)
+        self.assertEqual(LabelStat.objects.get(label=self.work).contact_count, 1)
+        self.assertEqual(self.client.get("/contactbook/contact/duplicates").json()["groups"], 0)
+
+    def test_command_stays_in_its_book(self):
+        Book.objects.create(slug="acme")
+        with books.use_book("acme"):
+            Contact.objects.create(name="Ann", email="ann@smart.pr", phone="1")
+        out = io.StringIO()
+        call_command("dedupe_contacts", "--merge", "--chunk-size", "2", stdout=out)
+        self.assertEqual(json.loads(out.getvalue())["merged"], 2)
+        with books.use_book("acme"):
+            self.assertEqual(Contact.objects.count(), 1)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None}, CONTACTBOOK_WRITE_BEHIND={"ENABLED": True, "WORKER": False})
+class LabelQueueTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.contact = Contact.objects.create(name="Queued", email="queued@smart.pr", phone="1")
+
+    def post(self, url, data):
+        return self.client.post(url, data=json.dumps(data), content_type="application/json")
+
+    def labels_of(self, contact):
+        return set(contact.labels.values_list("name", flat=True))
+
+    def test_mutations_are_queued_and_coalesced(self):
+        resp = self.post("/contactbook/contact/add_label", {"contact_id": self.contact.id, "labels": ["a", "b"]})
+        self.assertEqual(resp.status_code, 202)
+        ticket = resp.json()["ticket"]
+        self.post("/contactbook/contact/remove_label", {"contact_id": self.contact.id, "labels": ["b"]})
+        self.post("/contactbook/contact/add_label", {"contact_id": self.contact.id + 100, "labels": ["a"]})
+        self.assertEqual(self.labels_of(self.contact), set())
+        self.assertEqual(self.client.get("/contactbook/contact/label_queue").json()["queued"], 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            counts = label_queue.apply_pending()
+        self.assertEqual(counts, {"mutations": 3, "coalesced": 1, "added": 1, "removed": 0, "failed": 1})
+        self.assertEqual(self.labels_of(self.contact), {"a"})
+        self.assertFalse(Label.objects.filter(name="b").exists())  # added and removed again, never written
+        status = self.client.get("/contactbook/contact/label_queue", {"ticket": ticket}).json()
+        self.assertEqual(status["status"], "applied")
+        failed = LabelMutation.objects.get(contact_id=self.contact.id + 100)
+        self.assertEqual((failed.status, failed.error), ("failed", "contact not found"))
+        self.assertEqual(label_queue.apply_pending()["mutations"], 0)
+
+    def test_flush_on_read(self):
+        self.post("/contactbook/contact/add_label", {"contact_id": self.contact.id, "labels": ["a"]})
+        self.assertEqual(self.client.get("/contactbook/contact/list", {"labels": "a"}).json(), [])
+        resp = self.client.get("/contactbook/contact/list", {"labels": "a", "flush": "1"})
+        self.assertEqual([c["id"] for c in resp.json()], [self.contact.id])
+        with override_settings(CONTACTBOOK_WRITE_BEHIND={"ENABLED": True, "WORKER": False, "FLUSH_ON_READ": True}):
+            self.post("/contactbook/contact/remove_label", {"contact_id": self.contact.id, "labels": ["a"]})
+            self.assertEqual(self.client.get("/contactbook/contact/list", {"labels": "a"}).json(), [])
+
+        self.post("/contactbook/contact/add_label", {"contact_id": self.contact.id, "labels": ["c"]})
+        out = io.StringIO()
+        call_command("apply_label_queue", stdout=out)
+        self.assertEqual(json.loads(out.getvalue())["added"], 1)
+        self.assertEqual(self.labels_of(self.contact), {"c"})
+
+    def test_worker_survives_a_failing_round(self):
+        real = label_queue.apply_pending
+
+        def failing():
+            raise ValueError("boom")
+
+        label_queue.apply_pending = failing
+        try:
+            with self.assertLogs("contactbook.label_queue", "ERROR"):
+                label_queue.work_round()
+        finally:
+            label_queue.apply_pending = real
+
+    def test_bad_requests(self):
+        self.assertEqual(self.post("/contactbook/contact/add_label", {"contact_id": "x", "labels": ["a"]}).status_code,
+                         400)
+        self.assertEqual(self.client.get("/contactbook/contact/label_queue", {"ticket": "1"}).status_code, 400)
+        self.assertFalse(LabelMutation.objects.exists())
+
+
+ADMISSION = {"ENABLED": True, "EXPENSIVE_ROWS": 3, "CLIENT_RATE": 1, "CLIENT_BURST": 10, "QUEUE_SECONDS": 0}
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None}, CONTACTBOOK_ADMISSION=ADMISSION)
+class AdmissionTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        self.friends = Label.objects.create(name="friends")
+        self.contacts = [Contact.objects.create(name=f"C{i}", email=f"c{i}@smart.pr", phone=str(i)) for i in range(4)]
+        self.contacts[0].labels.add(self.friends)
+
+    def cost(self, **params):
+        params, _ = filters.parse_list_params(RequestFactory().get("/contactbook/contact/list", params))
+        return admission.estimate_cost(params, admission.get_config())
+
+    def test_cost_estimate(self):
+        top = self.contacts[-1].id
+        self.assertEqual(self.cost(), top)
+        self.assertEqual(self.cost(labels="friends"), 1)
+        self.assertEqual(self.cost(emails_only="1"), math.ceil(top * 0.2))
+        self.assertEqual(self.cost(limit="2"), 2)
+        self.assertEqual(self.cost(limit="2", stream="1"), 2)
+
+    def test_rate_limit(self):
+        # the burst of the client is one unfiltered list, refilled at a row per second
+        with override_settings(CONTACTBOOK_ADMISSION={**ADMISSION, "CLIENT_BURST": self.contacts[-1].id}):
+            self.assertEqual(self.client.get("/contactbook/contact/list").status_code, 200)
+            resp = self.client.get("/contactbook/contact/list")
+            self.assertEqual(resp.status_code, 429)
+            self.assertGreaterEqual(int(resp["Retry-After"]), 1)
+            # cheap requests and other clients still get in
+            self.assertEqual(self.client.get("/contactbook/contact/list", {"labels": "friends"}).status_code, 200)
+            self.assertEqual(self.client.get("/contactbook/contact/list", REMOTE_ADDR="10.0.0.2").status_code, 200)
+            stats = self.client.get("/contactbook/admission/stats").json()
+            self.assertEqual((stats["admitted"], stats["rejected_rate"], stats["cheap"]), (2, 1, 1))
+            self.assertIn('contactbook_admission_requests_total{outcome="rejected_rate"} 1',
+                          self.client.get("/contactbook/metrics").content.decode())
+
+    def test_concurrency_limit(self):
+        config = {**ADMISSION, "CLIENT_RATE": 1000, "MAX_CONCURRENT_PER_CLIENT": 1}
+        with override_settings(CONTACTBOOK_ADMISSION=config):
+            controller = admission.get_controller()
+            resp = self.client.get("/contactbook/contact/list", {"stream": "1"})
+            self.assertEqual(controller.stats()["running"], 1)  # until the stream is closed
+            self.assertEqual(self.client.get("/contactbook/contact/list").status_code, 429)
+            b"".join(resp.streaming_content)
+            self.assertEqual(controller.stats()["running"], 0)
+            self.assertEqual(self.client.get("/contactbook/contact/list").status_code, 200)
+            self.assertEqual(controller.stats()["rejected_concurrency"], 1)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class QueryPlanTestCase(TestCase):
+    """
+    Runs EXPLAIN QUERY PLAN on every query of the hot endpoints, none of them may read a whole table
+    unless returning the whole table is the point of the request.
+    """
+    # request -> tables it may scan completely
+    FULL_SCAN_ALLOWED = {
+        "/contactbook/contact/list": {"contactbook_contact"},
+        "/contactbook/contact/list?limit=2": {"contactbook_contact"},  # stops after the page
+        # the distinct contacts of the filter, materialized once for the GROUP BY
+        "/contactbook/contact/facets?labels=friends,work&match=and": {"subquery"},
+        "/contactbook/contact/list?q=NOT%20work": {"contactbook_contact"},  # no label to start from
+    }
+
+    def setUp(self):
+        self.client = Client()
+        self.friends = Label.objects.create(name="friends")
+        self.work = Label.objects.create(name="work")
+        for i in range(5):
+            c = Contact.objects.create(name=f"Contact {i}", email=f"c{i}@smart.pr", phone=str(i))
+            c.labels.add(self.friends if i % 2 else self.work)
+        self.contact = Contact.objects.first()
+
+    def plans(self, do_request):
+        with CaptureQueriesContext(connection) as ctx:
+            do_request()
+        plans = []
+        for captured in ctx.captured_queries:
+            sql = captured["sql"]
+            if not sql.startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+                plans.append((sql, [row[3] for row in cursor.fetchall()]))
+        self.assertTrue(plans)
+        return plans
+
+    def assertNoFullScan(self, name, do_request):
+        allowed = self.FULL_SCAN_ALLOWED.get(name, set())
+        for sql, plan in self.plans(do_request):
+            for step in plan:
+                if step.startswith("SCAN ") and " USING " not in step:
+                    table = step.split()[1]
+                    self.assertIn(table, allowed, f"{name} scans {table}:\n{sql}\n{plan}")
+
+    def test_contact_list(self):
+        for url in [
+            "/contactbook/contact/list",
+            "/contactbook/contact/list?limit=2",
+            "/contactbook/contact/list?labels=friends",
+            "/contactbook/contact/list?labels=friends,work&match=and",
+            "/contactbook/contact/list?labels=friends,work&limit=2",
+            "/contactbook/contact/list?labels=friends&exclude=work",
+            "/contactbook/contact/list?emails_only=1",
+            "/contactbook/contact/list?emails_only=1&limit=2",
+            "/contactbook/contact/list?labels=friends&emails_only=1",
+            "/contactbook/contact/list?q=friends%20AND%20NOT%20work",
+            "/contactbook/contact/list?q=friends%20AND%20work",
+            "/contactbook/contact/list?q=NOT%20work",
+            "/contactbook/changes?since=0",
+        ]:
+            with self.subTest(url=url):
+                self.assertNoFullScan(url, lambda: self.client.get(url))
+
+    def test_emails_only_reads_the_index_only(self):
+        # the first one is the version of conditional.py
+        [_, (sql, plan)] = self.plans(lambda: self.client.get("/contactbook/contact/list?emails_only=1"))
+        self.assertEqual(plan, ["SEARCH contactbook_contact USING COVERING INDEX contact_live_email_idx (book_id=?)"])
+
+    def test_label_list(self):
+        self.assertNoFullScan("label_list", lambda: self.client.get("/contactbook/label/list"))
+
+    def test_facets(self):
+        for url in [
+            "/contactbook/contact/facets?labels=friends",
+            "/contactbook/contact/facets?labels=friends,work&match=and",
+        ]:
+            with self.subTest(url=url):
+                self.assertNoFullScan(url, lambda: self.client.get(url))
+
+    def test_add_and_remove_label(self):
+        def post(url, labels):
+            return lambda: self.client.post(url, data=json.dumps({"contact_id": self.contact.id, "labels": labels}),
+                                            content_type="application/json")
+
+        self.assertNoFullScan("add_label", post("/contactbook/contact/add_label", ["friends", "new"]))
+        self.assertNoFullScan("remove_label", post("/contactbook/contact/remove_label", ["friends"]))
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class BenchmarkHarnessTestCase(TestCase):
+    def test_percentile_is_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_scenario_measures_queries_and_status(self):
+        Contact.objects.create(name="A", email="a@smart.pr", phone="1")
+        result = run_scenario(Client(), Scenario("list", "contact_list", query="limit=10"), requests=3)
+        self.assertEqual(result["status"], [200])
+        self.assertEqual(result["requests"], 3)
+        self.assertGreater(result["queries"], 0)
+        self.assertLessEqual(result["p50_ms"], result["p99_ms"])
+
+    def test_setup_runs_once_before_the_requests(self):
+        created = []
+
+        def setup(count):
+            created.extend(Contact.objects.create(name=f"D{i}", email=f"d{i}@smart.pr", phone="1").id
+                           for i in range(count))
+
+        scenario = Scenario("del", "contact_del", query=lambda n: f"id={created[n]}", setup=setup)
+        result = run_scenario(Client(), scenario, requests=3)
+        self.assertEqual(len(created), 5)  # warmup, 3 timed, the measured one
+        self.assertEqual(result["status"], [200])
+        self.assertFalse(Contact.objects.exists())
+
+    def test_baseline_comparison_flags_slower_and_chattier_scenarios(self):
+        baseline = {"a": {"p95_ms": 10, "queries": 2}, "b": {"p95_ms": 10, "queries": 2}}
+        results = {"a": {"p95_ms": 11, "queries": 3}, "b": {"p95_ms": 15, "queries": 2},
+                   "c": {"p95_ms": 1, "queries": 1}}
+        lines, regressions = compare_to_baseline(results, baseline, max_regression_pct=20)
+        self.assertEqual(regressions, ["a", "b"])
+        self.assertIn("c: new", lines)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None}, CONTACTBOOK_METRICS={"SAMPLE_RATE": 0, "DEBUG_HEADER": True})
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        metrics.clear()
+        friends = Label.objects.create(name="friends")
+        for i in range(3):
+            Contact.objects.create(name=f"C{i}", email=f"c{i}@smart.pr", phone=str(i)).labels.add(friends)
+
+    def test_debug_header_reports_queries_rows_and_bytes(self):
+        self.client.force_login(User.objects.create_user("ops", is_staff=True))
+        response = self.client.get(reverse("contact_list"), {"labels": "friends"}, HTTP_X_CONTACTBOOK_DEBUG="1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("sql;dur=", response["Server-Timing"])
+        self.assertEqual(response["X-Contactbook-Stats"], f"queries=4; rows=3; bytes={len(response.content)}")
+
+        recent = self.client.get(reverse("debug_requests")).json()
+        self.assertEqual(len(recent), 1)
+        self.assertEqual(recent[0]["view"], "contact_list")
+        # the change log head for the ETag, the label lookup, then the contacts with their label names
+        self.assertEqual(len(recent[0]["query_log"]), 4)
+
+    def test_debug_is_for_staff_only(self):
+        response = self.client.get(reverse("contact_list"), {"labels": "friends"}, HTTP_X_CONTACTBOOK_DEBUG="1")
+        self.assertNotIn("Server-Timing", response)
+        self.assertNotIn("X-Contactbook-Stats", response)
+        self.assertEqual(self.client.get(reverse("debug_requests")).status_code, 403)
+
+        self.client.force_login(User.objects.create_user("someone"))
+        self.assertEqual(self.client.get(reverse("debug_requests")).status_code, 403)
+        with override_settings(DEBUG=True):
+            self.assertEqual(self.client.get(reverse("debug_requests")).status_code, 200)
+        with override_settings(CONTACTBOOK_METRICS={"SAMPLE_RATE": 0}):
+            self.client.force_login(User.objects.create_user("ops", is_staff=True))
+            response = self.client.get(reverse("contact_list"), HTTP_X_CONTACTBOOK_DEBUG="1")
+            self.assertNotIn("Server-Timing", response)  # the header is off by default
+
+    def test_unsampled_requests_are_not_measured(self):
+        response = self.client.get(reverse("contact_list"))
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual(self.client.get(reverse("metrics")).content, b"\n")
+
+    @override_settings(CONTACTBOOK_METRICS={"SAMPLE_RATE": 1})
+    def test_metrics_are_prometheus_histograms_per_view(self):
+        self.client.get(reverse("contact_list"))
+        self.client.get(reverse("contact_list"), {"limit": 2})
+        self.client.get(reverse("label_list"))
+        text = self.client.get(reverse("metrics")).content.decode()
+        self.assertIn("# TYPE contactbook_request_duration_seconds histogram", text)
+        self.assertIn('contactbook_request_queries_count{view="contact_list"} 2', text)
+        self.assertIn('contactbook_request_rows_bucket{view="contact_list",le="+Inf"} 2', text)
+        self.assertIn('contactbook_request_rows_sum{view="contact_list"} 5', text)
+        self.assertIn('contactbook_request_queries_sum{view="label_list"} 2', text)
+
+    def test_streamed_responses_are_measured_once_sent(self):
+        response = self.client.get(reverse("contact_list"), {"stream": 1, "format": "ndjson"},
+                                   HTTP_X_CONTACTBOOK_DEBUG="1")
+        self.assertEqual(len(metrics.recent), 0)
+        body = b"".join(response.streaming_content)
+        self.assertEqual(len(metrics.recent), 1)
+        self.assertEqual(metrics.recent[0]["rows"], 3)
+        self.assertEqual(metrics.recent[0]["bytes"], len(body))
+        self.assertEqual(metrics.recent[0]["queries"], 2)
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None}, CONTACTBOOK_METRICS={"SAMPLE_RATE": 0})
+class AsyncViewsTestCase(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.friends = Label.objects.create(name="friends")
+        self.contacts = [Contact.objects.create(name=f"C{i}", email=f"c{i}@smart.pr", phone=str(i))
+                         for i in range(3)]
+        self.contacts[0].labels.add(self.friends)
+        self.contacts[2].labels.add(self.friends)
+
+    async def get(self, view, **params):
+        return await view(self.factory.get("/", params))
+
+    async def post(self, view, data):
+        return await view(self.factory.post("/", data, content_type="application/json"))
+
+    async def test_contact_list_matches_the_sync_view(self):
+        for params in ({}, {"labels": "friends"}, {"labels": "friends", "emails_only": "1"}, {"limit": "2"},
+                       {"exclude": "friends"}, {"labels": "nope,friends", "match": "and"}):
+            response = await self.get(async_views.contact_list, **params)
+            expected = await sync_to_async(self.client.get)(reverse("contact_list"), params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), expected.json(), params)
+
+    async def test_contact_list_streams_asynchronously(self):
+        response = await self.get(async_views.contact_list, labels="friends", stream="1", format="ndjson")
+        self.assertTrue(response.is_async)
+        lines = [json.loads(line) async for chunk in response.streaming_content for line in chunk.splitlines()]
+        self.assertEqual([c["id"] for c in lines], [self.contacts[0].id, self.contacts[2].id])
+        self.assertEqual(lines[0]["labels"], ["friends"])
+
+    async def test_contact_list_errors(self):
+        response = await self.get(async_views.contact_list, labels="friends", match="xor")
+        self.assertEqual(response.status_code, 400)
+
+    async def test_label_list(self):
+        response = await self.get(async_views.label_list)
+        self.assertEqual(json.loads(response.content), [{"id": self.friends.id, "name": "friends"}])
+        response = await self.get(async_views.label_list, with_counts="1")
+        self.assertEqual(json.loads(response.content)[0]["contacts"], await self.friends.contacts.acount())
+
+    async def test_writes(self):
+        response = await self.post(async_views.contact_create, {"name": "N", "email": "n@smart.pr", "phone": "9"})
+        contact_id = json.loads(response.content)["id"]
+
+        response = await self.post(async_views.add_label, {"contact_id": contact_id, "labels": ["friends", " new "]})
+        self.assertEqual(sorted(json.loads(response.content)["labels"]), ["friends", "new"])
+        response = await self.post(async_views.remove_label, {"contact_id": contact_id, "labels": ["friends"]})
+        self.assertEqual(json.loads(response.content)["labels"], ["new"])
+
+        response = await self.post(async_views.label_create, {"name": "new"})
+        self.assertFalse(json.loads(response.content)["created"])
+
+        response = await self.get(async_views.contact_del, id=str(contact_id))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(await Contact.objects.filter(id=contact_id).aexists())
+
+    async def test_label_create_restores_a_deleted_label(self):
+        await self.get(async_views.label_del, id=str(self.friends.id))
+        response = await self.post(async_views.label_create, {"name": "friends"})
+        self.assertEqual(json.loads(response.content)["id"], self.friends.id)
+        self.assertTrue(await Label.objects.filter(id=self.friends.id).aexists())
+
+    @override_settings(CONTACTBOOK_METRICS={"SAMPLE_RATE": 0, "DEBUG_HEADER": True})
+    async def test_queries_in_async_requests_are_measured(self):
+        metrics.clear()
+        await self.async_client.aforce_login(await User.objects.acreate_user("ops", is_staff=True))
+        response = await self.async_client.get(reverse("contact_list"), {"labels": "friends"},
+                                               headers={"X-Contactbook-Debug": "1"})
+        self.assertEqual(response["X-Contactbook-Stats"], f"queries=4; rows=2; bytes={len(response.content)}")
+
+
+@override_settings(CONTACTBOOK_CACHE={"BACKEND": None})
+class SerializationTestCase(TestCase):
+    def setUp(self):
+        friends = Label.objects.create(name="friends")
+        gone = Label.objects.create(name="gone")
+        exotic = Label.objects.create(name='Ünï "cödé" \\ ✓')
+        self.contacts = [
+            Contact.objects.create(name='Zoë "Z" \\ O\'Neil', email="zoe@smart.pr", phone="+31\t6"),
+            Contact.objects.create(name="No Labels", email="none@smart.pr", phone="1"),
+            Contact.objects.create(name="Ren 蓮", email="ren@smart.pr", phone="2"),
+        ]
+        self.contacts[0].labels.add(friends, gone, exotic)
+        self.contacts[2].labels.add(exotic)
+        self.client.get(reverse("label_del"), {"id": gone.id})
+
+    def test_rows_encode_to_the_model_serialization(self):
+        qs = Contact.objects.order_by("id")
+        expected = [serialize_contact(c) for c in qs.prefetch_related("labels")]
+        self.assertEqual(json.loads(serialization.encode_array(list(serialization.contact_rows(qs)))), expected)
+        self.assertEqual(expected[0]["labels"], ["friends", 'Ünï "cödé" \\ ✓'])
+        self.assertEqual(expected[1]["labels"], [])
+
+    def test_contact_list_pages_and_streams_the_same_contacts(self):
+        full = self.client.get(reverse("contact_list")).json()
+        self.assertEqual([c["id"] for c in full], [c.id for c in self.contacts])
+
+        first = self.client.get(reverse("contact_list"), {"limit": 2}).json()
+        rest = self.client.get(reverse("contact_list"), {"limit": 2, "after": first["next"]}).json()
+        self.assertEqual(first["results"] + rest["results"], full)
+        self.assertIsNone(rest["next"])
+
+        response = self.client.get(reverse("contact_list"), {"stream": 1})
+        self.assertEqual(json.loads(b"".join(response.streaming_content)), full)
+        response = self.client.get(reverse("contact_list"), {"stream": 1, "format": "ndjson", "limit": 2})
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], full[:2])
+
+    def test_chunked_streams(self):
+        rows = list(serialization.contact_rows(Contact.objects.order_by("id")))
+        self.assertEqual(json.loads(b"".join(serialization.stream_array(iter(rows), 2))), json.loads(
+            serialization.encode_array(rows)))
+        self.assertEqual(b"".join(serialization.stream_array(iter([]), 2)), b"[]")
+        self.assertEqual(len(b"".join(serialization.stream_lines(iter(rows), 2)).splitlines()), 3)
+
+    def test_fields_projection(self):
+        full = self.client.get(reverse("contact_list")).json()
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("contact_list"), {"fields": "email,id"})
+        self.assertEqual(response.json(), [{"id": c["id"], "email": c["email"]} for c in full])
+        # neither the other columns nor the labels are read
+        [sql] = [q["sql"] for q in ctx.captured_queries if "contactbook_contact" in q["sql"]]
+        self.assertNotIn("json_group_array", sql)
+        self.assertNotIn('"phone"', sql)
+
+        # the model path (other databases) answers the same, without prefetching the labels
+        rows = [{"name": c["name"], "labels": c["labels"]} for c in full]
+        self.assertEqual(self.client.get(reverse("contact_list"), {"fields": "labels,name"}).json(), rows)
+        qs = views.project(Contact.objects.order_by("id"), ["name", "phone"])
+        with self.assertNumQueries(1):
+            self.assertEqual([views.serialize_fields(c, ["name", "phone"]) for c in qs],
+                             [{"name": c["name"], "phone": c["phone"]} for c in full])
+
+        # paged without the id in the answer, the cursor still knows where it was
+        first = self.client.get(reverse("contact_list"), {"fields": "name", "limit": 2}).json()
+        rest = self.client.get(reverse("contact_list"), {"fields": "name", "limit": 2, "after": first["next"]}).json()
+        self.assertEqual(first["results"] + rest["results"], [{"name": c["name"]} for c in full])
+
+        for params in [{"fields": "id,secret"}, {"fields": "id", "emails_only": 1}]:
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(reverse("contact_list"), params).status_code, 400)
+
+    async def test_async_chunks_respect_the_limit(self):
+        rows = serialization.contact_rows(Contact.objects.order_by("id"))
+        chunks = [chunk async for chunk in async_views.arow_chunks(rows, limit=3, chunk_size=2)]
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual([row[0] for chunk in chunks for row in chunk], [c.id for c in self.contacts])
+
+
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        config = override_settings(CONTACTBOOK_EXPORTS={"DIR": directory.name, "WORKERS": 0, "CHUNK_SIZE": 2})
+        config.enable()
+        self.addCleanup(config.disable)
+        friends = Label.objects.create(name="friends")
+        work = Label.objects.create(name="work")
+        for i in range(5):
+            c = Contact.objects.create(name=f"Contact, {i}", email=f"c{i % 4}@smart.pr", phone=str(i))
+            c.labels.add(*([friends, work] if i % 2 else [work]))
+
+    def export(self, **params):
+        resp = self.client.post("/contactbook/contact/export", data=json.dumps(params),
+                                content_type="application/json")
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json()["status"], "pending")
+        self.assertIsNone(resp.json()["download_url"])
+        self.assertEqual(exports.run_pending(), 1)
+        job = self.client.get(resp.json()["status_url"]).json()
+        self.assertEqual(job["status"], "done", job["error"])
+        return job
+
+    def download(self, job, **headers):
+        resp = self.client.get(job["download_url"], headers=headers)
+        return resp, b"".join(resp.streaming_content)
+
+    def test_jobs_of_a_dead_worker_run_again(self):
+        lost = exports.create_job(["work"], background=False)
+        running = exports.create_job(["work"], background=False)
+        ExportJob.objects.filter(id=lost.id).update(status=ExportJob.RUNNING,
+                                                    started_date=timezone.now() - timedelta(hours=2))
+        ExportJob.objects.filter(id=running.id).update(status=ExportJob.RUNNING, started_date=timezone.now())
+        self.assertEqual(exports.run_pending(), 1)
+        self.assertEqual(ExportJob.objects.get(id=lost.id).status, ExportJob.DONE)
+        self.assertEqual(ExportJob.objects.get(id=running.id).status, ExportJob.RUNNING)
+
+    def test_csv_export_reads_back_with_the_importer(self):
+        job = self.export(labels="friends,work", match="and")
+        self.assertEqual(job["rows"], 2)
+        resp, body = self.download(job)
+        self.assertEqual(resp["Content-Type"], "application/gzip")
+        self.assertIn(f"contacts-{job['id']}.csv.gz", resp["Content-Disposition"])
+        lines = gzip.decompress(body).decode().splitlines()
+        self.assertEqual(lines[0], "id,name,email,phone,labels")
+        self.assertEqual(lines[1].split(",", 1)[1], '"Contact, 1",c1@smart.pr,1,"friends,work"')
+
+        Contact.objects.all().delete()
+        resp = self.client.post("/contactbook/contact/bulk_create", data=gzip.decompress(body),
+                                content_type="text/csv")
+        self.assertEqual(resp.json()["created"], 2)
+        self.assertEqual(Label.objects.get(name="friends").contacts.count(), 2)
+
+    def test_ndjson_emails_and_byte_ranges(self):
+        job = self.export(labels=["work"], emails_only=True, format="ndjson", compression="none")
+        resp, body = self.download(job)
+        self.assertEqual(resp["Accept-Ranges"], "bytes")
+        self.assertEqual([json.loads(line)["email"] for line in body.splitlines()],
+                         ["c0@smart.pr", "c1@smart.pr", "c2@smart.pr", "c3@smart.pr"])
+
+        resp, part = self.download(job, Range="bytes=5-24")
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp["Content-Range"], f"bytes 5-24/{len(body)}")
+        self.assertEqual(part, body[5:25])
+        self.assertEqual(self.download(job, Range="bytes=-10")[1], body[-10:])
+        resp = self.client.get(job["download_url"], headers={"Range": f"bytes={len(body)}-"})
+        self.assertEqual(resp.status_code, 416)
+
+    def test_bad_requests_and_unfinished_jobs(self):
+        def post(payload):
+            return self.client.post("/contactbook/contact/export", data=json.dumps(payload),
+                                    content_type="application/json").status_code
+
+        self.assertEqual(post({"format": "xml"}), 400)
+        self.assertEqual(post({"compression": "bz2"}), 400)
+        self.assertEqual(post({"labels": [1]}), 400)
+        self.assertEqual(self.client.get("/contactbook/contact/export/status?id=999").status_code, 400)
+        job = exports.create_job(background=False)
+        self.assertEqual(self.client.get(f"/contactbook/contact/export/download?id={job.id}").status_code, 409)
+
+    def test_export_contacts_command(self):
+        out = io.StringIO()
+        call_command("export_contacts", "--labels", "friends", "--format", "ndjson", stdout=out)
+        job = ExportJob.objects.get()
+        self.assertIn("2 rows", out.getvalue())
+        with gzip.open(exports.file_path(job)) as f:
+            self.assertEqual([json.loads(line)["labels"] for line in f], [["friends", "work"]] * 2)
+
+
+class DatabaseTuningTestCase(TestCase):
+    def test_new_connections_get_the_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], 5000)
+            cursor.execute("PRAGMA cache_size")
+            self.assertEqual(cursor.fetchone()[0], -64 * 1024)
+
+
+@override_settings(CONTACTBOOK_READ_REPLICAS=["replica"])
+class ReadReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.router = ReadReplicaRouter()
+        self.factory = RequestFactory()
+
+    def alias(self):
+        return self.router.db_for_read(Contact) or "default"
+
+    def test_only_read_only_views_read_from_replicas(self):
+        self.assertEqual(self.alias(), "default")
+        view = read_only_view(lambda request: HttpResponse(self.alias()))
+        self.assertEqual(view(self.factory.get("/")).content, b"replica")
+        self.assertEqual(self.alias(), "default")
+        with override_settings(CONTACTBOOK_READ_REPLICAS=[]):
+            self.assertEqual(view(self.factory.get("/")).content, b"default")
+        self.assertFalse(self.router.allow_migrate("replica", "contactbook"))
+
+    def test_streamed_bodies_read_from_replicas(self):
+        view = read_only_view(lambda request: StreamingHttpResponse(self.alias() for _ in range(2)))
+        response = view(self.factory.get("/"))
+        self.assertEqual(self.alias(), "default")
+        self.assertEqual(b"".join(response.streaming_content), b"replicareplica")
+
+    async def test_async_views(self):
+        async def body():
+            yield self.alias()
+
+        @read_only_view
+        async def view(request):
+            return StreamingHttpResponse(body())
+
+        response = await view(self.factory.get("/"))
+        self.assertEqual([chunk async for chunk in response.streaming_content], [b"replica"])
+
+
+class BookTestCase(TestCase):
+    def setUp(self):
+        self.client = Client()
+        get_result_cache().clear()
+        self.acme = Book.objects.create(slug="acme", name="Acme")
+
+    def get(self, url, book=None):
+        headers = {books.HEADER: book} if book else {}
+        return self.client.get(url, headers=headers)
+
+    def post(self, url, data, book=None):
+        headers = {books.HEADER: book} if book else {}
+        return self.client.post(url, data=json.dumps(data), content_type="application/json", headers=headers)
+
+    def test_books_dont_see_each_other(self):
+        self.post("/contactbook/contact/create", {"name": "Ann", "email": "ann@smart.pr", "phone": "1"})
+        bob = self.post("/contactbook/contact/create", {"name": "Bob", "email": "bob@smart.pr", "phone": "2"},
+                        "acme").json()
+        # the same name is another label in every book
+        self.post("/contactbook/contact/add_label", {"contact_id": bob["id"], "labels": ["vip"]}, "acme")
+        self.assertEqual(list(Label.all_objects.filter(name="vip").values_list("book__slug", flat=True)), ["acme"])
+        self.assertEqual(self.get("/contactbook/label/list").json(), [])
+
+        self.assertEqual([c["name"] for c in self.get("/contactbook/contact/list").json()], ["Ann"])
+        self.assertEqual([c["name"] for c in self.get("/contactbook/contact/list?labels=vip", "acme").json()],
+                         ["Bob"])
+        self.assertEqual(self.get("/contactbook/contact/list?labels=vip").json(), [])
+        # a contact of another book can't be touched either
+        resp = self.post("/contactbook/contact/add_label", {"contact_id": bob["id"], "labels": ["vip"]})
+        self.assertEqual(resp.status_code, 400)
+
+        with books.use_book("acme"):
+            self.assertEqual(list(Contact.objects.values_list("name", flat=True)), ["Bob"])
+            self.assertEqual(changes.read(0, 10)[0][0][1], ChangeEvent.CONTACT_CREATED)
+        self.assertEqual(Contact.objects.count(), 2)  # outside of a book, all of them
+
+    def test_unknown_book(self):
+        self.assertEqual(self.get("/contactbook/contact/list", "nope").status_code, 404)
+
+    def test_change_logs_are_per_book(self):
+        start = self.get("/contactbook/changes", "acme").json()["next"]
+        self.post("/contactbook/contact/create", {"name": "Ann", "email": "ann@smart.pr", "phone": "1"})
+        # seqs are shared, the gaps in the log of acme are not trimmed events
+        self.assertEqual(self.get(f"/contactbook/changes?since={start}", "acme").json()["changes"], [])
+        etag = self.get("/contactbook/contact/list", "acme")["ETag"]
+        self.assertNotEqual(self.get("/contactbook/contact/list")["ETag"], etag)
+
+    @override_settings(CONTACTBOOK_BOOK_DATABASES={"acme": "acme_db"})
+    def test_router_places_big_books(self):
+        router = books.BookRouter()
+        self.assertIsNone(router.db_for_write(Contact))
+        with books.use_book("acme"):
+            self.assertEqual(router.db_for_read(Contact), "acme_db")
+            self.assertEqual(router.db_for_write(Contact.labels.through), "acme_db")
+            self.assertEqual(books.db(), "acme_db")
+            self.assertIsNone(router.db_for_read(ExportJob))
+        with books.use_book(self.acme.id):
+            self.assertEqual(router.db_for_read(Label), "acme_db")
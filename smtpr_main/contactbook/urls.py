@@ -1,18 +1,42 @@
+from django.conf import settings
 from django.urls import path
 
-from . import views
+from . import async_views, views
+
+# under ASGI the hot endpoints can be served by their async versions, see async_views.py
+hot = async_views if getattr(settings, "CONTACTBOOK_ASYNC_VIEWS", False) else views
 
 urlpatterns = [
-    path("contact/list", views.contact_list, name="contact_list"),
-    path("contact/create", views.contact_create, name="contact_create"),
-    path("contact/del", views.contact_del, name="contact_del"),
+    path("contact/list", hot.contact_list, name="contact_list"),
+    path("contact/search", views.contact_search, name="contact_search"),
+    path("contact/facets", views.contact_facets, name="contact_facets"),
+    path("contact/export", views.contact_export, name="contact_export"),
+    path("contact/export/status", views.export_status, name="export_status"),
+    path("contact/export/download", views.export_download, name="export_download"),
+    path("contact/create", hot.contact_create, name="contact_create"),
+    path("contact/bulk_create", views.contact_bulk_create, name="contact_bulk_create"),
+    path("contact/del", hot.contact_del, name="contact_del"),
+
+    path("label/list", hot.label_list, name="label_list"),
+    path("label/create", hot.label_create, name="label_create"),
+    path("label/del", hot.label_del, name="label_del"),
+
+    path("segment/create", views.segment_create, name="segment_create"),
+    path("segment/list", views.segment_list, name="segment_list"),
+    path("segment/del", views.segment_del, name="segment_del"),
+
+    path("contact/add_label", hot.add_label, name="add_label"),
+    path("contact/remove_label", hot.remove_label, name="remove_label"),
+    path("contact/label_queue", views.label_queue_status, name="label_queue_status"),
+    path("contact/batch_label", views.batch_label, name="batch_label"),
+    path("contact/duplicates", views.contact_duplicates, name="contact_duplicates"),
 
-    path("label/list", views.label_list, name="label_list"),
-    path("label/create", views.label_create, name="label_create"),
-    path("label/del", views.label_del, name="label_del"),
+    path("changes", hot.changes_since, name="changes"),
 
-    path("contact/add_label", views.add_label, name="add_label"),
-    path("contact/remove_label", views.remove_label, name="remove_label"),
+    path("cache/stats", views.cache_stats, name="cache_stats"),
+    path("admission/stats", views.admission_stats, name="admission_stats"),
+    path("metrics", views.metrics, name="metrics"),
+    path("debug/requests", views.debug_requests, name="debug_requests"),
 
     path("true_del", views.true_del, name="true_del"),
     path("test/", views.api_test_page, name="api_test_page"),
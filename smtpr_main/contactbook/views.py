@@ -1,10 +1,38 @@
 from django.shortcuts import render
 
 # Create your views here.
+import bisect
 import json
-from django.http import JsonResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponse
+import os
+import time
+from django.db.models import Count
+from django.db.models.functions import Coalesce
+from django.http import FileResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseGone, HttpResponse, \
+    StreamingHttpResponse
+from django.urls import reverse
 from django.views.decorators.http import require_http_methods
-from .models import Contact, Label
+from . import admission, cache, changes, dedupe, deletion, exports, importer, instrumentation, label_index, label_queue, labels, \
+    memberships, query, search, segments, serialization
+from .cache import cached_view
+from .conditional import compressed_view, conditional_view
+from .database import read_only_view
+from .filters import active_label_ids, decode_cursor, encode_cursor, filter_contacts, \
+    parse_label_names, parse_limit, parse_list_params
+# django's JsonResponse, but the encoding time and rows are counted for the request stats
+from .instrumentation import JSONEncoder, JsonResponse
+from .models import ChangeEvent, Contact, ExportJob, Label, LabelMutation, LabelStat, LabelPairStat, Segment
+
+STREAM_CHUNK_SIZE = 2000  # rows fetched per round trip when streaming
+SEARCH_PAGE_SIZE = 20  # contact/search without limit=
+ID_CHUNK_SIZE = 500  # ids per "id IN (...)" query
+PURGE_BATCHES_PER_REQUEST = 10
+FILE_CHUNK_SIZE = 64 * 1024  # bytes read at a time when sending part of an export
+IMPORT_CONTENT_TYPES = {
+    "application/json": "json",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+    "text/csv": "csv",
+}
 
 
 def api_test_page(request):
@@ -16,12 +44,10 @@ def delete_object(request, model, obj_name="object"):
     if not obj_id:
         return HttpResponseBadRequest("id is required")
 
-    try:
-        obj = model.objects.get(id=obj_id)
-    except model.DoesNotExist:
+    # Only hidden for now, purge_deleted removes it (and whatever hangs on it) later on
+    if not deletion.soft_delete(model, [obj_id]):
         return HttpResponseBadRequest(f"{obj_name} not found")
 
-    obj.delete()
     return JsonResponse({"status": "ok", "deleted_id": obj_id})
 
 
@@ -46,50 +72,266 @@ def contact_create(request):
     return JsonResponse({"id": contact.id, "name": contact.name, "email": contact.email, "phone": contact.phone})
 
 
-@require_http_methods(["GET"])
-def contact_list(request):
-    qs = Contact.objects.all()
+def serialize_contact(c):
+    return {
+        "id": c.id,
+        "name": c.name,
+        "email": c.email,
+        "phone": c.phone,
+        "labels": [a_label.name for a_label in c.labels.all()],
+    }
 
-    labels_param = request.GET.get("labels", "").strip()  # Just in case there's blank spaces
-    emails_only = request.GET.get("emails_only", "").lower() in ("1", "true", "yes")
-    match_mode = request.GET.get("match", "or").lower()  # default: or
 
-    if labels_param:
-        label_names = [n.strip() for n in labels_param.split(",") if n.strip()]
-        if not label_names:
-            return HttpResponseBadRequest("valid label names should be separated by ','")
+def serialize_fields(c, fields):
+    """serialize_contact() with only the fields of a fields= projection, all of them for None"""
+    if fields is None:
+        return serialize_contact(c)
+    return {field: [a_label.name for a_label in c.labels.all()] if field == "labels" else getattr(c, field)
+            for field in fields}
 
-        if match_mode == "or":
-            # OR: contact has ANY of the labels
-            qs = qs.filter(labels__name__in=label_names).distinct()
 
-        elif match_mode == "and":
-            # AND: contact must have ALL labels
-            for name in label_names:
-                qs = qs.filter(labels__name=name)
-            qs = qs.distinct()
-        else:
-            return HttpResponseBadRequest("match must be 'and' or 'or'")
+def project(qs, fields):
+    """Selects only the columns of fields, the labels are only prefetched when they are one of them"""
+    if fields is None:
+        return qs.prefetch_related("labels")
+    qs = qs.only(*[field for field in fields if field != "labels"])
+    return qs.prefetch_related("labels") if "labels" in fields else qs
+
+
+def stream_json_array(items, prefix="", suffix=""):
+    # Yields the array piece by piece so we never hold the whole body in memory
+    yield prefix + "["
+    first = True
+    for item in items:
+        yield ("" if first else ",") + json.dumps(item, cls=JSONEncoder)
+        first = False
+    yield "]" + suffix
+
+
+def stream_ndjson(items):
+    for item in items:
+        yield json.dumps(item, cls=JSONEncoder) + "\n"
+
+
+def contacts_by_ids(ids, chunk_size=ID_CHUNK_SIZE, fields=None):
+    # Fetches by primary key in chunks, sqlite has a cap on the number of query parameters
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        yield from project(Contact.objects.filter(id__in=chunk).order_by("id"), fields)
+
+
+def emails_by_ids(ids, chunk_size=ID_CHUNK_SIZE):
+    emails = set()
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        emails.update(Contact.objects.filter(id__in=chunk).values_list("email", flat=True))
+    return sorted(emails)
+
+
+def label_index_response(params):
+    """contact_list when the in-memory label index answers the label part"""
+    label_names, exclude_names, match_mode = params["label_names"], params["exclude_names"], params["match_mode"]
+    emails_only, stream, output_format = params["emails_only"], params["stream"], params["output_format"]
+    limit, cursor, paged, page_size = params["limit"], params["cursor"], params["paged"], params["page_size"]
+
+    # The index answers the label part, the database only hands out rows by primary key
+    ids = label_index.label_index.contact_ids(label_names, match_mode, exclude_names)
+
+    if emails_only:
+        emails = emails_by_ids(ids)
+        if cursor:
+            emails = emails[bisect.bisect_right(emails, cursor["email"]):]
+        if stream:
+            return streaming_response(iter(emails[:limit] if limit else emails), output_format,
+                                      prefix='{"emails":', suffix="}")
+        if paged:
+            return JsonResponse(page_envelope("emails", emails[:page_size + 1], page_size,
+                                              lambda e: {"email": e}))
+        return JsonResponse({"emails": emails})
+
+    fields = params["fields"]
+    if cursor:
+        ids = ids[bisect.bisect_right(ids, cursor["id"]):]
+    if stream:
+        contacts = contacts_by_ids(ids[:limit] if limit else ids, fields=fields)
+        contacts = (serialize_fields(c, fields) for c in contacts)
+        return streaming_response(contacts, output_format)
+    if paged:
+        return JsonResponse(contact_page(list(contacts_by_ids(ids[:page_size + 1], fields=fields)), page_size, fields))
+    return JsonResponse([serialize_fields(c, fields) for c in contacts_by_ids(ids, fields=fields)], safe=False)
+
+
+@require_http_methods(["GET"])
+@label_queue.flushed
+@compressed_view
+@conditional_view
+@cached_view(cache.contact_list_scopes)
+@segments.reports_segment
+@read_only_view
+@admission.admitted(parse_list_params)
+def contact_list(request):
+    params, error = parse_list_params(request)
+    if error:
+        return HttpResponseBadRequest(error)
+    label_names, exclude_names, match_mode = params["label_names"], params["exclude_names"], params["match_mode"]
+    emails_only, stream, output_format = params["emails_only"], params["stream"], params["output_format"]
+    limit, sort_key, cursor = params["limit"], params["sort_key"], params["cursor"]
+    paged, page_size = params["paged"], params["page_size"]
+    qs = Contact.objects.all()
+
+    segment = segments.for_request(params)
+    if segment is not None:
+        # saved and kept up to date, the members are read instead of running the filter
+        qs = segments.contacts(segment[0])
+        request.contactbook_segment = segment[1]
+    elif params["query"] is not None:
+        plan = query.plan(params["query_text"], params["query"])
+        if params["explain"]:
+            return JsonResponse(plan.explain())
+        qs = plan.queryset
+    elif label_names and label_index.is_enabled():
+        return label_index_response(params)
+    else:
+        qs, error = filter_contacts(qs, label_names, match_mode, exclude_names)
+        if error:
+            return HttpResponseBadRequest(error)
+    if cursor:
+        qs = qs.filter(**{sort_key + "__gt": cursor[sort_key]})
 
     # Bonus: email-only mode
     if emails_only:
         emails = qs.values_list("email", flat=True).distinct()
+        if paged or stream:
+            emails = emails.order_by("email")
+        if stream:
+            emails = emails[:limit] if limit else emails
+            return streaming_response(emails.iterator(chunk_size=STREAM_CHUNK_SIZE),
+                                      output_format, prefix='{"emails":', suffix="}")
+        if paged:
+            page = list(emails[:page_size + 1])
+            return JsonResponse(page_envelope("emails", page, page_size, lambda e: {"email": e}))
         return JsonResponse({"emails": list(emails)})
 
-    # Full contact list
-    contacts = []
-    for c in qs.prefetch_related("labels"):
-        contacts.append({
-            "id": c.id,
-            "name": c.name,
-            "email": c.email,
-            "phone": c.phone,
-            "labels": [a_label.name for a_label in c.labels.all()],
-        })
+    fields = params["fields"]
+    if serialization.is_supported():
+        return fast_contact_list(serialization.contact_rows(qs.order_by("id"), fields), params)
+
+    qs = project(qs, fields).order_by("id")
+
+    if stream:
+        qs = qs[:limit] if limit else qs
+        contacts = (serialize_fields(c, fields) for c in qs.iterator(chunk_size=STREAM_CHUNK_SIZE))
+        return streaming_response(contacts, output_format)
+
+    if paged:
+        return JsonResponse(contact_page(list(qs[:page_size + 1]), page_size, fields))
 
+    # Full contact list
+    contacts = [serialize_fields(c, fields) for c in qs]
     return JsonResponse(contacts, safe=False)
 
 
+def fast_contact_list(rows, params):
+    """contact_list's contacts from flat rows, see serialization.py"""
+    limit, page_size = params["limit"], params["page_size"]
+    encode_row = serialization.row_encoder(params["fields"])
+    if params["stream"]:
+        rows = rows[:limit] if limit else rows
+        rows = rows.iterator(chunk_size=STREAM_CHUNK_SIZE)
+        if params["output_format"] == "ndjson":
+            return StreamingHttpResponse(serialization.stream_lines(rows, STREAM_CHUNK_SIZE, encode_row),
+                                         content_type="application/x-ndjson")
+        return StreamingHttpResponse(serialization.stream_array(rows, STREAM_CHUNK_SIZE, encode_row),
+                                     content_type="application/json")
+    if params["paged"]:
+        body = serialization.encode_page(list(rows[:page_size + 1]), page_size,
+                                         lambda row: encode_cursor({"id": row[0]}), encode_row)
+        return HttpResponse(body, content_type="application/json")
+    return HttpResponse(serialization.encode_array(list(rows), encode_row), content_type="application/json")
+
+
+def page_envelope(key, page, limit, cursor_of):
+    # We fetched one row more than asked, if it's there, there's a next page
+    has_next = len(page) > limit
+    page = page[:limit]
+    return {key: page, "next": encode_cursor(cursor_of(page[-1])) if has_next else None}
+
+
+def contact_page(contacts, limit, fields):
+    # the cursor comes from the model, fields= may have left the id out of the answer
+    envelope = page_envelope("results", contacts, limit, lambda c: {"id": c.id})
+    envelope["results"] = [serialize_fields(c, fields) for c in envelope["results"]]
+    return envelope
+
+
+def streaming_response(items, output_format, prefix="", suffix=""):
+    if output_format == "ndjson":
+        return StreamingHttpResponse(stream_ndjson(items), content_type="application/x-ndjson")
+    return StreamingHttpResponse(stream_json_array(items, prefix, suffix),
+                                 content_type="application/json")
+
+
+@require_http_methods(["POST"])
+def contact_bulk_create(request):
+    input_format = request.GET.get("format", "").lower() or IMPORT_CONTENT_TYPES.get(request.content_type, "json")
+    if input_format not in importer.FORMATS:
+        return HttpResponseBadRequest("format must be one of " + ", ".join(importer.FORMATS))
+    try:
+        batch_size = int(request.GET.get("batch_size", importer.DEFAULT_BATCH_SIZE))
+    except ValueError:
+        return HttpResponseBadRequest("batch_size must be an integer")
+    if batch_size < 1:
+        return HttpResponseBadRequest("batch_size must be positive")
+
+    # The request is read line by line, the body never has to fit in memory as a whole
+    report = importer.import_contacts(importer.iter_rows(request, input_format), batch_size)
+    return JsonResponse(report, status=400 if "fatal" in report else 200)
+
+
+@require_http_methods(["GET"])
+@label_queue.flushed
+@read_only_view
+def contact_search(request):
+    """Contacts whose name, email or phone contain q, best matches first, combinable with the label filters."""
+    q = request.GET.get("q", "").strip()
+    if not q:
+        return HttpResponseBadRequest("q is required")
+
+    labels_param = request.GET.get("labels", "").strip()
+    exclude_param = request.GET.get("exclude", "").strip()
+    label_names = parse_label_names(labels_param)
+    exclude_names = parse_label_names(exclude_param)
+    if (labels_param and not label_names) or (exclude_param and not exclude_names):
+        return HttpResponseBadRequest("valid label names should be separated by ','")
+    qs, error = filter_contacts(Contact.objects.all(), label_names,
+                                request.GET.get("match", "or").lower(), exclude_names)
+    if error:
+        return HttpResponseBadRequest(error)
+
+    limit, error = parse_limit(request)
+    if error:
+        return HttpResponseBadRequest(error)
+    limit = limit or SEARCH_PAGE_SIZE
+
+    after = request.GET.get("after", "").strip()
+    last = None
+    if after:
+        cursor = decode_cursor(after)
+        if not isinstance(cursor, dict) or "id" not in cursor:
+            return HttpResponseBadRequest("invalid cursor")
+        last = (cursor["id"], cursor.get("rank"))
+
+    hits = search.search_contacts(qs, q, limit + 1, last)
+    contacts = Contact.objects.in_bulk([contact_id for contact_id, _ in hits[:limit]])
+    page = []
+    for contact_id, rank in hits:
+        # the extra row only tells there's a next page, page_envelope drops it
+        contact = serialize_contact(contacts[contact_id]) if contact_id in contacts else {"id": contact_id}
+        contact["rank"] = rank
+        page.append(contact)
+    return JsonResponse(page_envelope("results", page, limit, lambda c: {"id": c["id"], "rank": c["rank"]}))
+
+
 @require_http_methods(["GET"])
 def contact_del(request):
     return delete_object(request, Contact, "contact")
@@ -99,17 +341,98 @@ def contact_del(request):
 def label_create(request):
     data = parse_body(request)
     name = data.get("name", None)
-    if not name:
+    if not isinstance(name, str) or not name.strip():
         return HttpResponseBadRequest("name is required")
 
-    a_label, created = Label.objects.get_or_create(name=name.strip()) # Just in case there's blank spaces
+    a_label, created = labels.get_or_create(name)
     return JsonResponse({"id": a_label.id, "name": a_label.name, "created": created})
 
 
+def facet_list(rows):
+    return [{"id": label_id, "name": name, "contacts": count} for label_id, name, count in rows]
+
+
+def wants_counts(request):
+    return request.GET.get("with_counts", "").lower() in ("1", "true", "yes")
+
+
+def label_list_values(request):
+    live_labels = Label.objects.all().order_by("id")
+    if wants_counts(request):
+        # the LabelStat counters, a label nobody ever had has no row yet
+        return live_labels.values_list("id", "name", Coalesce("stat__contact_count", 0))
+    return live_labels.values("id", "name")
+
+
+def label_list_entries(request, labels):
+    return facet_list(labels) if wants_counts(request) else list(labels)
+
+
 @require_http_methods(["GET"])
+@label_queue.flushed
+@compressed_view
+@conditional_view
+@cached_view(cache.label_list_scopes)
+@read_only_view
 def label_list(request):
-    labels = Label.objects.all().values("id", "name")
-    return JsonResponse(list(labels), safe=False)
+    return JsonResponse(label_list_entries(request, label_list_values(request)), safe=False)
+
+
+def counted_facets(label_names, ids_by_name):
+    """contact_facets from the counters, for no label or one label. Returns (total, facets)."""
+    if not label_names:
+        rows = Label.objects.filter(stat__contact_count__gt=0).values_list("id", "name", "stat__contact_count")
+        return Contact.objects.count(), facet_list(rows)
+    label_id = ids_by_name.get(label_names[0])
+    if label_id is None:
+        return 0, []
+    total = LabelStat.objects.filter(label_id=label_id).values_list("contact_count", flat=True).first() or 0
+    rows = (LabelPairStat.objects.filter(label_id=label_id, other__is_deleted=False, contact_count__gt=0)
+            .values_list("other_id", "other__name", "contact_count"))
+    return total, facet_list(rows)
+
+
+def queried_facets(qs, label_ids):
+    """contact_facets counted over the filtered contacts. Returns (total, facets)."""
+    rows = (Label.objects.filter(contacts__in=qs.values("id")).exclude(id__in=label_ids)
+            .values_list("id", "name").annotate(Count("contacts")))
+    return qs.count(), facet_list(rows)
+
+
+@require_http_methods(["GET"])
+@label_queue.flushed
+@cached_view(cache.contact_list_scopes)
+@read_only_view
+def contact_facets(request):
+    """
+    How many contacts match the labels/exclude/match filter of contact/list, and how many of those carry
+    each other label. No filter or a single label is read off the counters of label_stats.py, anything
+    else is counted by the database.
+    """
+    params, error = parse_list_params(request)
+    if error:
+        return HttpResponseBadRequest(error)
+    label_names, exclude_names = params["label_names"], params["exclude_names"]
+    ids_by_name = active_label_ids(label_names + exclude_names) if label_names or exclude_names else {}
+
+    if params["query"] is not None:
+        qs = query.plan(params["query_text"], params["query"]).queryset
+        shown = active_label_ids(query.positive_label_names(params["query"]))
+        total, facets = queried_facets(qs, list(shown.values()))
+        source = "query"
+    elif len(set(label_names)) <= 1 and not exclude_names:
+        total, facets = counted_facets(label_names, ids_by_name)
+        source = "counters"
+    else:
+        qs, error = filter_contacts(Contact.objects.all(), label_names, params["match_mode"], exclude_names,
+                                    ids_by_name=ids_by_name)
+        if error:
+            return HttpResponseBadRequest(error)
+        total, facets = queried_facets(qs, [ids_by_name[name] for name in label_names if name in ids_by_name])
+        source = "query"
+
+    facets = sorted(facets, key=lambda facet: (-facet["contacts"], facet["id"]))
+    return JsonResponse({"total": total, "facets": facets, "source": source})
 
 
 @require_http_methods(["GET"])
@@ -117,30 +440,92 @@ def label_del(request):
     return delete_object(request, Label, "label")
 
 
+def segment_json(segment, members):
+    return {"id": segment.id, "name": segment.name, "q": segment.query, "contacts": members,
+            "refreshed_date": segment.refreshed_date}
+
+
+@require_http_methods(["POST"])
+def segment_create(request):
+    """Saves a label expression as a segment, contact/list answers it from the segment from then on"""
+    data = parse_body(request)
+    text = data.get("q")
+    if not isinstance(text, str) or not text.strip():
+        return HttpResponseBadRequest("q is required")
+    try:
+        segment = segments.create(data.get("name"), text)
+    except segments.SegmentError as e:
+        return HttpResponseBadRequest(str(e))
+    return JsonResponse(segment_json(segment, segment.members.count()))
+
+
+@require_http_methods(["GET"])
+def segment_list(request):
+    saved = Segment.objects.annotate(n=Count("members")).order_by("name")
+    return JsonResponse([segment_json(segment, segment.n) for segment in saved], safe=False)
+
+
+@require_http_methods(["GET"])
+def segment_del(request):
+    segment_id = request.GET.get("id")
+    if not segment_id or not segment_id.isdigit():
+        return HttpResponseBadRequest("id is required")
+    if not Segment.objects.filter(id=segment_id).delete()[0]:
+        return HttpResponseBadRequest("segment not found")
+    return JsonResponse({"status": "ok", "deleted_id": int(segment_id)})
+
+
+@require_http_methods(["GET"])
+def cache_stats(request):
+    result_cache = cache.get_result_cache()
+    return JsonResponse(result_cache.stats() if result_cache else {"backend": None})
+
+
+@require_http_methods(["GET"])
+def admission_stats(request):
+    controller = admission.get_controller()
+    return JsonResponse(controller.stats() if controller else {"enabled": False})
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """Histograms per view of the measured requests, in the Prometheus text format"""
+    return HttpResponse(instrumentation.metrics.prometheus() + admission.prometheus(),
+                        content_type="text/plain; version=0.0.4")
+
+
+@require_http_methods(["GET"])
+def debug_requests(request):
+    """The last measured requests, the ones sent with X-Contactbook-Debug: 1 list their queries"""
+    if not instrumentation.may_debug(request.user):
+        return HttpResponseForbidden("staff only")
+    return JsonResponse(list(instrumentation.metrics.recent), safe=False)
+
+
+@require_http_methods(["GET"])
 def true_del(request):
-    return HttpResponse("OK")
+    # One bounded round of the purge, purge_deleted --loop is what should run in production
+    counts = deletion.purge_deleted(max_batches=PURGE_BATCHES_PER_REQUEST)
+    return JsonResponse(counts)
 
 
 @require_http_methods(["POST"])
 def add_label(request):
     data = parse_body(request)
     contact_id = data.get("contact_id")
-    label_names = data.get("labels", [])  # return empty list for label if there's none provided
+    label_names = name_list(data.get("labels", []))  # stripped, empty names left out
 
     if not contact_id or not label_names:
         return HttpResponseBadRequest("contact_id and labels are required")
+    if label_queue.is_enabled():
+        return enqueue_labels(LabelMutation.ADD, contact_id, label_names)
 
     try:
         contact = Contact.objects.get(id=contact_id)
     except Contact.DoesNotExist:
         return HttpResponseBadRequest("contact with id" + str(contact_id) + "not found")
 
-    labels = []
-    for name in label_names:
-        a_label, _ = Label.objects.get_or_create(name=name.strip()) # Just in case there's blank spaces
-        labels.append(a_label)
-
-    contact.labels.add(*labels)
+    contact.labels.add(*labels.resolve(label_names, create=True).values())
 
     return JsonResponse({
         "contact_id": contact.id,
@@ -153,20 +538,324 @@ def remove_label(request):
     data = parse_body(request)
 
     contact_id = data.get("contact_id")
-    label_names = data.get("labels", [])
+    label_names = name_list(data.get("labels", []))
 
     if not contact_id or not label_names:
         return HttpResponseBadRequest("contact_id and labels are required")
+    if label_queue.is_enabled():
+        return enqueue_labels(LabelMutation.REMOVE, contact_id, label_names)
 
     try:
         contact = Contact.objects.get(id=contact_id)
     except Contact.DoesNotExist:
         return HttpResponseBadRequest("contact not found")
 
-    labels = Label.objects.filter(name__in=label_names)
-    contact.labels.remove(*labels)
+    contact.labels.remove(*labels.resolve(label_names).values())
 
     return JsonResponse({
         "contact_id": contact.id,
         "labels": [a_label.name for a_label in contact.labels.all()]
     })
+
+
+def mutation_json(mutation):
+    return {
+        "ticket": mutation.id,
+        "status": mutation.status,
+        "action": mutation.action,
+        "contact_id": mutation.contact_id,
+        "labels": mutation.labels,
+        "error": mutation.error,
+        "created": mutation.created_date,
+        "applied": mutation.applied_date,
+        "status_url": reverse("label_queue_status") + f"?ticket={mutation.id}",
+    }
+
+
+def enqueue_labels(action, contact_id, label_names):
+    """add_label / remove_label in write-behind mode (label_queue.py): 202 with the ticket"""
+    try:
+        contact_id = int(contact_id)
+    except (TypeError, ValueError):
+        return HttpResponseBadRequest("contact_id must be a number")
+    return JsonResponse(mutation_json(label_queue.enqueue(action, contact_id, label_names)), status=202)
+
+
+@require_http_methods(["GET"])
+def label_queue_status(request):
+    """A write-behind add_label / remove_label by its ticket, without one how many of the book wait"""
+    if "ticket" not in request.GET:
+        return JsonResponse({"enabled": label_queue.is_enabled(), "queued": label_queue.pending()})
+    try:
+        mutation = LabelMutation.objects.get(id=int(request.GET["ticket"]))
+    except (ValueError, LabelMutation.DoesNotExist):
+        return HttpResponseBadRequest("ticket not found")
+    return JsonResponse(mutation_json(mutation))
+
+
+def name_list(value):
+    """Label names given either as a list or as "a,b" """
+    if isinstance(value, str):
+        return parse_label_names(value)
+    if isinstance(value, list) and all(isinstance(n, str) for n in value):
+        return [n.strip() for n in value if n.strip()]
+    return None
+
+
+def existing_contact_id_chunks(contact_ids):
+    for chunk in memberships.chunked(sorted(set(contact_ids))):
+        yield list(Contact.objects.filter(id__in=chunk).order_by("id").values_list("id", flat=True))
+
+
+@require_http_methods(["POST"])
+def batch_label(request):
+    """Adds and/or removes labels on many contacts, picked by id or by a label filter."""
+    data = parse_body(request)
+    contact_ids = data.get("contact_ids")
+    label_filter = data.get("filter")
+    add_names = name_list(data.get("add", []))
+    remove_names = name_list(data.get("remove", []))
+
+    if add_names is None or remove_names is None:
+        return HttpResponseBadRequest("add and remove must be lists of label names")
+    if not add_names and not remove_names:
+        return HttpResponseBadRequest("add or remove is required")
+    if set(add_names) & set(remove_names):
+        return HttpResponseBadRequest("a label can't be added and removed at the same time")
+    if (contact_ids is None) == (label_filter is None):
+        return HttpResponseBadRequest("either contact_ids or filter is required")
+
+    if contact_ids is not None:
+        if not isinstance(contact_ids, list) or not all(isinstance(i, int) for i in contact_ids):
+            return HttpResponseBadRequest("contact_ids must be a list of ids")
+        id_chunks = existing_contact_id_chunks(contact_ids)
+    else:
+        if not isinstance(label_filter, dict):
+            return HttpResponseBadRequest("filter must be an object")
+        filter_names = name_list(label_filter.get("labels", []))
+        if not filter_names:
+            return HttpResponseBadRequest("filter.labels is required")
+        qs, error = filter_contacts(Contact.objects.all(), filter_names,
+                                    str(label_filter.get("match", "or")).lower())
+        if error:
+            return HttpResponseBadRequest(error)
+        id_chunks = memberships.iter_id_chunks(qs)
+
+    add_ids = labels.resolve(add_names, create=True).values()
+    remove_ids = labels.resolve(remove_names).values()
+    counts = memberships.apply_to_contacts(id_chunks, list(add_ids), list(remove_ids))
+    return JsonResponse(counts)
+
+
+@require_http_methods(["GET", "POST"])
+def contact_duplicates(request):
+    """GET reports the duplicate contacts (a dry run), POST merges them. See dedupe.py."""
+    return JsonResponse(dedupe.dedupe(dry_run=request.method == "GET"))
+
+
+def export_json(job):
+    status_url = reverse("export_status") + f"?id={job.id}"
+    data = {
+        "id": job.id,
+        "status": job.status,
+        "params": job.params,
+        "format": job.file_format,
+        "compression": job.compression,
+        "rows": job.rows,
+        "size": job.size,
+        "error": job.error,
+        "created": job.created_date,
+        "finished": job.finished_date,
+        "status_url": status_url,
+        "download_url": None,
+    }
+    if job.status == ExportJob.DONE:
+        data["download_url"] = reverse("export_download") + f"?id={job.id}"
+    return data
+
+
+@require_http_methods(["POST"])
+def contact_export(request):
+    """
+    Starts writing the contacts (or emails) of a label filter to a file in the background. Answers 202 with
+    the job, poll its status_url until download_url is set.
+    """
+    data = parse_body(request)
+    label_names = name_list(data.get("labels", []))
+    exclude_names = name_list(data.get("exclude", []))
+    match_mode = str(data.get("match", "or")).lower()
+    file_format = str(data.get("format", "csv")).lower()
+    compression = str(data.get("compression", "gzip")).lower()
+
+    if label_names is None or exclude_names is None:
+        return HttpResponseBadRequest("labels and exclude must be lists of label names")
+    if label_names and match_mode not in ("and", "or"):
+        return HttpResponseBadRequest("match must be 'and' or 'or'")
+    error = exports.check_options(file_format, compression)
+    if error:
+        return HttpResponseBadRequest(error)
+
+    job = exports.create_job(label_names, exclude_names, match_mode, bool(data.get("emails_only")),
+                             file_format, compression)
+    return JsonResponse(export_json(job), status=202)
+
+
+def get_export(request):
+    try:
+        return ExportJob.objects.get(id=int(request.GET.get("id", "")))
+    except (ValueError, ExportJob.DoesNotExist):
+        return None
+
+
+@require_http_methods(["GET"])
+def export_status(request):
+    job = get_export(request)
+    if job is None:
+        return HttpResponseBadRequest("export not found")
+    return JsonResponse(export_json(job))
+
+
+def parse_range(header, size):
+    """
+    The (start, end) byte positions of a single range "bytes=a-b", "bytes=a-" or "bytes=-n", end included.
+    None when there's no usable range (the whole file is sent), "unsatisfiable" when it lies past the end.
+    """
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    first, _, last = header[len("bytes="):].strip().partition("-")
+    try:
+        if not first:  # the last n bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return "unsatisfiable"
+    return start, end
+
+
+def file_slice(path, start, length):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(FILE_CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+@require_http_methods(["GET"])
+def export_download(request):
+    """The export file, whole or the byte range asked for in a Range header, read from disk in chunks"""
+    job = get_export(request)
+    if job is None:
+        return HttpResponseBadRequest("export not found")
+    if job.status != ExportJob.DONE:
+        return HttpResponse(f"export is {job.status}", status=409)
+
+    path = exports.file_path(job)
+    size = os.path.getsize(path)
+    byte_range = parse_range(request.headers.get("Range", ""), size)
+    if byte_range == "unsatisfiable":
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+    if byte_range is None:
+        response = FileResponse(open(path, "rb"), as_attachment=True, filename=exports.file_name(job),
+                                content_type=exports.content_type(job))
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(file_slice(path, start, end - start + 1), status=206,
+                                         content_type=exports.content_type(job))
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(end - start + 1)
+        response["Content-Disposition"] = f'attachment; filename="{exports.file_name(job)}"'
+    response["Accept-Ranges"] = "bytes"
+    return response
+
+
+def parse_changes_params(request):
+    """since, limit and wait of changes, returns (params, error). since is None when not given."""
+    config = changes.get_config()
+    params = {"since": None, "limit": config["PAGE_SIZE"], "wait": 0.0}
+    try:
+        if request.GET.get("since", "").strip():
+            params["since"] = int(request.GET["since"])
+        if request.GET.get("limit", "").strip():
+            params["limit"] = int(request.GET["limit"])
+        if request.GET.get("wait", "").strip():
+            params["wait"] = float(request.GET["wait"])
+    except ValueError:
+        return None, "since, limit and wait must be numbers"
+    if params["since"] is not None and params["since"] < 0:
+        return None, "since must be 0 or more"
+    if not 1 <= params["limit"] <= config["PAGE_SIZE"]:
+        return None, f"limit must be between 1 and {config['PAGE_SIZE']}"
+    if not 0 <= params["wait"] <= config["MAX_WAIT"]:
+        return None, f"wait must be between 0 and {config['MAX_WAIT']} seconds"
+    return params, None
+
+
+def change_entry(event):
+    seq, action, contact_id, label_id = event
+    entry = {"seq": seq, "action": action}
+    if contact_id is not None:
+        entry["contact_id"] = contact_id
+    if label_id is not None:
+        entry["label_id"] = label_id
+    return entry
+
+
+def change_page(since, limit):
+    """
+    The answer of changes: the events after since, and the current state of the contacts and labels
+    they create or restore (the ones still live), so a client needs no other request to apply them.
+    """
+    events, more = changes.read(since, limit)
+    contact_ids = sorted({contact_id for _, action, contact_id, _ in events
+                          if action in (ChangeEvent.CONTACT_CREATED, ChangeEvent.CONTACT_RESTORED)})
+    label_ids = sorted({label_id for _, action, _, label_id in events
+                        if action in (ChangeEvent.LABEL_CREATED, ChangeEvent.LABEL_RESTORED)})
+    return {
+        "changes": [change_entry(event) for event in events],
+        "contacts": [serialize_contact(c) for c in contacts_by_ids(contact_ids)],
+        "labels": list(Label.objects.filter(id__in=label_ids).order_by("id").values("id", "name")),
+        "next": events[-1][0] if events else since,
+        "more": more,
+    }
+
+
+def start_of_changes(params):
+    """
+    Answers changes without since (the seq to start from) or with one that was trimmed away (410, the
+    client has to download the book again). None when there are changes to look for.
+    """
+    if params["since"] is None:
+        return JsonResponse({"changes": [], "contacts": [], "labels": [], "next": changes.head(), "more": False})
+    if changes.is_trimmed(params["since"]):
+        return HttpResponseGone("since is older than the change log, download contact/list again")
+    return None
+
+
+@require_http_methods(["GET"])
+@label_queue.flushed
+@compressed_view
+def changes_since(request):
+    params, error = parse_changes_params(request)
+    if error:
+        return HttpResponseBadRequest(error)
+    response = start_of_changes(params)
+    if response is not None:
+        return response
+
+    # long poll: look again whenever this process commits events, or every POLL_INTERVAL for the others
+    deadline = time.monotonic() + params["wait"]
+    while True:
+        generation = changes.notifier.generation
+        page = change_page(params["since"], params["limit"])
+        remaining = deadline - time.monotonic()
+        if page["changes"] or remaining <= 0:
+            return JsonResponse(page)
+        changes.notifier.wait(generation, min(remaining, changes.get_config()["POLL_INTERVAL"]))
@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'contactbook.instrumentation.InstrumentationMiddleware',
+    'contactbook.books.BookMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,9 +79,30 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # keep connections (and their PRAGMAs, see contactbook/database.py) for a minute, checked before reuse
+        'CONN_MAX_AGE': 60,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # take the write lock when the transaction starts, two transactions upgrading their read lock
+            # at the same time fail with "database is locked" whatever the busy timeout
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
+# Read replicas get the queries of the read-only views (contact/list, contact/search, contact/facets,
+# label/list), e.g. a LiteFS / Litestream copy or a Postgres standby:
+#   DATABASES['replica'] = {**DATABASES['default'], 'NAME': ..., 'TEST': {'MIRROR': 'default'}}
+#   CONTACTBOOK_READ_REPLICAS = ['replica']
+DATABASE_ROUTERS = ['contactbook.books.BookRouter', 'contactbook.database.ReadReplicaRouter']
+CONTACTBOOK_READ_REPLICAS = []
+
+# Big books (see contactbook/books.py) get a database of their own, slug -> alias:
+#   DATABASES['acme'] = {**DATABASES['default'], 'NAME': BASE_DIR / 'acme.sqlite3'}
+#   CONTACTBOOK_BOOK_DATABASES = {'acme': 'acme'}
+# then manage.py migrate --database acme, before manage.py create_book acme (moving the rows of a book is manual).
+CONTACTBOOK_BOOK_DATABASES = {}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -121,3 +144,68 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Contact book
+# Keep label -> contacts bitmaps in memory and answer label filters with set operations.
+# Only turn this on when a single process handles all writes, see contactbook/label_index.py
+CONTACTBOOK_LABEL_INDEX = False
+
+# Result cache of contact/list and label/list, see contactbook/cache.py.
+# "locmem" is an LRU inside this process, "django" uses CACHES[ALIAS] so several workers can share it.
+CONTACTBOOK_CACHE = {
+    "BACKEND": "locmem",
+    "MAX_ENTRIES": 1000,
+}
+
+# Deleted contacts and labels stay (hidden) this long before purge_deleted removes them
+CONTACTBOOK_PURGE_AFTER_HOURS = 24
+
+# Serve contact/list, label/list, changes and the single contact/label writes with the async views of
+# contactbook/async_views.py. Only worth it under ASGI: uvicorn smtpr_main.asgi:application
+CONTACTBOOK_ASYNC_VIEWS = False
+
+# Per-request SQL / serialization stats, served as histograms by contactbook/metrics.
+# Requests with the X-Contactbook-Debug: 1 header are always measured, see contactbook/instrumentation.py
+CONTACTBOOK_METRICS = {
+    "SAMPLE_RATE": 0.1,
+}
+
+# PRAGMAs of every SQLite connection, see contactbook/database.py for the defaults (WAL, synchronous=NORMAL,
+# busy_timeout 5s, 64MB cache, 256MB mmap)
+CONTACTBOOK_SQLITE = {
+    "ENABLED": True,
+}
+
+# contact/export and manage.py export_contacts, see contactbook/exports.py. Files go to DIR (BASE_DIR/exports),
+# WORKERS threads of the web process write them; with 0 run manage.py export_contacts --pending instead.
+CONTACTBOOK_EXPORTS = {
+    "WORKERS": 2,
+}
+
+# changes?since=, see contactbook/changes.py. A long poll (wait=) waits at most MAX_WAIT seconds;
+# manage.py trim_changes removes the events older than RETENTION_DAYS.
+CONTACTBOOK_CHANGES = {
+    "MAX_WAIT": 30,
+    "RETENTION_DAYS": 30,
+}
+
+# contact/duplicates and manage.py dedupe_contacts, see contactbook/dedupe.py. Phone numbers without a
+# country code are read as numbers of COUNTRY_CODE (e.g. "31"), left as they are with None.
+CONTACTBOOK_DEDUPE = {
+    "COUNTRY_CODE": None,
+}
+
+# Write-behind contact/add_label and contact/remove_label, see contactbook/label_queue.py. With ENABLED they answer
+# 202 with a ticket (contact/label_queue?ticket=) and a thread applies the queue every INTERVAL seconds, in batches;
+# with "WORKER": False run manage.py apply_label_queue --loop instead. FLUSH_ON_READ applies it before every list.
+CONTACTBOOK_WRITE_BEHIND = {
+    "ENABLED": False,
+}
+
+# Admission control for contact/list, see contactbook/admission.py. Requests estimated to read EXPENSIVE_ROWS rows or
+# more need one of MAX_CONCURRENT slots (MAX_CONCURRENT_PER_CLIENT per client) and tokens of the rows per second
+# buckets, or get a 429 with Retry-After after waiting QUEUE_SECONDS. The counters are at contactbook/admission/stats.
+CONTACTBOOK_ADMISSION = {
+    "ENABLED": False,
+}